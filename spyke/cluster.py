@@ -15,6 +15,10 @@ from PyQt4.QtCore import Qt
 getSaveFileName = QtGui.QFileDialog.getSaveFileName
 from OpenGL import GL, GLU
 
+import pyximport
+pyximport.install(build_in_temp=False, inplace=True)
+from . import util # .pyx file
+
 from .core import SpykeToolWindow, lstrip, lst2shrtstr, tocontig
 from .plot import CLUSTERCOLOURSRGB, GREYRGB, CLUSTERCOLOURRGBDICT
 
@@ -22,6 +26,119 @@ CLUSTERPARAMMAXSAMPLES = 2000
 VIEWDISTANCE = 50
 
 
+def groupmedians(a, counts):
+    """Return median of each group of values in 1D array a, where a consists of
+    consecutive groups of counts values each, all of them > 0. Same result as calling
+    np.median on each group, but all groups are done in a single pass in Cython"""
+    a = np.ascontiguousarray(a, dtype=np.float64)
+    counts = np.ascontiguousarray(counts, dtype=np.int64)
+    medians = np.empty(len(counts))
+    util.segmedians(a, counts, medians)
+    return medians
+
+def update_poss(clusters, dims=None, nsamples=CLUSTERPARAMMAXSAMPLES):
+    """Update unnormalized and normalized positions of all clusters along specified dims,
+    which default to all dims in their positions. Use median instead of mean to reduce
+    influence of outliers on cluster position. Subsample each cluster for speed. All
+    clusters are gathered from the spikes array together and have their medians taken
+    in a single pass per dim, which is much faster than doing them one by one when
+    there are many"""
+    # clusters without spikes have no position to update:
+    clusters = [ cluster for cluster in clusters if len(cluster.neuron.sids) > 0 ]
+    if len(clusters) == 0:
+        return
+    sort = clusters[0].neuron.sort
+    spikes = sort.spikes
+    if dims is None: # use all of them
+        dims = [] # some of these might not exist in spikes array
+        for cluster in clusters:
+            dims.extend([ dim for dim in cluster.pos if dim not in dims ])
+    sidss = []
+    for cluster in clusters:
+        sids = cluster.neuron.sids
+        nspikes = len(sids)
+        if nsamples and nspikes > nsamples: # subsample spikes
+            step = nspikes // nsamples + 1
+            print('neuron %d: update_pos() sampling every %d spikes instead of all %d'
+                  % (cluster.id, step, nspikes))
+            sids = sids[::step]
+        sidss.append(sids)
+    counts = [ len(sids) for sids in sidss ]
+    sids = np.concatenate(sidss)
+
+    ## FIXME: some code duplication from sort.get_param_matrix()?
+    for dim in dims:
+        try:
+            spikes[dim]
+        except ValueError:
+            continue # this dim doesn't exist in spikes record array, ignore it
+        # data from all spikes:
+        data = spikes[dim]
+        # data from clusters' spikes, potentially subsample of them,
+        # copied for in-place normalization:
+        subdata = np.float64(data[sids])
+        # update unnormalized positions
+        poss = groupmedians(subdata, counts)
+        # get mean and std for normalization
+        mean, std = sort.get_paramstats(dim)
+        if dim in ['x0', 'y0'] and sort.probe.ncols > 1: # norm spatial params by x0 std
+            std = sort.get_paramstats('x0')[1]
+        # now do the actual normalization
+        subdata -= mean
+        if std != 0:
+            subdata /= std
+        # update normalized positions
+        normposs = groupmedians(subdata, counts)
+        for cluster, pos, normpos in zip(clusters, poss, normposs):
+            cluster.pos[dim] = pos
+            cluster.normpos[dim] = normpos
+
+def update_compposs(clusters, X, sids, nsamples=CLUSTERPARAMMAXSAMPLES):
+    """Update unnormalized and normalized component analysis (PCA/ICA) positions of all
+    clusters, from component matrix X of sorted sids. Use median instead of mean to
+    reduce influence of outliers on cluster position. Subsample each cluster for speed.
+    Like update_poss(), the spikes of all clusters are grouped together, by a stable
+    argsort of their nids, and their medians taken in a single pass per component"""
+    clusters = list(clusters)
+    if len(clusters) == 0:
+        return
+    spikes = clusters[0].neuron.sort.spikes
+    nids = spikes['nid'][sids]
+    sidis = nids.argsort(kind='mergesort') # grouped by nid, sorted within each group
+    unids, starts, counts = np.unique(nids[sidis], return_index=True, return_counts=True)
+    found, sidiss = [], []
+    for cluster in clusters:
+        i = unids.searchsorted(cluster.id)
+        if i == len(unids) or unids[i] != cluster.id:
+            continue # cluster has no spikes in sids, nothing to update
+        mysidis = sidis[starts[i]:starts[i]+counts[i]]
+        nspikes = len(mysidis)
+        if nsamples and nspikes > nsamples: # subsample spikes
+            step = nspikes // nsamples + 1
+            print('neuron %d: update_comppos() sampling every %d spikes instead '
+                  'of all %d in last CA' % (cluster.id, step, nspikes))
+            mysidis = mysidis[::step]
+        found.append(cluster)
+        sidiss.append(mysidis)
+    if len(found) == 0:
+        return
+    counts = [ len(mysidis) for mysidis in sidiss ]
+    subX = X[np.concatenate(sidiss)]
+    mean = X.mean(axis=0)
+    std = X.std(axis=0)
+    for compid in range(X.shape[1]):
+        subdata = np.float64(subX[:, compid]) # copied for in-place normalization
+        medians = groupmedians(subdata, counts)
+        subdata -= mean[compid]
+        subdata /= std[compid]
+        normmedians = groupmedians(subdata, counts)
+        # write component fields to dicts:
+        dim = 'c%d' % compid
+        for cluster, median, normmedian in zip(found, medians, normmedians):
+            cluster.pos[dim] = median
+            cluster.normpos[dim] = normmedian
+
+
 class Cluster(object):
     """A container for scaled multidim cluster parameters.
     A Cluster will always correspond to a Neuron"""
@@ -66,89 +183,13 @@ class Cluster(object):
         """Update unnormalized and normalized cluster positions for self along specified
         dims. Use median instead of mean to reduce influence of outliers on cluster
         position. Subsample for speed"""
-        sort = self.neuron.sort
-        spikes = sort.spikes
-        if dims is None: # use all of them
-            dims = list(self.pos) # some of these might not exist in spikes array
-        sids = self.neuron.sids
-        nspikes = len(sids)
-        if nsamples and nspikes > nsamples: # subsample spikes
-            step = nspikes // nsamples + 1 
-            print('neuron %d: update_pos() sampling every %d spikes instead of all %d'
-                  % (self.id, step, nspikes))
-            sids = sids[::step]
-            nspikes = len(sids) # update
-
-        # check for pre-calculated spike param means and stds
-        try: sort.means
-        except AttributeError: sort.means = {}
-        try: sort.stds
-        except AttributeError: sort.stds = {}
-
-        ## FIXME: some code duplication from sort.get_param_matrix()?
-        for dim in dims:
-            try:
-                spikes[dim]
-            except ValueError:
-                continue # this dim doesn't exist in spikes record array, ignore it
-            # data from all spikes:
-            data = spikes[dim]
-            # data from neuron's spikes, potentially subsample of them,
-            # copied for in-place normalization:
-            subdata = np.float64(data[sids].copy())
-            # update unnormalized position
-            self.pos[dim] = np.median(subdata)
-            # calculate mean and std for normalization
-            try: mean = sort.means[dim]
-            except KeyError:
-                mean = data.mean()
-                sort.means[dim] = mean # save to pre-calc
-            if dim in ['x0', 'y0'] and sort.probe.ncols > 1: # norm spatial params by x0 std
-                try: std = sort.stds['x0']
-                except KeyError:
-                    std = spikes['x0'].std()
-                    sort.stds['x0'] = std # save to pre-calc
-            else: # normalize all other params by their std
-                try: std = sort.stds[dim]
-                except KeyError:
-                    std = data.std()
-                    sort.stds[dim] = std # save to pre-calc
-            # now do the actual normalization
-            subdata -= mean
-            if std != 0:
-                subdata /= std
-            # update normalized position
-            self.normpos[dim] = np.median(subdata)
+        update_poss([self], dims=dims, nsamples=nsamples)
 
     def update_comppos(self, X, sids, nsamples=CLUSTERPARAMMAXSAMPLES):
         """Update unnormalized and normalized component analysis (PCA/ICA) values for
         self. Use median instead of mean to reduce influence of outliers on cluster
         position. Subsample for speed"""
-        sort = self.neuron.sort
-        ncomp = X.shape[1]
-        mysids = self.neuron.sids
-        # get all sids that belong to self:
-        mysids = np.intersect1d(sids, mysids, assume_unique=True)
-        nspikes = len(mysids)
-        if nsamples and nspikes > nsamples: # subsample spikes
-            step = nspikes // nsamples + 1 
-            print('neuron %d: update_comppos() sampling every %d spikes instead '
-                  'of all %d in last CA' % (self.id, step, nspikes))
-            mysids = mysids[::step]
-            nspikes = len(mysids) # update
-        sidis = sids.searchsorted(mysids)
-        subX = X[sidis].copy() # this copy is necessary for in-place operations
-        medians = np.median(subX, axis=0)
-        mean = X.mean(axis=0)
-        std = X.std(axis=0)
-        subX -= mean
-        subX /= std
-        normmedians = np.median(subX, axis=0)
-        # write component fields to dicts:
-        for compid in range(ncomp):
-            dim = 'c%d' % compid
-            self.pos[dim] = medians[compid]
-            self.normpos[dim] = normmedians[compid]
+        update_compposs([self], X, sids, nsamples=nsamples)
 
 
 class ClusterWindow(SpykeToolWindow):
@@ -17,6 +17,12 @@ import random
 import string
 from copy import copy
 import json
+import mmap
+import ctypes
+import zlib
+import tempfile
+import threading
+import traceback
 
 from PyQt4 import QtCore, QtGui
 from PyQt4.QtCore import Qt
@@ -78,11 +84,27 @@ assert KERNELSIZE % 2 == 0
 # a greater excess is needed than e.g. SurfStream because it's already analog filtered
 XSWIDEBANDPOINTS = 200
 
+# C library, for madvise() on memmapped arrays:
+LIBC = ctypes.CDLL(None) if sys.platform.startswith('linux') else None
+MADV_DONTNEED = 4 # Linux value
+
 MAXLONGLONG = 2**63-1
 MAXNBYTESTOFILE = 2**31 # max array size safe to call .tofile() on in Numpy 1.5.0 on Windows
 
 MAXNSPIKEPLOTS = 200
 MAXNROWSLISTSELECTION = 10000
+# max num bytes of packed spike ids and nids of cluster changes to keep in memory for
+# undo/redo. Beyond that, the oldest are spilled to a temporary file:
+CCHANGESMAXNBYTES = 128 * 2**20
+# max num contiguous runs of rows to update a list by, beyond which it's fully refreshed:
+MAXNLISTUPDATERUNS = 100
+# max num bytes of rows to gather, read or write at a time while updating .npy file rows:
+NPYJOURNALCHUNKNBYTES = 64 * 2**20
+# estimated cost of a seek while updating .npy file rows, in bytes of sequential IO. Gaps
+# between rows that would cost less than this to read and rewrite are bridged instead:
+NPYSEEKNBYTES = 64 * 2**10
+# how often to poll progress of background saving, ms:
+SAVEPOLLINTERVAL = 200
 
 CHANFIELDLEN = 256 # channel string field length at start of .resample file
 
@@ -757,11 +779,17 @@ class NSListModel(SListModel):
 
 class USListModel(SListModel):
     """Model for unsorted spike list view"""
+    def __init__(self, parent):
+        SListModel.__init__(self, parent)
+        self.nrows = None # row count while in the midst of updateRows()
+
     def rowCount(self, parent=None):
         try:
             nspikes = len(self.sortwin.sort.usids)
             # update uslist tooltip before returning:
             self.sortwin.uslist.setToolTip("Unsorted spike list\n%d spikes" % nspikes)
+            if self.nrows is not None:
+                return self.nrows
             return nspikes
         except AttributeError: # sort doesn't exist
             self.sortwin.uslist.setToolTip("Unsorted spike list")
@@ -776,6 +804,30 @@ class USListModel(SListModel):
                 spike = self.sortwin.sort.spikes[sid]
                 return self.spiketooltip(spike)
 
+    def updateRows(self, rmrows, addrows):
+        """Notify views of rows removed from and added to sort.usids, which has already
+        been updated. rmrows are sorted rows of the old usids, and addrows are sorted rows
+        of the new usids. Rows are removed and added in contiguous runs, so that views
+        only have to update those rows and keep their selections, unless there are too
+        many runs, in which case all rows are refreshed"""
+        rmruns, addruns = runs(rmrows), runs(addrows)
+        if len(rmruns) + len(addruns) > MAXNLISTUPDATERUNS:
+            self.updateAll()
+            return
+        root = QtCore.QModelIndex()
+        self.nrows = len(self.sortwin.sort.usids) + len(rmrows) - len(addrows) # old count
+        try:
+            for row0, row1 in rmruns[::-1]: # from the end, so earlier rows don't shift
+                self.beginRemoveRows(root, int(row0), int(row1)-1)
+                self.nrows -= row1 - row0
+                self.endRemoveRows()
+            for row0, row1 in addruns: # from the start, earlier runs are already in place
+                self.beginInsertRows(root, int(row0), int(row1)-1)
+                self.nrows += row1 - row0
+                self.endInsertRows()
+        finally:
+            self.nrows = None
+
 
 class NListDelegate(QtGui.QStyledItemDelegate):
     """Delegate for neuron list view, modifies appearance of items"""
@@ -904,9 +956,54 @@ class Stack(list):
         return list.__getitem__(self, key)
 
 
+class ClusterChangeStack(Stack):
+    """Stack of cluster changes for undo/redo. Keeps the packed spike ids and nids of its
+    cluster changes within a memory budget of maxnbytes, by spilling those of the oldest
+    ones to a temporary file"""
+    def __init__(self, maxnbytes=CCHANGESMAXNBYTES):
+        Stack.__init__(self)
+        self.maxnbytes = maxnbytes
+        self.spillfile = None
+
+    def append(self, cc):
+        Stack.append(self, cc)
+        nbytes = sum([ c.nbytes for c in self ])
+        for c in self: # oldest first
+            if nbytes <= self.maxnbytes:
+                break
+            if c.nbytes == 0: # already spilled
+                continue
+            if self.spillfile is None:
+                self.spillfile = tempfile.TemporaryFile(prefix='spyke_cchanges_')
+            nbytes -= c.nbytes
+            c.spill(self.spillfile)
+
+    def __delitem__(self, key):
+        """Delete cluster changes, and shrink the spill file down to the end of the last
+        spilled data of any that remain, or discard it if none remain spilled"""
+        Stack.__delitem__(self, key)
+        if self.spillfile is None:
+            return
+        end = max([ c.spillend for c in self ] or [0])
+        if end == 0:
+            self.spillfile.close()
+            self.spillfile = None
+        else:
+            self.spillfile.truncate(end)
+
+    def __delslice__(self, i, j):
+        """Py2 calls this instead of __delitem__ for simple slices, like del stack[:]"""
+        self.__delitem__(slice(i, j))
+
+
 class ClusterChange(object):
-    """Stores info for undoing/redoing a change to any set of clusters"""
+    """Stores info for undoing/redoing a change to any set of clusters. Spike ids are
+    delta encoded, and they and their old and new nids are compressed, which shrinks
+    runs of consecutive spike ids and of equal nids to almost nothing. Once spilled to
+    a file, they're read back in only when needed"""
     def __init__(self, sids, spikes, message):
+        self.packed = {} # packed arrays by name, as bytes, or (offset, size) in spillfile
+        self.spillfile = None
         self.sids = sids
         self.spikes = spikes
         self.message = message
@@ -914,8 +1011,68 @@ class ClusterChange(object):
     def __repr__(self):
         return self.message
 
+    def pack(self, name, a, delta=False):
+        a = np.asarray(a)
+        data = a
+        if delta and len(a) > 0:
+            data = np.concatenate([a[:1], np.diff(a)])
+        self.packed[name] = a.dtype.str, delta, zlib.compress(data.tobytes(), 1)
+
+    def unpack(self, name):
+        dtype, delta, data = self.packed[name]
+        if isinstance(data, tuple): # spilled
+            offset, size = data
+            self.spillfile.seek(offset)
+            data = self.spillfile.read(size)
+        a = np.frombuffer(zlib.decompress(data), dtype=dtype)
+        if delta:
+            a = a.cumsum(dtype=dtype)
+        return a
+
+    def spill(self, f):
+        """Move packed arrays to end of open file f, free up their memory"""
+        self.spillfile = f
+        for name, (dtype, delta, data) in self.packed.items():
+            if isinstance(data, tuple):
+                continue # already spilled
+            f.seek(0, os.SEEK_END)
+            self.packed[name] = dtype, delta, (f.tell(), len(data))
+            f.write(data)
+
+    def get_nbytes(self):
+        """Num bytes of packed arrays in memory"""
+        return sum([ len(data) for dtype, delta, data in self.packed.values()
+                     if not isinstance(data, tuple) ])
+
+    nbytes = property(get_nbytes)
+
+    def get_spillend(self):
+        """Offset in spillfile of end of spilled packed arrays, 0 if none are spilled"""
+        return max([ sum(data) for dtype, delta, data in self.packed.values()
+                     if isinstance(data, tuple) ] or [0])
+
+    spillend = property(get_spillend)
+
+    def get_sids(self):
+        return self.unpack('sids')
+
+    def set_sids(self, sids):
+        self.pack('sids', sids, delta=True)
+
+    sids = property(get_sids, set_sids)
+
+    def get_oldnids(self):
+        return self.unpack('oldnids')
+
+    oldnids = property(get_oldnids)
+
+    def get_newnids(self):
+        return self.unpack('newnids')
+
+    newnids = property(get_newnids)
+
     def save_old(self, oldclusters, oldnorder, oldgood):
-        self.oldnids = self.spikes['nid'][self.sids] # this seems to create a copy
+        self.pack('oldnids', self.spikes['nid'][self.sids])
         self.oldunids = [ c.id for c in oldclusters ]
         self.oldposs = [ c.pos.copy() for c in oldclusters ]
         self.oldnormposs = [ c.normpos.copy() for c in oldclusters ]
@@ -923,7 +1080,7 @@ class ClusterChange(object):
         self.oldgood = copy(oldgood)
 
     def save_new(self, newclusters, newnorder, newgood):
-        self.newnids = self.spikes['nid'][self.sids] # this seems to create a copy
+        self.pack('newnids', self.spikes['nid'][self.sids])
         self.newunids = [ c.id for c in newclusters ]
         self.newposs = [ c.pos.copy() for c in newclusters ]
         self.newnormposs = [ c.normpos.copy() for c in newclusters ]
@@ -1441,6 +1598,16 @@ def rmserror(a, b, axis=None):
     """Return root-mean-squared error between arrays a and b"""
     return rms(a - b, axis=axis)
 
+def runs(a):
+    """Return (start, stop) of each run of consecutive integers in sorted array a"""
+    a = np.asarray(a)
+    if len(a) == 0:
+        return []
+    breaks, = np.where(np.diff(a) != 1)
+    starts = np.concatenate([[a[0]], a[breaks+1]])
+    stops = np.concatenate([a[breaks] + 1, [a[-1] + 1]])
+    return list(zip(starts, stops))
+
 def printflush(*args, **kwargs):
     """Print args and flush to stdout immediately, so that
     python need not be started in unbuffered mode, or PYTHONUNBUFFERED env need
@@ -1698,6 +1865,19 @@ def negentropy(x, axis=0):
     #diffentropy = gaussianEntropy - negentropy + np.log(stdx)
     return negentropy
 
+def knn_interpolate(refpoints, refvalues, points, k=10):
+    """Interpolate values at points (npoints, ndims) by inverse distance weighted averaging
+    of refvalues (nrefpoints, nvaldims) of their k nearest neighbours in refpoints
+    (nrefpoints, ndims). A point that coincides with a refpoint gets its value"""
+    from scipy.spatial import cKDTree # delay as late as possible
+    k = min(k, len(refpoints))
+    dists, nis = cKDTree(refpoints).query(points, k=k)
+    if k == 1:
+        dists, nis = dists[:, None], nis[:, None]
+    w = 1 / np.maximum(dists, 1e-12)
+    w /= w.sum(axis=1)[:, None]
+    return (w[:, :, None] * refvalues[nis]).sum(axis=1)
+
 def DKL(p, q):
     """Kullback-Leibler divergence from true probability distribution p to arbitrary
     distribution q"""
@@ -1876,29 +2056,221 @@ def envelope_filt(x, sampfreq=None, f0=None, f1=BWLPF1, order=BWLPORDER, ftype='
                         btype='lowpass', ftype=ftype) # float64
     return x
 
-def updatenpyfilerows(fname, rows, arr):
+def writeatomic(path, write):
+    """Call write(f) to write a new file at path via a temporary file in the same
+    directory, which is only renamed to path once it's completely written and flushed to
+    disk. That way, a crash or error while writing leaves any existing file at path
+    intact"""
+    tmppath = path + '.tmp'
+    f = open(tmppath, 'wb')
+    try:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+    except:
+        f.close()
+        os.remove(tmppath)
+        raise
+    f.close()
+    if sys.platform == 'win32' and os.path.exists(path):
+        os.remove(path) # rename can't overwrite on win32
+    os.rename(tmppath, path)
+
+def readnpyheader(f):
+    """Read .npy format header from open file f, return shape, fortran_order and dtype of
+    array in file, leaving f at the start of the array data"""
+    major, minor = np.lib.format.read_magic(f)
+    assert (major == 1 and minor == 0)
+    return np.lib.format.read_array_header_1_0(f)
+
+def updatenpyfilerows(fname, rows, arr, progress=None):
     """Given a numpy formatted binary file (usually with .npy extension,
     but not necessarily), update 0-based rows (first dimension) of the
-    array stored in the file from arr. Works for arrays of any rank >= 1"""
+    array stored in the file from arr. Works for arrays of any rank >= 1.
+    Rows are merged into spans that are written all at once, see writenpyrows(), and
+    partialnpyupdate() estimates whether that beats rewriting the whole file. The new rows
+    are first written to a journal file, which is only removed once the update is
+    complete, so that an interrupted update can be finished by recovernpyfilerows().
+    progress, if given, is called with the number of bytes written after each write,
+    which adds up to twice the nbytes of rows: once for the journal, and once for the
+    file"""
     assert len(arr) >= 1 # has at least 1 row
     f = open(fname, 'r+b') # open in read+write binary mode
-    # get .npy format version:
-    major, minor = np.lib.format.read_magic(f)
-    assert (major == 1 and minor == 0)
     # read header to move file pointer to start of array in file
-    shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+    shape, fortran_order, dtype = readnpyheader(f)
     assert shape == arr.shape
     assert fortran_order == np.isfortran(arr)
     assert dtype == arr.dtype
     arroffset = f.tell()
     rowsize = arr[0].size * dtype.itemsize # nbytes per row
     # sort rows so that we move efficiently from start to end of file
-    rows = sorted(rows) # rows might be a set, list, tuple, or array, convert to list
-    # update rows in file
-    for row in rows:
-        f.seek(arroffset + row*rowsize) # seek from start of file, row is 0-based
-        f.write(arr[row])
+    rows = np.unique(np.fromiter(rows, dtype=np.int64)) # rows might be a set, list, etc.
+    if progress is None:
+        progress = lambda nbytes: None
+    # write rows to journal, a chunk at a time, straight from arr, in case arr is memmapped:
+    jname = fname + '.journal'
+    j = open(jname, 'wb')
+    np.save(j, rows)
+    chunksize = max(NPYJOURNALCHUNKNBYTES // rowsize, 1)
+    for i in range(0, len(rows), chunksize):
+        chunk = arr[rows[i:i+chunksize]]
+        chunk.tofile(j)
+        progress(chunk.nbytes)
+    j.flush()
+    os.fsync(j.fileno())
+    j.close()
+    # update rows in file from journal, so the file ends up exactly as journaled, even if
+    # rows in arr change in the meantime:
+    j = open(jname, 'rb')
+    np.load(j) # skip rows
+    writenpyrows(f, arroffset, rowsize, rows, j, progress)
+    j.close()
+    f.flush()
+    os.fsync(f.fileno())
     f.close()
+    os.remove(jname)
+
+def npyrowspans(rows, rowsize):
+    """Merge sorted unique rows of rowsize bytes each into spans of consecutive rows,
+    bridging any gaps between them that are cheaper to read and rewrite than to seek
+    over. Return start and stop row of each span, and index into rows of its first row"""
+    maxgap = NPYSEEKNBYTES // (2*rowsize)
+    breaks, = np.where(np.diff(rows) > maxgap + 1)
+    iis = np.concatenate([[0], breaks+1])
+    starts = rows[iis]
+    stops = np.concatenate([rows[breaks], rows[-1:]]) + 1
+    return starts, stops, iis
+
+def partialnpyupdate(nrows, rowsize, rows):
+    """Return whether updating only sorted unique rows of a numpy formatted file of
+    nrows rows of rowsize bytes each with updatenpyfilerows() is expected to be faster
+    than rewriting the whole file. Costs are in bytes of sequential IO: a partial update
+    writes and rereads its journal, and then costs a seek per span of rows, plus reading
+    the gaps it bridges and writing the whole span"""
+    if len(rows) == 0:
+        return True
+    starts, stops, iis = npyrowspans(rows, rowsize)
+    spannbytes = (stops - starts).sum() * rowsize
+    gapnbytes = spannbytes - len(rows)*rowsize
+    partialcost = (2*len(rows)*rowsize + len(starts)*NPYSEEKNBYTES + spannbytes +
+                   gapnbytes)
+    return partialcost < nrows*rowsize
+
+def writenpyrows(f, arroffset, rowsize, rows, j, progress):
+    """Write rows of rowsize bytes each, read in order from open journal file j, to array
+    starting at arroffset in open file f. Rows are merged into spans by npyrowspans(),
+    each of which is written with as few large writes as possible, after reading in any
+    gaps it bridges"""
+    if len(rows) == 0:
+        return
+    starts, stops, iis = npyrowspans(rows, rowsize)
+    iis = np.concatenate([iis, [len(rows)]])
+    chunknrows = max(NPYJOURNALCHUNKNBYTES // rowsize, 1)
+    for start, stop, i0, i1 in zip(starts, stops, iis[:-1], iis[1:]):
+        spanrows = rows[i0:i1]
+        for c0 in range(start, stop, chunknrows):
+            c1 = min(c0+chunknrows, stop)
+            k0, k1 = np.searchsorted(spanrows, [c0, c1])
+            nbytes = (k1 - k0) * rowsize
+            data = j.read(nbytes)
+            f.seek(arroffset + c0*rowsize) # seek from start of file, row is 0-based
+            if k1 - k0 < c1 - c0: # chunk bridges gaps, read them in and fill in rows
+                chunk = np.empty((c1-c0, rowsize), dtype=np.uint8)
+                f.readinto(chunk)
+                chunk[spanrows[k0:k1] - c0] = np.frombuffer(data, dtype=np.uint8).reshape(
+                                                  k1-k0, rowsize)
+                f.seek(arroffset + c0*rowsize)
+                data = chunk
+            f.write(data)
+            progress(nbytes)
+
+def recovernpyfilerows(fname):
+    """Finish any update of rows in numpy formatted binary file fname by
+    updatenpyfilerows() that was interrupted, from its journal file. A journal that was
+    itself interrupted is discarded, since the file is only ever updated once its journal
+    is complete. Return whether fname had to be recovered"""
+    jname = fname + '.journal'
+    if not os.path.exists(jname):
+        return False
+    f = open(fname, 'r+b')
+    shape, fortran_order, dtype = readnpyheader(f)
+    arroffset = f.tell()
+    rowsize = int(np.prod(shape[1:])) * dtype.itemsize
+    j = open(jname, 'rb')
+    try:
+        rows = np.load(j)
+        complete = j.tell() + len(rows)*rowsize == os.fstat(j.fileno()).st_size
+    except (ValueError, EOFError): # journal header itself incomplete
+        complete = False
+    if complete:
+        print('Recovering interrupted update of %d rows in %r' % (len(rows), fname))
+        writenpyrows(f, arroffset, rowsize, rows, j, lambda nbytes: None)
+        f.flush()
+        os.fsync(f.fileno())
+    else:
+        print('Discarding incomplete journal %r, %r is unchanged' % (jname, fname))
+    j.close()
+    f.close()
+    os.remove(jname)
+    return complete
+
+
+class SaveThread(threading.Thread):
+    """Run a sequence of save jobs on a background thread. Each job is a (msg, nbytes,
+    func) tuple, where func(progress) does the writing, and reports each nbytes it
+    writes by calling progress(nbytes). Any error is stored in self.error, and stops any
+    remaining jobs"""
+    def __init__(self, jobs):
+        threading.Thread.__init__(self, name='SaveThread')
+        self.jobs = jobs
+        self.nbytes = sum([ nbytes for msg, nbytes, func in jobs ])
+        self.nbytesdone = 0
+        self.msg = ''
+        self.error = None
+
+    def progress(self, nbytes):
+        self.nbytesdone += nbytes
+
+    def get_fraction(self):
+        """Fraction of total nbytes saved so far"""
+        if self.nbytes == 0:
+            return 1.0
+        return min(self.nbytesdone / self.nbytes, 1.0)
+
+    fraction = property(get_fraction)
+
+    def run(self):
+        t0 = time.time()
+        for msg, nbytes, func in self.jobs:
+            self.msg = msg
+            print(msg)
+            try:
+                func(self.progress)
+            except Exception as e:
+                traceback.print_exc()
+                self.error = e
+                print('ERROR: saving stopped at: %s' % msg)
+                return
+        print('Done saving, took %.3f sec' % (time.time()-t0))
+
+
+def releasememmaprows(arr, start, stop):
+    """Advise the OS that the pages backing rows start:stop of memmapped arr won't be
+    needed anytime soon, so they no longer count towards this process' resident memory,
+    and are reread from the file if accessed again. Only pages that lie entirely within
+    those rows are released. Any changes to those rows in a copy-on-write (mode 'c')
+    memmap are lost, so only release rows that are the same as in the file. Does
+    nothing on platforms other than Linux"""
+    if LIBC is None or stop <= start:
+        return
+    rownbytes = arr[0].nbytes
+    pagesize = mmap.PAGESIZE
+    addr0 = arr.ctypes.data + int(start) * rownbytes
+    addr1 = arr.ctypes.data + int(stop) * rownbytes
+    addr0 = -(-addr0 // pagesize) * pagesize # round up to page boundary
+    addr1 = addr1 // pagesize * pagesize # round down to page boundary
+    if addr1 > addr0:
+        LIBC.madvise(ctypes.c_void_p(addr0), ctypes.c_size_t(addr1 - addr0), MADV_DONTNEED)
 
 def unpickler_find_global(oldmod, oldcls):
     """Required for unpickling some .sort files and upgrading them to the next version.
@@ -17,6 +17,8 @@ from .stream import DATStream
 
 class File(object):
     """Open a .dat file"""
+    growing = False # is file still being written to? set by refresh()
+
     def __init__(self, fname, path=None):
         if path is None:
             path, fname = os.path.split(fname) # separate path from fname
@@ -57,6 +59,28 @@ class File(object):
             del self.datapacket._data
             self.f.close()
 
+    def refresh(self):
+        """Check for data appended to the file since it was last loaded, such as when it's
+        still being written to by the acquisition system, and reload the file to include
+        it. Only whole timepoints, with all chans written, are included. Return number of
+        new timepoints"""
+        nbytespertimepoint = 2 * self.fileheader.nchanstotal # 2 bytes per sample
+        dataoffset = self.datapacket.dataoffset
+        filesize = os.stat(self.join(self.fname))[6] # in bytes
+        nt = (filesize - dataoffset) // nbytespertimepoint
+        nnew = nt - self.nt
+        if nnew <= 0:
+            return 0
+        self.growing = True
+        # ignore any partially written timepoint at the end:
+        self.filesize = dataoffset + nt * nbytespertimepoint
+        self.close()
+        self.open() # calls load(), which uses self.filesize
+        self.t0i, self.nt = self.datapacket.t0i, self.datapacket.nt
+        self.t1i = self.t0i + self.nt - 1
+        self.t1 = self.t1i * self.fileheader.tres # us
+        return nnew
+
     def is_open(self):
         try:
             return not self.f.closed
@@ -93,7 +117,8 @@ class File(object):
         nt = int(nsamples / nchanstotal) # total number of timepoints in file
 
         datapacket = DataPacket(self.f, nchanstotal, nt, t0i)
-        assert self.f.tell() == self.filesize # make sure we're at EOF
+        # make sure we're at EOF, unless file has grown since self.filesize was measured:
+        assert self.f.tell() == self.filesize or self.growing and self.f.tell() > self.filesize
         self.datapacket = datapacket
         self.contiguous = True
 
@@ -5,8 +5,11 @@ from __future__ import print_function
 
 __authors__ = ['Martin Spacek', 'Reza Lotun']
 
+import os
 import sys
 import time
+import shutil
+import hashlib
 import logging
 import datetime
 import multiprocessing as mp
@@ -43,7 +46,7 @@ pyximport.install(build_in_temp=False, inplace=True)
 from . import util # .pyx file
 
 from . import stream
-from .core import eucd, dist, unsortedis, concatenate_destroy, intround
+from .core import eucd, unsortedis, concatenate_destroy, intround, XSWIDEBANDPOINTS
 
 #DMURANGE = 0, 500 # allowed time difference between peaks of modelled spike
 
@@ -57,6 +60,8 @@ info = logger.info
 
 DEBUG = False # print detection debug messages to log file? slows down detection
 MPMETHOD = 'detectionprocess' #'singleprocess', 'detectionprocess', 'pool'
+CHECKPOINT = True # save each finished block to disk, resume interrupted detection runs
+KEEPCHECKPOINT = False # keep checkpoint folder after a successful detection run?
 
 import errno
 def _eintr_retry_call(func, *args):
@@ -75,6 +80,11 @@ def callsearchblock(blockrange):
     detector = ps().detector
     return detector.searchblock(blockrange)
 
+def callnoisestats(blockranges):
+    """Accumulate noise stats over blockranges using current process' Detector"""
+    detector = ps().detector
+    return detector.get_noisestats(blockranges)
+
 def initializer(detector):
     """Save pickled copy of the Detector to the current process"""
     # not exactly sure why, but deepcopy is crucial to prevent artefactual spikes!
@@ -138,6 +148,122 @@ class RandomBlockRanges(object):
         return self
 
 
+class NoiseStats(object):
+    """Per-chan noise statistics of int16 data, accumulated one block of data at a time.
+    For the 'median' noisemethod, keep an exact histogram of absolute values, and for
+    'stdev', keep exact sums and sums of squares. Either way, the full sample of data
+    never needs to be held in memory, and stats from separate blocks can be merged"""
+    def __init__(self, nchans, noisemethod='median'):
+        self.nchans = nchans
+        self.noisemethod = noisemethod
+        self.n = 0 # num timepoints accumulated per chan
+        if noisemethod == 'median':
+            self.abshist = np.zeros((nchans, 2**15+1), dtype=np.int64)
+        elif noisemethod == 'stdev':
+            self.sum = np.zeros(nchans, dtype=np.int64)
+            self.sumsq = np.zeros(nchans, dtype=np.int64)
+        else:
+            raise ValueError('Unknown noise method %r' % noisemethod)
+
+    def update(self, data):
+        """Accumulate stats of a (nchans, nt) int16 block of data"""
+        assert data.dtype == np.int16
+        assert data.shape[0] == self.nchans
+        if self.noisemethod == 'median':
+            util.abshist_2Dshort(data, self.abshist)
+        else: # 'stdev'
+            self.sum += data.sum(axis=1, dtype=np.int64)
+            self.sumsq += np.einsum('ij,ij->i', data, data, dtype=np.int64)
+        self.n += data.shape[1]
+
+    def merge(self, other):
+        """Merge stats accumulated by other into self"""
+        assert other.nchans == self.nchans
+        assert other.noisemethod == self.noisemethod
+        if self.noisemethod == 'median':
+            self.abshist += other.abshist
+        else: # 'stdev'
+            self.sum += other.sum
+            self.sumsq += other.sumsq
+        self.n += other.n
+
+    def get_noise(self):
+        """Return per-chan noise in float AD units, same as Detector.get_noise() would
+        return for all the accumulated data at once"""
+        if self.noisemethod == 'median':
+            return util.median_abshist(self.abshist) / 0.6745 # see Quiroga2004
+        else: # 'stdev'
+            mean = self.sum / self.n
+            return np.sqrt(self.sumsq / self.n - mean**2)
+
+
+class DetectionCheckpoint(object):
+    """On-disk store of per-block detection results. Each finished block's spikes and
+    wavedata are saved to their own pair of .npy files, so that an interrupted detection
+    run can skip over finished blocks when rerun with identical settings. Files are written
+    under temporary names and then renamed, so a block is either entirely saved or absent"""
+    def __init__(self, path):
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def fname(self, blocki, kind):
+        return join(self.path, 'block%06d_%s.npy' % (blocki, kind))
+
+    def _save(self, fname, a):
+        tmpfname = fname + '.tmp'
+        with open(tmpfname, 'wb') as f:
+            np.save(f, a)
+        os.rename(tmpfname, fname) # atomic on POSIX
+
+    def isdone(self, blocki):
+        """Has block blocki been saved? spikes are saved last, so they mark completion"""
+        return os.path.exists(self.fname(blocki, 'spikes'))
+
+    def save(self, blocki, spikes, wavedata):
+        self._save(self.fname(blocki, 'wavedata'), wavedata)
+        self._save(self.fname(blocki, 'spikes'), spikes)
+
+    def load(self, blocki, mmap_mode=None):
+        spikes = np.load(self.fname(blocki, 'spikes'), mmap_mode=mmap_mode)
+        wavedata = np.load(self.fname(blocki, 'wavedata'), mmap_mode=mmap_mode)
+        return spikes, wavedata
+
+    def save_thresh(self, thresh, ppthresh):
+        self._save(join(self.path, 'thresh.npy'), np.asarray([thresh, ppthresh]))
+
+    def load_thresh(self):
+        """Return previously saved (thresh, ppthresh), or None"""
+        fname = join(self.path, 'thresh.npy')
+        if not os.path.exists(fname):
+            return None
+        thresh, ppthresh = np.load(fname)
+        return thresh, ppthresh
+
+    def assemble(self, blockis):
+        """Return spikes and wavedata of blockis concatenated, without ever holding more
+        than one block's worth of data in memory in addition to the output arrays"""
+        nspikes = 0
+        for blocki in blockis: # only read headers to get sizes
+            spikes, wavedata = self.load(blocki, mmap_mode='r')
+            nspikes += len(spikes)
+            dtype, wds = spikes.dtype, wavedata.shape
+        allspikes = np.empty(nspikes, dtype=dtype)
+        allwavedata = np.empty((nspikes,) + wds[1:], dtype=np.int16)
+        si = 0
+        for blocki in blockis:
+            spikes, wavedata = self.load(blocki, mmap_mode='r')
+            nblockspikes = len(spikes)
+            allspikes[si:si+nblockspikes] = spikes
+            allwavedata[si:si+nblockspikes] = wavedata
+            si += nblockspikes
+            del spikes, wavedata # release memmaps
+        return allspikes, allwavedata
+
+    def remove(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
 class DistanceMatrix(object):
     """Channel distance matrix, with rows in .data corresponding to
     .chans and .coords"""
@@ -231,13 +357,31 @@ class Detector(object):
 
         self.predetect(logpath=logpath)
 
+        # prevent out of memory errors due to copying of large stream.wavedata array
+        # when spawning multiple processes
+        if type(self.sort.stream) == stream.SimpleStream:
+            self.mpmethod = 'singleprocess'
+
         print('Detection trange: %r' % (self.trange,))
 
         t0 = time.time()
         # convert from numpy.int64 to normal int for inline C:
         self.dti = int(self.dt // sort.stream.tres)
-        self.thresh = self.get_thresh() # abs, in AD units, one per chan in self.chans
-        self.ppthresh = np.int16(np.round(self.thresh * self.ppthreshmult)) # abs, in AD units
+        checkpoint = None
+        if CHECKPOINT:
+            checkpoint = DetectionCheckpoint(self.get_checkpointpath(logpath))
+        # reuse thresholds of an interrupted run, ChanFixed thresholds come from random
+        # samples of the data and wouldn't otherwise be reproduced exactly:
+        threshes = checkpoint and checkpoint.load_thresh()
+        if threshes:
+            self.fixedthresh = sort.converter.uV2AD(self.fixedthreshuV) # AD units
+            self.thresh, self.ppthresh = threshes
+        else:
+            self.thresh = self.get_thresh() # abs, in AD units, one per chan in self.chans
+            # abs, in AD units:
+            self.ppthresh = np.int16(np.round(self.thresh * self.ppthreshmult))
+            if checkpoint:
+                checkpoint.save_thresh(self.thresh, self.ppthresh)
         AD2uV = sort.converter.AD2uV
         info('thresh calcs took %.3f sec' % (time.time()-t0))
         info('thresh   = %s' % AD2uV(self.thresh))
@@ -247,82 +391,229 @@ class Detector(object):
         bx = self.blockexcess
         blockranges = self.get_blockranges(bs, bx)
         nblocks = len(blockranges)
+        blockis = range(nblocks)
+        if checkpoint:
+            # only search blocks that weren't finished by a previous interrupted run:
+            blockis = [ blocki for blocki in blockis if not checkpoint.isdone(blocki) ]
+            if len(blockis) < nblocks:
+                print('Resuming detection from checkpoint %r, %d of %d blocks left'
+                      % (checkpoint.path, len(blockis), nblocks))
+        spikes = [None] * nblocks
+        wavedata = [None] * nblocks
+
+        def saveblock(blocki, blockspikes, blockwavedata):
+            """Save finished block to checkpoint on disk instead of keeping it in memory"""
+            if checkpoint:
+                checkpoint.save(blocki, blockspikes, blockwavedata)
+            else:
+                spikes[blocki] = blockspikes
+                wavedata[blocki] = blockwavedata
 
-        # prevent out of memory errors due to copying of large stream.wavedata array
-        # when spawning multiple processes
-        if type(self.sort.stream) == stream.SimpleStream:
-            self.mpmethod = 'singleprocess'
+        t0 = time.time()
+        self.searchblocks(blockranges, blockis, saveblock)
 
-        ncores = mp.cpu_count()
+        if checkpoint: # stream results back in from disk, one block at a time
+            spikes, wavedata = checkpoint.assemble(range(nblocks))
+            if not KEEPCHECKPOINT:
+                checkpoint.remove()
+        else:
+            spikes = concatenate_destroy(spikes)
+            # along sid axis, other dims are identical:
+            wavedata = concatenate_destroy(wavedata)
+        print('wavedata.shape:', wavedata.shape)
+        self.nspikes = len(spikes)
+        assert len(wavedata) == self.nspikes
+        # default -1 indicates no nid is set as of yet, reserve 0 for actual ids
+        spikes['nid'] = 0
+        info('\nfound %d spikes in total' % self.nspikes)
+        info('inside .detect() took %.3f sec' % (time.time()-t0))
+        uis = unsortedis(spikes['t'])
+        nuis = len(uis)
+        if nuis != 0:
+            print('WARNING: detected spike times of %d spikes are out of order for some '
+                  'reason, probably due to minor jitter in detection algorithm' % nuis)
+            print('IDs of spikes that are temporally out of order:')
+            print(uis)
+        # assign ids (should be almost entirely in temporal order):
+        spikes['id'] = np.arange(self.nspikes)
+        self.datetime = datetime.datetime.now()
+        return spikes, wavedata
+
+    def detect_incremental(self, spikes=None, wavedata=None, logpath=''):
+        """Search for spikes in a .dat or .nsx file that's still being written to. The first
+        call (with spikes=None) does the same setup as detect(), and searches all data
+        written so far, starting from self.trange[0]. Each subsequent call reloads the file
+        and only searches newly written data, appending the new spikes and wavedata to
+        those returned by the previous call, with ids carrying on in temporal order.
+
+        Only whole blocks are searched, and only once data beyond their end, for
+        blockexcess and the stream's own filtering excess, has also been written. The
+        rest is left for the next call. Blocks fall on the same grid as in detect(), so
+        results are the same as those of a single detect() run over the same data.
+        self.trange[1] marks the end of the data searched so far"""
+        sort = self.sort
+        if not isinstance(sort.stream, stream.DATStream): # includes NSXStream
+            raise TypeError("incremental detection requires a single .dat or .nsx stream")
         t0 = time.time()
+        sort.stream.refresh()
+        if spikes is None: # first call
+            self.mpmethod = MPMETHOD
+            self.predetect(logpath=logpath)
+            self.dti = int(self.dt // sort.stream.tres)
+            # ChanFixed noise is estimated from everything written so far, and thresholds
+            # are then kept fixed for all subsequent calls:
+            self.trange = self.trange[0], sort.stream.t1
+            self.thresh = self.get_thresh() # abs, in AD units, one per chan in self.chans
+            # abs, in AD units:
+            self.ppthresh = np.int16(np.round(self.thresh * self.ppthreshmult))
+            self.trange = self.trange[0], self.trange[0] # nothing searched yet
+            spikes = np.zeros(0, dtype=self.SPIKEDTYPE)
+            wavedata = np.zeros((0, self.maxnchansperspike, self.maxnt), dtype=np.int16)
+
+        bs = self.blocksize
+        bx = self.blockexcess
+        # excess raw data the stream needs beyond each block to avoid filtering edge effects:
+        xs = XSWIDEBANDPOINTS * sort.stream.rawtres # us
+        tstart = self.trange[1] # end of data searched so far
+        nblocks = max(int((sort.stream.t1 - bx - xs - tstart) // bs), 0)
+        if nblocks == 0:
+            return spikes, wavedata
+        es = tstart + np.arange(nblocks) * bs # left edges of data blocks
+        blockranges = np.column_stack([es-bx, es+bs+bx]) # time ranges for .searchblock()
+        # don't cut the excess at the very start of detection, like get_blockranges():
+        if tstart == self.trange[0]:
+            blockranges[0, 0] = tstart
+        # the excess is cut off the end of the last block since it's != self.trange[1]:
+        self.trange = self.trange[0], intround(tstart + nblocks*bs)
+        print('Incremental detection trange: (%r, %r)' % (tstart, self.trange[1]))
+
+        newspikes = [None] * nblocks
+        newwavedata = [None] * nblocks
+        def saveblock(blocki, blockspikes, blockwavedata):
+            newspikes[blocki] = blockspikes
+            newwavedata[blocki] = blockwavedata
+        self.nspikes = len(spikes)
+        self.searchblocks(blockranges, range(nblocks), saveblock)
+        newspikes = concatenate_destroy(newspikes)
+        newwavedata = concatenate_destroy(newwavedata)
+
+        nold, nnew = len(spikes), len(newspikes)
+        newspikes['nid'] = 0
+        newspikes['id'] = np.arange(nold, nold+nnew)
+        uis = unsortedis(newspikes['t'])
+        if len(uis) != 0:
+            print('WARNING: detected spike times of %d spikes are out of order' % len(uis))
+        spikes, wavedata = self.append_incremental(spikes, wavedata, newspikes,
+                                                   newwavedata)
+        self.nspikes = len(spikes)
+        info('found %d new spikes, %d in total' % (nnew, self.nspikes))
+        info('inside .detect_incremental() took %.3f sec' % (time.time()-t0))
+        self.datetime = datetime.datetime.now()
+        return spikes, wavedata
+
+    def append_incremental(self, spikes, wavedata, newspikes, newwavedata):
+        """Return spikes and wavedata with newspikes and newwavedata appended. The results
+        are views into over-allocated buffers owned by self, whose capacity doubles
+        whenever it runs out, so that appending usually costs time proportional only to
+        the new data. The arrays passed in are never resized or written to, so any other
+        references and views to them stay valid. Unless they're the ones returned by the
+        last call, the buffers are started over from copies of them"""
+        nold, n = len(spikes), len(spikes) + len(newspikes)
+        try:
+            spikesbuf, wavedatabuf = self.incspikesbuf, self.incwavedatabuf
+            last = (spikes.base is spikesbuf and wavedata.base is wavedatabuf and
+                    nold == self.incnspikes)
+        except AttributeError: # no buffers yet
+            last = False
+        if not last or n > len(spikesbuf): # start over, or grow into new buffers
+            capacity = max(n, 2 * (len(spikesbuf) if last else nold))
+            spikesbuf = np.empty(capacity, dtype=spikes.dtype)
+            wavedatabuf = np.empty((capacity,) + wavedata.shape[1:], dtype=wavedata.dtype)
+            spikesbuf[:nold] = spikes
+            wavedatabuf[:nold] = wavedata
+            self.incspikesbuf, self.incwavedatabuf = spikesbuf, wavedatabuf
+        spikesbuf[nold:n] = newspikes
+        wavedatabuf[nold:n] = newwavedata
+        self.incnspikes = n
+        return spikesbuf[:n], wavedatabuf[:n]
+
+    def __getstate__(self):
+        """Get object state for pickling"""
+        d = self.__dict__.copy()
+        # incremental detection buffers belong to the Sort, and are saved with it:
+        for attr in ['incspikesbuf', 'incwavedatabuf', 'incnspikes']:
+            d.pop(attr, None)
+        return d
+
+    def searchblocks(self, blockranges, blockis, saveblock):
+        """Search blockranges[blockis], according to self.mpmethod. Results of each block
+        are passed to saveblock(blocki, blockspikes, blockwavedata) as they come in"""
+        ncores = mp.cpu_count()
+        nsearch = len(blockis)
 
         # mp.Pool is slightly faster than my own DetectionProcess
-        if not DEBUG and self.mpmethod == 'pool': # use a pool of processes
-            nprocesses = min(ncores, nblocks)
+        if nsearch == 0:
+            pass
+        elif not DEBUG and self.mpmethod == 'pool': # use a pool of processes
+            nprocesses = min(ncores, nsearch)
             # send pickled copy of self to each process
             pool = mp.Pool(nprocesses, initializer, (self,))
-            results = pool.map(callsearchblock, blockranges, chunksize=1)
+            # results are (spikes, wavedata) tuples, consume them in order as they come in:
+            results = pool.imap(callsearchblock, blockranges[blockis], chunksize=1)
+            for blocki, (blockspikes, blockwavedata) in zip(blockis, results):
+                saveblock(blocki, blockspikes, blockwavedata)
             pool.close()
-            # results is a list of (spikes, wavedata) tuples, and needs to be unzipped
-            spikes, wavedata = zip(*results)
         elif not DEBUG and self.mpmethod == 'detectionprocess':
-            nprocesses = min(ncores, nblocks)
+            nprocesses = min(ncores, nsearch)
             dps = []
             q = mp.Queue()
-            spikes = [None] * nblocks
-            wavedata = [None] * nblocks
             for dpi in range(nprocesses):
                 dp = DetectionProcess()
                 # not exactly sure why, but deepcopy is crucial to prevent artefactual spikes!
                 dp.detector = deepcopy(self)
                 dp.detector.sort.stream.open()
-                dp.blockis = range(dpi, nblocks, nprocesses)
+                dp.blockis = blockis[dpi::nprocesses]
                 dp.blockranges = blockranges[dp.blockis]
                 dp.q = q
                 dp.start()
                 dps.append(dp)
-            for i in range(nblocks):
+            for i in range(nsearch):
                 #blocki, blockspikes, blockwavedata = dp.q.get() # defaults to block=True
                 blocki, blockspikes, blockwavedata = _eintr_retry_call(dp.q.get)
                 #print('got block %d results' % blocki)
-                spikes[blocki] = blockspikes
-                wavedata[blocki] = blockwavedata
+                saveblock(blocki, blockspikes, blockwavedata)
             for dp in dps:
                 dp.join()
                 #_eintr_retry_call(dp.join) # eintr isn't raised anymore it seems
         else: # use a single process, useful for debugging or for .tsf files
-            spikes = []
-            wavedata = []
-            for blockrange in blockranges:
-                blockspikes, blockwavedata = self.searchblock(blockrange)
-                spikes.append(blockspikes)
-                wavedata.append(blockwavedata)
-
-        spikes = concatenate_destroy(spikes)
-        wavedata = concatenate_destroy(wavedata) # along sid axis, other dims are identical
-        print('wavedata.shape:', wavedata.shape)
-        self.nspikes = len(spikes)
-        assert len(wavedata) == self.nspikes
-        # default -1 indicates no nid is set as of yet, reserve 0 for actual ids
-        spikes['nid'] = 0
-        info('\nfound %d spikes in total' % self.nspikes)
-        info('inside .detect() took %.3f sec' % (time.time()-t0))
-        uis = unsortedis(spikes['t'])
-        nuis = len(uis)
-        if nuis != 0:
-            print('WARNING: detected spike times of %d spikes are out of order for some '
-                  'reason, probably due to minor jitter in detection algorithm' % nuis)
-            print('IDs of spikes that are temporally out of order:')
-            print(uis)
-        # assign ids (should be almost entirely in temporal order):
-        spikes['id'] = np.arange(self.nspikes)
-        self.datetime = datetime.datetime.now()
-        return spikes, wavedata
+            for blocki in blockis:
+                blockspikes, blockwavedata = self.searchblock(blockranges[blocki])
+                saveblock(blocki, blockspikes, blockwavedata)
 
     def log(self, msg):
         """Write message to debugger log"""
         self.logger.debug(msg)
 
+    def get_checkpointkey(self):
+        """Return hex digest that identifies the results of a detection run, based on
+        detection parameters and a fingerprint of the stream being searched"""
+        sort, stream = self.sort, self.sort.stream
+        params = [self.chans.tolist(), list(self.trange), self.blocksize, self.blockexcess,
+                  self.threshmethod, self.noisemethod, self.noisemult, self.fixedthreshuV,
+                  self.ppthreshmult, self.dt, self.lockrx, self.inclr, self.fixednoisewin,
+                  self.extractparamsondetect, list(sort.tw)]
+        if self.extractparamsondetect:
+            params.append(sort.extractor.XYmethod)
+        fingerprint = [stream.fname, stream.t0, stream.t1, stream.sampfreq,
+                       stream.shcorrect, stream.filtmeth, stream.car,
+                       np.asarray(stream.chans).tolist()]
+        return hashlib.md5(repr(params + fingerprint).encode()).hexdigest()
+
+    def get_checkpointpath(self, logpath=''):
+        """Return path of checkpoint folder for the current detection run"""
+        return join(logpath, '.%s_detect_%s' % (os.path.basename(self.fname),
+                                                self.get_checkpointkey()[:16]))
+
     def calc_chans(self):
         """Calculate lockout and inclusion chan neighbourhoods, max number of chans to use,
         and define the spike record dtype"""
@@ -425,6 +716,10 @@ class Detector(object):
         spikes = np.zeros(npeaks, self.SPIKEDTYPE) # nspikes will always be <= npeaks
         ## TODO: test whether np.empty or np.zeros is faster overall in this case
         wavedata = np.empty((npeaks, self.maxnchansperspike, self.maxnt), dtype=np.int16)
+        # pack each [ti, chani] row in peakis into a single int64 key. peakis is sorted by
+        # ti and then by chani, so the keys come out strictly increasing, and membership
+        # of any [ti, chani] in the remaining peaks can be checked by binary search:
+        peakkeys = peakis[:, 0].astype(np.int64) * self.nchans + peakis[:, 1]
         # check each threshold-exceeding peak for validity:
         for peaki, (ti, chani) in enumerate(peakis):
             if DEBUG: self.log('*** trying thresh peak at t=%r chan=%d'
@@ -514,7 +809,10 @@ class Detector(object):
             # that was thresh exceeding caused the trigger, but this nearby [chani, ti] tuple
             # is according to the sharpness measure the best estimate of the spatiotemporal
             # origin of the trigger-causing event.
-            newpeak_coming_up = (peakis[peaki+1:] == [ti, chani]).prod(axis=1).any()
+            newpeakkey = ti * self.nchans + chani
+            newpeakii = peakkeys.searchsorted(newpeakkey)
+            newpeak_coming_up = (peaki < newpeakii < npeaks
+                                 and peakkeys[newpeakii] == newpeakkey)
             if chani != oldchani:
                 if newpeak_coming_up:
                     if DEBUG:
@@ -690,15 +988,9 @@ class Detector(object):
                 x0, y0 = s['x0'], s['y0']
                 # lockout radius for this spike:
                 lockr = min(self.lockrx*s['sx'], self.inclr) # in um
-                # test y coords of inclchans in y array, ylockchaniis can be used to index
-                # into x, y and inclchans:
-                ylockchaniis, = np.where(np.abs(y - y0) <= lockr) # convert bool arr to int
-                # test Euclid distance from x0, y0 for each ylockchani:
-                lockchaniis = ylockchaniis.copy()
-                for ylockchanii in ylockchaniis:
-                    if dist((x[ylockchanii], y[ylockchanii]), (x0, y0)) > lockr:
-                        # Euclidean distance is too great, remove ylockchanii from lockchaniis:
-                        lockchaniis = lockchaniis[lockchaniis != ylockchanii]
+                # test Euclid distance from x0, y0 of all inclchans at once, lockchaniis can
+                # be used to index into x, y and inclchans:
+                lockchaniis, = np.where(np.sqrt((x-x0)**2 + (y-y0)**2) <= lockr)
                 lockchans = inclchans[lockchaniis]
                 lockchanis = inclchanis[lockchaniis]
                 nlockchans = len(lockchans)
@@ -783,17 +1075,25 @@ class Detector(object):
                 nblocks = intround(self.fixednoisewin / self.blocksize)
                 blockranges = RandomBlockRanges(self.trange, bs=self.blocksize, bx=0,
                                                 maxntranges=nblocks, replacement=False)
-            # preallocating memory doesn't seem to help here, all the time is in loading
-            # from stream:
-            data = []
-            for blockrange in blockranges:
-                wave = self.sort.stream(blockrange[0], blockrange[1], self.chans)
-                data.append(wave.data)
-            data = np.concatenate(data, axis=1) # int16 AD units
+            # all the time is in loading from stream, so load blocks in parallel, and
+            # accumulate noise stats block by block instead of concatenating all the data:
+            blockranges = list(blockranges)
+            nblocks = len(blockranges)
+            if DEBUG or self.mpmethod == 'singleprocess' or nblocks == 1:
+                noisestats = self.get_noisestats(blockranges)
+            else:
+                nprocesses = min(mp.cpu_count(), nblocks)
+                # one list of blockranges per process, minimizes noise stats passed back:
+                blockrangess = [ blockranges[i::nprocesses] for i in range(nprocesses) ]
+                # send pickled copy of self to each process
+                pool = mp.Pool(nprocesses, initializer, (self,))
+                results = pool.map(callnoisestats, blockrangess, chunksize=1)
+                pool.close()
+                noisestats = results[0]
+                for result in results[1:]:
+                    noisestats.merge(result)
             info('loading data to calc noise took %.3f sec' % (time.time()-tload))
-            tnoise = time.time()
-            noise = self.get_noise(data) # float AD units
-            info('get_noise took %.3f sec' % (time.time()-tnoise))
+            noise = noisestats.get_noise() # float AD units
             thresh = noise * self.noisemult # float AD units
             thresh = np.int16(np.round(thresh)) # int16 AD units
             # clip so that all thresholds are at least fixedthresh
@@ -806,6 +1106,15 @@ class Detector(object):
             raise ValueError
         return thresh
 
+    def get_noisestats(self, blockranges):
+        """Return NoiseStats accumulated over self.chans for all blockranges, loading one
+        block at a time"""
+        noisestats = NoiseStats(self.nchans, self.noisemethod)
+        for blockrange in blockranges:
+            wave = self.sort.stream(blockrange[0], blockrange[1], self.chans)
+            noisestats.update(wave.data) # int16 AD units
+        return noisestats
+
     def get_noise(self, data):
         """Calculates noise over last dim in data (time), using .noisemethod"""
         #print('calculating noise')
@@ -814,13 +1123,15 @@ class Detector(object):
         if self.noisemethod == 'median':
             #noise = pool.map(self.get_median, data) # multithreads over rows in data
             #noise = np.median(np.abs(data), axis=-1) / 0.6745 # see Quiroga2004
-            # np.abs does a copy, so modifying the result in-place is safe:
-            noise = util.median_inplace_2Dshort(np.abs(data)) / 0.6745 # see Quiroga2004
+            #noise = util.median_inplace_2Dshort(np.abs(data)) / 0.6745 # see Quiroga2004
             #noise = np.mean(np.abs(data), axis=-1) / 0.6745 / 1.2
             #noise = util.mean_2Dshort(np.abs(data)) / 0.6745 # see Quiroga2004
+            # multithreaded, exact histogram-based median, doesn't copy or modify data:
+            noise = util.median_abs_2Dshort(data) / 0.6745 # see Quiroga2004
         elif self.noisemethod == 'stdev':
             #noise = pool.map(self.get_stdev, data) # multithreads over rows in data
-            noise = np.std(data, axis=-1)
+            #noise = np.std(data, axis=-1)
+            noise = util.stdev_2Dshort(data) # multithreaded, doesn't copy data
         else:
             raise ValueError
         #pool.terminate() # pool.close() doesn't allow Python to exit when spyke is closed
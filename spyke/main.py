@@ -29,6 +29,7 @@ try:
 except ImportError:
     import pickle
 import random
+import uuid
 from copy import copy
 from struct import unpack
 from collections import OrderedDict as odict
@@ -75,11 +76,12 @@ from .core import (toiter, tocontig, intround, intceil, printflush, lstrip, matl
                    qvar2list, qvar2str)
 from . import dat, nsx, surf, stream, probes
 from .stream import SimpleStream, MultiStream
-from .sort import Sort, SortWindow, NSLISTWIDTH, MEANWAVEMAXSAMPLES, NPCSPERCHAN
+from .sort import (Sort, SortWindow, XCache, SpikeTable, NSLISTWIDTH, MEANWAVEMAXSAMPLES,
+                   NPCSPERCHAN)
 from .plot import SpikePanel, ChartPanel, LFPPanel
 from .detect import Detector, calc_SPIKEDTYPE, DEBUG
 from .extract import Extractor
-from .cluster import Cluster, ClusterWindow
+from .cluster import Cluster, ClusterWindow, update_poss
 from .__version__ import __version__
 
 # spike window temporal window (us)
@@ -127,9 +129,13 @@ CLUSTERWINDOWHEIGHT = 700
 MAXRECENTFILES = 20 # anything > 10 will mess up keyboard accelerators, but who cares
 WINDOWUPDATEORDER = ['Spike', 'LFP', 'Chart'] # chart goes last cuz it's slowest
 
-# if updating at least this many selected spikes in .wave file, update them all
-# instead for speed:
-NDIRTYSIDSTHRESH = 200000
+# memmap .wave files instead of loading them into memory, for sorts too big to fit.
+# None: load into memory, 'c': memmap copy-on-write, 'r': memmap read-only, which doesn't
+# allow any operations that modify waveforms:
+WAVEMMAPMODE = None
+# save .spike files as a directory of one .npy file per spikes field, which are loaded only
+# as needed, and resaved only when changed:
+COLUMNARSPIKEFILES = False
 
 
 class SpykeWindow(QtGui.QMainWindow):
@@ -160,10 +166,14 @@ class SpykeWindow(QtGui.QMainWindow):
         self.hpstream = None
         self.lpstream = None
 
-        self.cchanges = core.Stack() # cluster change stack, for undo/redo
+        self.cchanges = core.ClusterChangeStack() # cluster change stack, for undo/redo
         self.cci = -1 # pointer to cluster change for the next undo (add 1 for next redo)
 
         self.dirtysids = set() # sids whose waveforms in .wave file are out of date
+        self.savethread = None # background thread of last save, until it's finished
+        self.savedone = [] # funcs to call with any error once last save is finished
+        self.savetimer = QtCore.QTimer(self) # polls progress of last save
+        self.savetimer.timeout.connect(self.on_savetimer_timeout)
         
         # disable most widgets until a stream or a sort is opened:
         self.EnableStreamWidgets(False)
@@ -805,7 +815,7 @@ class SpykeWindow(QtGui.QMainWindow):
         sids = np.arange(s.nspikes)
         s.reload_spikes(sids)
         # add sids to the set of dirtysids to be resaved to .wave file:
-        self.dirtysids.update(sids)
+        self.update_dirtysids(sids)
         s.__version__ = '0.4' # update
         print('Done updating sort from version 0.3 to 0.4')
         return float(s.__version__)
@@ -856,6 +866,7 @@ class SpykeWindow(QtGui.QMainWindow):
         from numpy.lib import recfunctions as rfn
         newspikes = rfn.recursive_fill_fields(s.spikes, newspikes) # copy from old to new
         s.spikes = newspikes # overwrite
+        s.invalidate_paramstats()
 
         # in cluster.pos and .normpos, remove 's0' and 's1', and rename 'dphase' to 'dt':
         for c in s.clusters.values():
@@ -960,6 +971,7 @@ class SpykeWindow(QtGui.QMainWindow):
         newspikes['nlockchans'] = oldspikes['nchans']
         newspikes['lockchans'] = oldspikes['chans']
         s.spikes = newspikes # overwrite
+        s.invalidate_paramstats()
 
         from pprint import pprint
         print('old dtype:')
@@ -1353,6 +1365,7 @@ class SpykeWindow(QtGui.QMainWindow):
         #cProfile.runctx('self.sort.extractor.extract_all_XY()', globals(), locals())
 
         self.sort.extractor.extract_all_XY() # adds extracted XY params to sort.spikes
+        self.sort.invalidate_paramstats()
         self.windows['Sort'].uslist.updateAll() # update any columns showing param values
         self.EnableSpikeWidgets(True) # enable cluster_pane
 
@@ -1651,39 +1664,52 @@ class SpykeWindow(QtGui.QMainWindow):
         cc = ClusterChange(sids, spikes, message)
         cc.save_old(oldclusters, s.norder, s.good)
 
+        # group sids by nid in a single pass, stably, so each group's sids keep their order:
+        order = nids.argsort(kind='mergesort')
+        unids, starts, counts = np.unique(nids[order], return_index=True,
+                                          return_counts=True)
+
         # start insertion indices of new clusters from first selected cluster, if any
-        unids = np.unique(nids)
         nnids = len(unids)
         insertis = [None] * nnids
         if len(oldclusters) > 0:
             startinserti = s.norder.index(oldclusters[0].id)
             insertis = range(startinserti, startinserti+nnids)
 
+        # save sids and waveform sums of old neurons, new neurons derive theirs from these
+        # instead of rebuilding them from scratch:
+        donors = dict([ (c.id, (c.neuron.sids, c.neuron.wavesums)) for c in oldclusters ])
+
         # delete old clusters
         self.DelClusters(oldclusters, update=False)
 
         # apply new clusters
         newclusters = []
-        for nid, inserti in zip(unids, insertis):
-            ii, = np.where(nids == nid)
+        oldnids = cc.oldnids # unpack only once
+        for nid, inserti, start, count in zip(unids, insertis, starts, counts):
+            ii = order[start:start+count]
             nsids = sids[ii] # sids belonging to this nid
             if nid != 0:
                 nid = None # auto generate a new nid
             cluster = self.CreateCluster(update=False, id=nid, inserti=inserti)
             newclusters.append(cluster)
             neuron = cluster.neuron
-            sw.MoveSpikes2Neuron(nsids, neuron, update=False)
+            neuron.add_sids(nsids) # also triggers template mean update
+            neuron.inherit_wavesums(donors, oldnids[ii])
             if len(nsids) == 0:
                 raise RuntimeError('WARNING: neuron %d has no spikes for some reason'
                                    % neuron.id)
-            cluster.update_pos()
+        # bind new neuron ids of all sids in spikes struct array at once:
+        spikes['nid'][sids[order]] = np.repeat([ c.id for c in newclusters ], counts)
+        update_poss(newclusters)
 
         # save more undo/redo stuff
         cc.save_new(newclusters, s.norder, s.good)
         self.AddClusterChangeToStack(cc)
 
-        # now do some final updates
-        self.UpdateClustersGUI()
+        # now do some final updates, old clusters' spikes may not all be in sids:
+        self.UpdateClustersGUI(np.concatenate([sids] + [ oldsids for oldsids, wavesums
+                                                         in donors.values() ]))
         if not np.all(sids == spikes['id']): # if clustering only some spikes,
             self.SelectClusters(newclusters) # select all newly created cluster(s)
         if np.all(sids == cw.glWidget.sids):
@@ -1768,7 +1794,7 @@ class SpykeWindow(QtGui.QMainWindow):
         sids = self.GetAllSpikes() # only selected spikes
         tis = sw.tis # waveform time indices to include, centered on spike
         selchans = np.asarray(self.get_selchans(sids))
-        chans = self.sort.get_common_chans(sids, selchans)[0]
+        chans = self.sort.get_common_chans(sids, selchans)
         npcsperchan = self.sort.npcsperchan
         norm = self.ui.normButton.isChecked()
         return kind, sids, tis, chans, npcsperchan, norm
@@ -1841,8 +1867,7 @@ class SpykeWindow(QtGui.QMainWindow):
         gauss /= (gauss * binwidth).sum() # normalize to unit area
         djs = DJS(dhist, gauss)
         mplw = self.OpenWindow('MPL')
-        a = mplw.ax
-        a.clear()
+        a = mplw.reset()[0, 0] # clear any grid of axes left over from other plots
         mplw.setWindowTitle('Density Histogram')
         a.bar(ledges, dhist, width=binwidth)
         a.plot(ris, gauss, '-') # plot Gaussian on top of density histogram
@@ -1869,29 +1894,13 @@ class SpykeWindow(QtGui.QMainWindow):
     def on_calcMatchErrorsButton_clicked(self):
         """Match pane calc button click. Calculate rmserror between all clusters and
         all unsorted spikes. Also calculate which cluster each unsorted spike matches best"""
-        spikes = self.sort.spikes
-        wavedata = self.sort.wavedata
         cids = np.sort(self.sort.clusters.keys())
         sids = self.sort.usids.copy()
         ncids, nsids = len(cids), len(sids)
         print('Calculating rmserror between all %d clusters and all %d unsorted spikes'
               % (ncids, nsids))
-        errs = np.empty((ncids, nsids), dtype=np.float32)
-        errs.fill(np.inf) # TODO: replace with sparse matrix with np.inf as default value
-        for cidi, cid in enumerate(cids):
-            neuron = self.sort.neurons[cid]
-            for sidi, sid in enumerate(sids):
-                chan = spikes['chan'][sid]
-                nchans = spikes['nchans'][sid]
-                chans = spikes['chans'][sid][:nchans]
-                # TODO: this is a bit wasteful if no chans are in common:
-                sdata = wavedata[sid, :nchans]
-                try:
-                    ndata, sdata = neuron.getCommonWaveData(chan, chans, sdata)
-                except ValueError: # not comparable
-                    continue
-                errs[cidi, sidi] = core.rms(ndata - sdata)
-        errs = self.sort.converter.AD2uV(errs) # convert from AD units to uV, np.infs are OK
+        errs = self.sort.get_match_errors(cids, sids) # sparse, only comparable pairs
+        errs.data = self.sort.converter.AD2uV(errs.data) # convert from AD units to uV
         self.match = Match(cids, sids, errs)
         print('Done calculating rmserror between all %d clusters and all %d unsorted spikes'
               % (ncids, nsids))
@@ -1945,63 +1954,42 @@ class SpykeWindow(QtGui.QMainWindow):
     @QtCore.pyqtSlot()
     def on_plotXcorrsButton_clicked(self):
         """Plot all cross/auto correlograms for all selected neurons, and display
-        them in an upper or lower triangle configuration"""
-        ## TODO: for now, just plot a single cross/auto correlogram
+        them in a lower triangle configuration"""
         clusters = self.GetClusters()
-        xsids = clusters[0].neuron.sids
-        if len(clusters) == 1:
-            autocorr = True
-            ysids = xsids # x and y are identical
-        elif len(clusters) == 2:
-            autocorr = False
-            ysids = clusters[1].neuron.sids
-        else:
-            raise NotImplementedError("can't deal with more than one xcorr for now")
-        xspikets = self.sort.spikes['t'][xsids]
-        yspikets = self.sort.spikes['t'][ysids]
-
-        ## TODO: spikes['t'][sids] is very different from spikes[sids]['t'] !
-        ## The first is C contig, the second is not! The first probably makes a copy,
-        ## while the second does not. First is much much faster for array ops, while
-        ## the second conserves memory, and avoids needless copying, which might be faster
-        ## if no array ops are involved. Should check all the code that pulls stuff out of
-        ## the spikes recarray, and choose the best one more carefully!
-        
+        if len(clusters) == 0:
+            return
+        nids = [ cluster.id for cluster in clusters ]
+        nn = len(nids)
         trange = self.ui.xcorrsRangeSpinBox.value() * 1000 # convert to us
         trange = max(1000, trange) # enforce min trange, in us
         trange = np.array([-trange, trange]) # convert to a +/- array, in us
-        
-        dts = util.xcorr(xspikets, yspikets, trange=trange) # in us
-        if autocorr:
-            dts = dts[dts != 0] # remove 0s for autocorr
-        #print(dts)
-
-        dts = dts / 1000 # in ms, converts to float64 array
-        trange = trange / 1000 # in ms, converts to float64 array
-        nbins = intround(np.sqrt(len(dts))) # good heuristic
-        nbins = max(20, nbins) # enforce min nbins
-        nbins = min(100, nbins) # enforce max nbins
-        t = np.linspace(start=trange[0], stop=trange[1], num=nbins, endpoint=True)
-        n = np.histogram(dts, bins=t, density=False)[0]
+        # (nn, nn, nbins) counts of spike times of nids[j] relative to nids[i]:
+        counts, t = self.sort.get_xcorrs(nids, trange)
+        t = t / 1000 # bin edges in ms
         binwidth = t[1] - t[0] # all should be equal width
 
         # plot:
         mplw = self.OpenWindow('MPL')
-        a = mplw.ax
-        a.clear()
-        # omit last right edge in t:
-        a.bar(t[:-1], height=n, width=binwidth, color='k', edgecolor='k')
-        a.set_xlim(t[0], t[-1])
-        a.set_xlabel('ISI (ms)')
-        a.set_ylabel('count')
-        if autocorr:
-            windowtitle = "n%d autocorr" % clusters[0].id
+        axes = mplw.reset(nn, nn, tril=True)
+        for i in range(nn):
+            for j in range(i+1):
+                a = axes[i, j]
+                # omit last right edge in t:
+                a.bar(t[:-1], height=counts[i, j], width=binwidth, color='k', edgecolor='k')
+                a.set_xlim(t[0], t[-1])
+                if i == nn-1:
+                    a.set_xlabel('ISI (ms)' if nn == 1 else 'n%d' % nids[j])
+                if j == 0:
+                    a.set_ylabel('count' if nn == 1 else 'n%d' % nids[i])
+        if nn == 1:
+            windowtitle = "n%d autocorr" % nids[0]
         else:
-            windowtitle = "n%d xcorr with n%d" % (clusters[0].id, clusters[1].id)
+            windowtitle = "xcorrs of %s" % ', '.join([ 'n%d' % nid for nid in nids ])
         mplw.setWindowTitle(windowtitle)
         title = windowtitle + ', binwidth: %.2f ms' % binwidth
         print(title)
-        a.set_title(title)
+        if nn == 1:
+            mplw.ax.set_title(title)
         #a.set_ylabel('ISI rate (Hz)')
         mplw.f.tight_layout(pad=0.3) # crop figure to contents
         mplw.figurecanvas.draw()
@@ -2011,8 +1999,8 @@ class SpykeWindow(QtGui.QMainWindow):
         """If only one cluster is selected, split off any duplicate spikes within that
         cluster, according to the ISI threshold. If multiple clusters or no clusters are
         selected, remove any duplicate spikes within selected clusters or all clusters,
-        respectively, according to the same single ISI threshold. As implemented, the latter
-        is not undoable"""
+        respectively, according to the same single ISI threshold. Either way, the change
+        can be undone"""
         clusters = self.GetClusters()
         minISI = self.ui.minISISpinBox.value()
         spikes = self.sort.spikes
@@ -2020,74 +2008,44 @@ class SpykeWindow(QtGui.QMainWindow):
         if len(nids) == 0: # if no neurons selected, clean all neurons
             nids = sorted(self.sort.neurons)
 
-        rmsidss = {} # dict of lists of sids to split off or remove, indexed by nid
+        # For each pair of duplicate spikes, keep whichever has the most channel overlap
+        # with neuron template. If they have same amount of overlap, keep the first one.
+        # Dict of arrays of sids to split off or remove, indexed by nid:
+        rmsidss = self.sort.get_duplicate_sids(nids, minISI)
         print('Duplicate spikes:')
-        for nid in nids:
-            # For each pair of duplicate spikes, keep whichever has the most channel overlap
-            # with neuron template. If they have same amount of overlap, keep the first one
-            neuron = self.sort.neurons[nid]
-            rmsids = [] # list of sids to remove for this neuron
-            # pick out the first sid of each pair of duplicate sids, if any:
-            sidis = np.where(np.diff(spikes['t'][neuron.sids]) <= minISI)[0]
-            if len(sidis) == 0:
-                continue # skip to next nid
-            #x0, y0 = neuron.cluster.pos['x0'], neuron.cluster.pos['y0']
-            for sidi in sidis:
-                sid0 = neuron.sids[sidi] # 1st spike in each pair
-                sid1 = neuron.sids[sidi+1] # 2nd spike in each pair
-                nchans0 = spikes['nchans'][sid0]
-                nchans1 = spikes['nchans'][sid1]
-                chans0 = spikes['chans'][sid0][:nchans0]
-                chans1 = spikes['chans'][sid1][:nchans1]
-                ncommon0 = len(np.intersect1d(neuron.chans, chans0))
-                ncommon1 = len(np.intersect1d(neuron.chans, chans1))
-                if ncommon0 >= ncommon1:
-                    # sid0 has more template chan overlap, or both are equal, keep sid0
-                    rmsid = sid1
-                else:
-                    # sid1 has more template chan overlap, keep it
-                    rmsid = sid0
-                """
-                # code for choosing the one closest to template mean position, not as robust:
-                d02 = (spikes['x0'][sid] - x0)**2 + (spikes['y0'][sid] - y0)**2
-                d12 = (spikes['x0'][sid+1] - x0)**2 + (spikes['y0'][sid+1] - y0)**2
-                if d02 <= d12:
-                    rmsid = sid + 1
-                else:
-                    rmsid = sid
-                """
-                rmsids.append(rmsid)
-            print('neuron %d: %r' % (nid, rmsids))
-            rmsidss[nid] = rmsids
+        for nid, rmsids in rmsidss.items():
+            print('neuron %d: %r' % (nid, rmsids.tolist()))
         nrm = sum([ len(rmsids) for rmsids in rmsidss.values() ])
         print('Found %d duplicate spikes' % nrm)
         if nrm == 0:
             return
         sw = self.windows['Sort']
         if len(nids) == 1: # split duplicate spikes from single cluster into cluster 0
-            sidis = neuron.sids.searchsorted(rmsids)
+            neuron = self.sort.neurons[nids[0]]
+            sidis = neuron.sids.searchsorted(rmsidss[nids[0]])
             sw.nslist.selectRows(sidis) # select spikes to split off from single cluster
             self.SplitSpikes(delete=True) # split them off into cluster 0 (undoable)
             return
-        # otherwise, remove duplicate spikes from multiple clusters:
-        val = QtGui.QMessageBox.question(self, "Remove %d duplicate spikes" % nrm,
-              "Are you sure? This will clear the undo/redo stack, and is not undoable.",
-              QtGui.QMessageBox.Yes, QtGui.QMessageBox.No)
-        if val == QtGui.QMessageBox.No:
-            return
+        # otherwise, remove duplicate spikes from multiple clusters, in place, keeping
+        # their nids. Save all spikes of affected clusters for undo/redo:
+        clusters = [ self.sort.clusters[nid] for nid in rmsidss ]
+        allrmsids = np.concatenate(list(rmsidss.values()))
+        sids = np.concatenate([ cluster.neuron.sids for cluster in clusters ])
+        sids.sort()
+        message = 'remove %d duplicate spikes from clusters %r' % (nrm, list(rmsidss))
+        cc = ClusterChange(sids, spikes, message)
+        cc.save_old(clusters, self.sort.norder, self.sort.good)
         # do the actual removal:
         for nid, rmsids in rmsidss.items():
             neuron = self.sort.neurons[nid]
-            neuron.sids = np.setdiff1d(neuron.sids, rmsids) # remove from source neuron
+            neuron.remove_sids(rmsids) # remove from source neuron, update template sums
             spikes['nid'][rmsids] = 0 # set to junk in spikes struct array
-            neuron.wave.data = None # trigger template mean update
             if neuron in sw.nslist.neurons:
                 sw.nslist.neurons = sw.nslist.neurons # trigger nslist refresh
         # update usids and uslist:
-        self.sort.update_usids()
-        sw.uslist.updateAll()
-        # cluster changes in stack no longer applicable, reset cchanges:
-        del self.cchanges[:]
+        sw.update_usids(allrmsids)
+        cc.save_new(clusters, self.sort.norder, self.sort.good)
+        self.AddClusterChangeToStack(cc)
         print('Removed %d duplicate spikes' % nrm)
 
     def GetSortedSpikes(self):
@@ -2257,20 +2215,21 @@ class SpykeWindow(QtGui.QMainWindow):
         sw = self.windows['Sort']
         cw = self.windows['Cluster']
         self.ColourPoints(clusters, setnid=0) # decolour before clusters lose their sids
+        sids = [ cluster.neuron.sids for cluster in clusters ]
         for cluster in clusters:
             sw.RemoveNeuron(cluster.neuron, update=update)
         cw.glWidget.updateGL()
         if update:
-            self.UpdateClustersGUI()
+            self.UpdateClustersGUI(np.concatenate(sids))
 
-    def UpdateClustersGUI(self):
+    def UpdateClustersGUI(self, sids=None):
         """Update lots of stuff after modifying clusters,
-        here as a separate method for speed, only call when really needed"""
-        s = self.sort
+        here as a separate method for speed, only call when really needed.
+        If given, sids are the only spikes that might have moved into or out of
+        the unsorted list, which is then updated incrementally"""
         sw = self.windows['Sort']
         sw.nlist.updateAll()
-        s.update_usids()
-        sw.uslist.updateAll()
+        sw.update_usids(sids)
 
     def ColourPoints(self, clusters, setnid=None):
         """Colour the points that fall within each cluster (as specified
@@ -2338,6 +2297,10 @@ class SpykeWindow(QtGui.QMainWindow):
 
         # delete newly added clusters
         newclusters = [ s.clusters[nid] for nid in newunids ]
+        # save sids and waveform sums of new neurons, restored neurons derive theirs from
+        # these instead of rebuilding them from scratch:
+        donors = dict([ (c.id, (c.neuron.sids, c.neuron.wavesums)) for c in newclusters ])
+        donornids = spikes['nid'][sids]
         self.SelectClusters(newclusters, on=False) # deselect new clusters
         # temporarily deselect any bystander clusters to get around fact that
         # selections are row-based in Qt, not value-based, which means selection
@@ -2359,6 +2322,7 @@ class SpykeWindow(QtGui.QMainWindow):
             oldclusters.append(cluster)
             neuron = cluster.neuron
             sw.MoveSpikes2Neuron(nsids, neuron, update=False)
+            neuron.inherit_wavesums(donors, donornids[oldnids == nid])
             cluster.pos = pos
             cluster.normpos = normpos
         # restore norder and good
@@ -2366,7 +2330,7 @@ class SpykeWindow(QtGui.QMainWindow):
         s.good = copy(good)
 
         # now do some final updates
-        self.UpdateClustersGUI()
+        self.UpdateClustersGUI(sids)
         self.ColourPoints(oldclusters)
         # select newly recreated oldclusters
         self.SelectClusters(oldclusters)
@@ -3158,8 +3122,7 @@ class SpykeWindow(QtGui.QMainWindow):
         self.UpdateClustersGUI()
 
         # update mean cluster positions, so they can be sorted by y0:
-        for cluster in sort.clusters.values():
-            cluster.update_pos()
+        update_poss(list(sort.clusters.values()))
 
         print('Done importing events from %r' % fullfname)
 
@@ -3273,6 +3236,9 @@ class SpykeWindow(QtGui.QMainWindow):
         # load .wave file of the same base name:
         sort.wavefname = basefname + '.wave' # update in case of renamed basefname
         sort.wavedata = self.OpenWaveFile(sort.wavefname)
+        # restore any dimension reduction results saved along with the sort:
+        sort.X = XCache()
+        self.bind_Xcache(fname)
 
         # try auto-updating sort to latest version:
         if float(sort.__version__) < float(__version__):
@@ -3352,21 +3318,28 @@ class SpykeWindow(QtGui.QMainWindow):
     def OpenSpikeFile(self, fname):
         """Open a .spike file, assign its contents to the spikes array, update dependencies"""
         sort = self.sort
+        path = os.path.join(self.sortpath, fname)
+        if os.path.isdir(path):
+            # columnar, fields are only loaded as needed:
+            print('Opening columnar spike file %r' % fname)
+            spikes = SpikeTable(path)
+        else:
 <<<<<<< HEAD
-        print('loading spike file %r' % fname)
-        f = open(join(self.sortpath, fname), 'rb')
-        spikes = np.load(f)
-        print('spike file was %d bytes long' % f.tell())
+            print('loading spike file %r' % fname)
+            f = open(join(self.sortpath, fname), 'rb')
+            spikes = np.load(f)
+            print('spike file was %d bytes long' % f.tell())
 =======
-        print('Loading spike file %r' % fname)
-        t0 = time.time()
-        f = open(os.path.join(self.sortpath, fname), 'rb')
-        spikes = np.load(f)
-        print('Done opening spike file, took %.3f sec' % (time.time()-t0))
-        print('Spike file was %d bytes long' % f.tell())
+            print('Loading spike file %r' % fname)
+            t0 = time.time()
+            f = open(os.path.join(self.sortpath, fname), 'rb')
+            spikes = np.load(f)
+            print('Done opening spike file, took %.3f sec' % (time.time()-t0))
+            print('Spike file was %d bytes long' % f.tell())
 >>>>>>> upstream/master
-        f.close()
+            f.close()
         sort.spikes = spikes
+        sort.invalidate_paramstats() # any stats unpickled from older .sort files
         # when loading a spike file, make sure the nid field is overwritten
         # in the spikes array. The nids in sort.neurons are always the definitive ones:
         for neuron in sort.neurons.values():
@@ -3376,6 +3349,8 @@ class SpykeWindow(QtGui.QMainWindow):
     def OpenWaveFile(self, fname):
         """Open a .wave file and return wavedata array"""
         sort = self.sort
+        # finish any update of the .wave file that was interrupted by a crash:
+        core.recovernpyfilerows(os.path.join(self.sortpath, fname))
 <<<<<<< HEAD
         print('opening wave file %r' % fname)
         try: f = open(join(self.sortpath, fname), 'rb')
@@ -3391,7 +3366,14 @@ class SpykeWindow(QtGui.QMainWindow):
             del sort.wavedata
             #gc.collect() # ensure memory is freed up to prepare for new wavedata, necessary?
         except AttributeError: pass
-        wavedata = np.load(f)
+        try: del sort.wavemodified # only applies to the old wavedata
+        except AttributeError: pass
+        if WAVEMMAPMODE:
+            wavedata = np.load(f.name, mmap_mode=WAVEMMAPMODE)
+            print('Memmapped wave file with mode %r' % WAVEMMAPMODE)
+            f.seek(0, os.SEEK_END) # for reporting file size
+        else:
+            wavedata = np.load(f)
 <<<<<<< HEAD
         print('wave file was %d bytes long' % f.tell())
 =======
@@ -3416,16 +3398,21 @@ class SpykeWindow(QtGui.QMainWindow):
         return self.sort
 
     def SaveSortFile(self, fname):
-        """Save sort to a .sort file. fname is assumed to be relative to self.sortpath"""
+        """Save sort to a .sort file, along with its .spike and .wave files. Everything
+        that's saved is snapshotted right away, and then written in the background, each
+        file atomically. fname is assumed to be relative to self.sortpath"""
         s = self.sort
         try: s.spikes
         except AttributeError: raise RuntimeError("Sort has no spikes to save")
+        self.FinishSave() # last save might still be writing the same files
         if not os.path.splitext(fname)[1]: # if it doesn't have an extension
             fname = fname + '.sort'
         try: s.spikefname
         except AttributeError: # corresponding .spike filename hasn't been generated yet
             s.spikefname = os.path.splitext(fname)[0] + '.spike'
-        self.SaveSpikeFile(s.spikefname) # always (re)save .spike when saving .sort
+        jobs, done = [], []
+        # always (re)save .spike when saving .sort:
+        self.SaveSpikeFile(s.spikefname, jobs, done)
 <<<<<<< HEAD
         print('saving sort file %r' % fname)
 =======
@@ -3435,15 +3422,62 @@ class SpykeWindow(QtGui.QMainWindow):
         self.save_clustering_selections()
         self.save_window_states()
         s.fname = fname # bind it now that it's about to be saved
-        f = open(os.path.join(self.sortpath, fname), 'wb')
-        pickle.dump(s, f, protocol=-1) # pickle with most efficient protocol
-        f.close()
+        path = os.path.join(self.sortpath, fname)
+        data = pickle.dumps(s, protocol=-1) # pickle with most efficient protocol
+        def write(progress):
+            core.writeatomic(path, lambda f: f.write(data))
+            progress(len(data))
+        # write .sort last, so it's never newer than the .spike and .wave files it needs:
+        jobs.append(('Writing sort file %r' % fname, len(data), write))
+        self.bind_Xcache(fname)
+        s.X.flush()
+        wavepath = self.get_Xcachewavepath(fname)
+        def finish(error):
+            if not error: # cached results are valid for the .wave file as just written
+                s.X.update_wavestat(wavepath)
+        done.append(finish)
 <<<<<<< HEAD
 =======
-        print('Done saving sort file, took %.3f sec' % (time.time()-t0))
+        print('Done snapshotting sort file, took %.3f sec' % (time.time()-t0))
 >>>>>>> upstream/master
+        self.SaveInBackground(jobs, done)
         self.updateTitle()
-        self.updateRecentFiles(os.path.join(self.sortpath, fname))
+        self.updateRecentFiles(path)
+
+    def SaveInBackground(self, jobs, done):
+        """Run save jobs on a background thread, and show their progress in the status
+        bar. Once they're finished, call each of funcs in done with any error, back in
+        the GUI thread"""
+        self.savethread = core.SaveThread(jobs)
+        self.savedone = done
+        self.savethread.start()
+        self.savetimer.start(core.SAVEPOLLINTERVAL)
+
+    def on_savetimer_timeout(self):
+        """Show progress of background saving, and finish up once it's done"""
+        t = self.savethread
+        if t is not None and t.is_alive():
+            self.statusBar().showMessage('%s: %d%%' % (t.msg, t.fraction*100))
+        else:
+            self.FinishSave()
+
+    def FinishSave(self):
+        """Wait for any background saving to finish, and then finish up after it"""
+        t = self.savethread
+        self.savetimer.stop()
+        if t is None:
+            return
+        if t.is_alive():
+            print('Waiting for last save to finish')
+            t.join()
+        self.savethread = None
+        for func in self.savedone:
+            func(t.error)
+        self.savedone = []
+        if t.error:
+            self.statusBar().showMessage('Saving failed: %s' % t.error)
+        else:
+            self.statusBar().showMessage('Saved', 2000)
 
     def save_clustering_selections(self):
         """Save state of last user-selected clustering parameters. Unlike parameters such as
@@ -3473,8 +3507,32 @@ class SpykeWindow(QtGui.QMainWindow):
             s.windowGeometries[wintype] = window.saveGeometry()
             s.windowStates[wintype] = window.saveState()
 
-    def SaveSpikeFile(self, fname):
-        """Save spikes to a .spike file. fname is assumed to be relative to self.sortpath"""
+    def get_Xcachepath(self, fname):
+        """Return path of on-disk dimension reduction cache for .sort file fname"""
+        basefname = os.path.splitext(fname)[0]
+        return os.path.join(self.sortpath, '.%s_Xcache' % basefname)
+
+    def get_Xcachewavepath(self, fname):
+        """Return path of .wave file that the on-disk dimension reduction cache for .sort
+        file fname was calculated from"""
+        basefname = os.path.splitext(fname)[0]
+        return os.path.join(self.sortpath, basefname + '.wave')
+
+    def bind_Xcache(self, fname):
+        """Bind sort's dimension reduction cache to the on-disk one for .sort file fname.
+        Results on disk from any other sort, or from a since modified .wave file, are
+        cleared"""
+        s = self.sort
+        try: s.X
+        except AttributeError: s.X = XCache()
+        try: s.uid
+        except AttributeError: s.uid = uuid.uuid4().hex # new sort, or sort from before uids
+        s.X.set_path(self.get_Xcachepath(fname), s.uid, self.get_Xcachewavepath(fname))
+
+    def SaveSpikeFile(self, fname, jobs, done):
+        """Save spikes to a .spike file, by appending save jobs to jobs, and funcs to call
+        once they're done to done, for self.SaveInBackground(). fname is assumed to be
+        relative to self.sortpath"""
         s = self.sort
         try: s.spikes
         except AttributeError: raise RuntimeError("Sort has no spikes to save")
@@ -3484,61 +3542,96 @@ class SpykeWindow(QtGui.QMainWindow):
         except AttributeError: # corresponding .wave file hasn't been created yet
             wavefname = os.path.splitext(fname)[0] + '.wave'
             # only write whole .wave file if missing s.wavefname attrib:
-            self.SaveWaveFile(wavefname)
+            self.SaveWaveFile(wavefname, jobs, done)
             self.dirtysids.clear() # shouldn't be any, but clear anyway just in case
         if len(self.dirtysids) > 0:
-            self.SaveWaveFile(s.wavefname, sids=self.dirtysids)
-            self.dirtysids.clear() # no longer dirty
+            self.SaveWaveFile(s.wavefname, jobs, done, sids=self.dirtysids)
+            self.dirtysids.clear() # no longer dirty, unless saving them fails
+        if COLUMNARSPIKEFILES or isinstance(s.spikes, SpikeTable):
+            print('Saving columnar spike file %r' % fname)
+            t0 = time.time()
+            if not isinstance(s.spikes, SpikeTable):
+                s.spikes = SpikeTable(spikes=s.spikes)
+            s.spikes.save(os.path.join(self.sortpath, fname)) # only changed fields
+            print('Done saving spike file, took %.3f sec' % (time.time()-t0))
+        else:
 <<<<<<< HEAD
-        print('saving spike file %r' % fname)
-        f = open(join(self.sortpath, fname), 'wb')
-        np.save(f, s.spikes)
-        f.close()
+            print('saving spike file %r' % fname)
+            path = join(self.sortpath, fname)
 =======
-        print('Saving spike file %r' % fname)
-        t0 = time.time()
-        f = open(os.path.join(self.sortpath, fname), 'wb')
-        np.save(f, s.spikes)
-        f.close()
-        print('Done saving spike file, took %.3f sec' % (time.time()-t0))
+            print('Saving spike file %r' % fname)
+            path = os.path.join(self.sortpath, fname)
 >>>>>>> upstream/master
+            spikes = s.spikes.copy() # snapshot
+            def write(progress):
+                core.writeatomic(path, lambda f: np.save(f, spikes))
+                progress(spikes.nbytes)
+            jobs.append(('Writing spike file %r' % fname, spikes.nbytes, write))
         s.spikefname = fname # used to indicate that the spikes have been saved
 
-    def SaveWaveFile(self, fname, sids=None):
+    def SaveWaveFile(self, fname, jobs, done, sids=None):
         """Save waveform data to a .wave file. Optionally, update only sids
-        in existing .wave file. fname is assumed to be relative to self.sortpath"""
+        in existing .wave file. Save jobs are appended to jobs, and funcs to call once
+        they're done to done, for self.SaveInBackground(). Unlike the .sort and .spike
+        files, wavedata is too big to snapshot, and is written straight from memory. Any
+        sids modified while being written are dirty again by then, and are rewritten on
+        the next save. fname is assumed to be relative to self.sortpath"""
         s = self.sort
         try: s.wavedata
         except AttributeError: return # no wavedata to save
         if not os.path.splitext(fname)[1]: # if it doesn't have an extension
             fname = fname + '.wave'
+        path = os.path.join(self.sortpath, fname)
+        # memmapped wavedata can only be updated in place in the file it's mapped from:
+        mapped = (isinstance(s.wavedata, np.memmap) and os.path.exists(path) and
+                  os.path.samefile(s.wavedata.filename, path))
 <<<<<<< HEAD
         print('saving wave file %r' % fname)
-        if sids != None and len(sids) >= NDIRTYSIDSTHRESH:
+        if sids != None:
 =======
         print('Saving wave file %r' % fname)
-        t0 = time.time()
-        if sids is not None and len(sids) >= NDIRTYSIDSTHRESH:
+        if sids is not None:
 >>>>>>> upstream/master
-            sids = None # resave all of them for speed
+            sids = np.unique(np.fromiter(sids, dtype=np.int64, count=len(sids))) # snapshot
+            rowsize = s.wavedata[0].nbytes
+            if not mapped and not core.partialnpyupdate(s.nspikes, rowsize, sids):
+                sids = None # resave all of them for speed
         if sids is None: # write the whole file
-            print('Updating all %d spikes in wave file %r' % (s.nspikes, fname))
-            f = open(os.path.join(self.sortpath, fname), 'wb')
-            np.save(f, s.wavedata)
-            f.close()
+            if mapped:
+                raise RuntimeError("Can't overwrite wave file %r that wavedata is "
+                                   "memmapped from" % fname)
+            msg = 'Updating all %d spikes in wave file %r' % (s.nspikes, fname)
+            nbytes = s.wavedata.nbytes
+            def write(progress):
+                # a chunk at a time:
+                core.writeatomic(path, lambda f: s.save_wavedata(f, progress))
+            def finish(error):
+                if error:
+                    del s.wavefname # whole .wave file needs to be written next time
         else: # write only sids
 <<<<<<< HEAD
-            print('updating %d spikes in wave file %r' % (len(sids), fname))
-            core.updatenpyfilerows(join(self.sortpath, fname), sids, s.wavedata)
+            msg = 'updating %d spikes in wave file %r' % (len(sids), fname)
 =======
-            print('Updating %d spikes in wave file %r' % (len(sids), fname))
-            core.updatenpyfilerows(os.path.join(self.sortpath, fname), sids, s.wavedata)
-        print('Done saving wave file, took %.3f sec' % (time.time()-t0))
+            msg = 'Updating %d spikes in wave file %r' % (len(sids), fname)
 >>>>>>> upstream/master
+            nbytes = 2 * len(sids) * rowsize # journal, then file
+            def write(progress):
+                core.updatenpyfilerows(path, sids, s.wavedata, progress)
+            def finish(error):
+                if error:
+                    self.dirtysids.update(sids.tolist()) # still dirty
+                elif mapped:
+                    # updated rows in memory now match those in the file, no need to keep
+                    # them, unless they've been modified again in the meantime:
+                    clean = sids[~np.in1d(sids, list(self.dirtysids))]
+                    s.update_wavemodified(clean, modified=False)
+        jobs.append((msg, nbytes, write))
+        done.append(finish)
         s.wavefname = fname
 
     def DeleteSort(self):
         """Delete any existing Sort"""
+        self.FinishSave() # don't leave any of its files half written
         try:
             # TODO: if Save button is enabled, check if Sort is saved,
             # if not, prompt to save
@@ -3845,10 +3938,11 @@ class SpykeWindow(QtGui.QMainWindow):
         self.update_sort_from_gui()
 
     def update_dirtysids(self, sids):
-        """Update self.dirtysids and clear the dimension reduction cache"""
+        """Update self.dirtysids and invalidate any cached dimension reduction results
+        that depend on them"""
         self.dirtysids.update(sids)
-        # clear the dimension reduction cache:
-        self.sort.X = {}
+        try: self.sort.X.invalidate(sids)
+        except AttributeError: pass # no dimension reduction cache yet
 
     def update_spiketw(self, spiketw):
         """Update tw of self.sort and of Spike and Sort windows. For efficiency,
@@ -4091,6 +4185,20 @@ class MPLWindow(SpykeToolWindow):
         self.setWindowTitle("MPL Window")
         self.ax = figure.add_subplot(111)
 
+    def reset(self, nrows=1, ncols=1, tril=False):
+        """Clear figure, and fill it with an nrows x ncols grid of axes, or only its lower
+        triangle if tril. Return the grid as a 2D object array, with None where there are
+        no axes, and bind its first axes to self.ax"""
+        self.f.clf()
+        axes = np.empty((nrows, ncols), dtype=object)
+        for i in range(nrows):
+            for j in range(ncols):
+                if tril and j > i:
+                    continue
+                axes[i, j] = self.f.add_subplot(nrows, ncols, i*ncols + j + 1)
+        self.ax = axes[0, 0]
+        return axes
+
 class Match(object):
     """Just an object to store rmserror calculations between all clusters
     and all unsorted spikes, and also to store which cluster each spike
@@ -4098,12 +4206,17 @@ class Match(object):
     def __init__(self, cids=None, sids=None, errs=None):
         self.cids = cids # row labels
         self.sids = sids # column labels
-        self.errs = errs # len(cids) x len(sids) error array
+        # len(cids) x len(sids) sparse error matrix, missing values are incomparable pairs:
+        self.errs = errs.tocsr()
         self.best = {} # dict with cluster ids as keys and sids as values
-        bestcidis = errs.argmin(axis=0) # of length len(sids)
+        coo = errs.tocoo()
+        # sort stored errors by sid, then by error, and take the first one of each sid:
+        i = np.lexsort((coo.data, coo.col))
+        cidis, sidis = coo.row[i], coo.col[i]
+        first = np.diff(np.concatenate([[-1], sidis])) != 0
+        cidis, sidis = cidis[first], sidis[first] # spikes with no stored errs are left out
         for cidi, cid in enumerate(cids):
-            sidis, = np.where(bestcidis == cidi)
-            self.best[cid] = sids[sidis]
+            self.best[cid] = sids[sidis[cidis == cidi]]
 
     def get_best_errs(self, cid):
         """Get rmserror values between cluster cid and all the unsorted spikes
@@ -4111,8 +4224,8 @@ class Match(object):
         cidi = self.cids.searchsorted(cid)
         bestsids = self.best[cid]
         bestsidis = self.sids.searchsorted(bestsids)
-        return self.errs[cidi, bestsidis]
-        
+        return self.errs[cidi][:, bestsidis].toarray().ravel()
+
 
 if __name__ == '__main__':
     # prevents "The event loop is already running" messages when calling ipshell():
@@ -63,9 +63,16 @@ class File(dat.File):
         long contiguous data packet, but if there are pauses during the recording, the
         data is broken up into multiple packets, with a time gap between each one. Need
         to step over all chans, including aux chans, so pass nchanstotal instead of nchans"""
-        datapacket = DataPacket(self.f, self.fileheader.nchanstotal)
-        if self.f.tell() != self.filesize: # make sure we're at EOF
-            raise NotImplementedError("Can't handle pauses in recording yet")
+        nchanstotal = self.fileheader.nchanstotal
+        if self.growing:
+            # header nt isn't necessarily up to date while the file is still being written
+            # to, use number of whole timepoints up to self.filesize instead:
+            nt = (self.filesize - self.datapacketoffset - 9) // (2 * nchanstotal)
+            datapacket = DataPacket(self.f, nchanstotal, nt=nt)
+        else:
+            datapacket = DataPacket(self.f, nchanstotal)
+            if self.f.tell() != self.filesize: # make sure we're at EOF
+                raise NotImplementedError("Can't handle pauses in recording yet")
         self.datapacket = datapacket
         self.contiguous = True
 
@@ -298,13 +305,15 @@ class ChanHeader(object):
 
 class DataPacket(object):
     """.nsx data packet"""
-    def __init__(self, f, nchans):
+    def __init__(self, f, nchans, nt=None):
         self.offset = f.tell()
         self.nchans = nchans
         header, = unpack('B', f.read(1))
         assert header == 1
         # nsamples offset of first timepoint from t=0; number of timepoints:
         self.t0i, self.nt = unpack('II', f.read(8))
+        if nt is not None: # override nt in header
+            self.nt = nt
         self.dataoffset = f.tell()
 
         # load all data into memory using np.fromfile. Time is MSB, chan is LSB:
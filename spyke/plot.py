@@ -880,7 +880,7 @@ class PlotPanel(FigureCanvas):
                   "reloading selected spike")
             return
         t = spw.primarypeakt
-        spikes[sid]['t'] = t # us
+        spikes['t'][sid] = t # us
         nchans = spikes[sid]['nchans']
         chans = spikes[sid]['chans'][:nchans]
         try:
@@ -888,16 +888,17 @@ class PlotPanel(FigureCanvas):
                 # update chan and chani:
                 chan = spw.alignspike2chan
                 assert chan in chans
-                spikes[sid]['chan'] = chan
-                spikes[sid]['chani'] = chans.searchsorted(chan) # chans are always sorted
+                spikes['chan'][sid] = chan
+                spikes['chani'][sid] = chans.searchsorted(chan) # chans are always sorted
         except AttributeError:
             pass
         t0 = t + sort.tw[0]
         t1 = t + sort.tw[1]
-        spikes[sid]['t0'] = t0 # us
-        spikes[sid]['t1'] = t1
+        spikes['t0'][sid] = t0 # us
+        spikes['t1'][sid] = t1
         wave = spw.hpstream(t0, t1, chans)
         sort.wavedata[sid][:nchans] = wave.data
+        sort.update_wavemodified([sid])
         assert t != spw.secondarypeakt
         if t < spw.secondarypeakt:
             aligni = 0
@@ -909,14 +910,15 @@ class PlotPanel(FigureCanvas):
             peak1ti = wave.ts.searchsorted(t)
         # TODO: redo spatial localization.
         # For now, cheat and make peaktis the same for all chans:
-        spikes[sid]['tis'][:nchans] = peak0ti, peak1ti
-        spikes[sid]['dt'] = abs(spw.secondarypeakt - t) # us
+        spikes['tis'][sid, :nchans] = peak0ti, peak1ti
+        spikes['dt'][sid] = abs(spw.secondarypeakt - t) # us
         chani = spikes[sid]['chani']
         V0 = AD2uV(wave.data[chani, peak0ti]) # uV
         V1 = AD2uV(wave.data[chani, peak1ti])
-        spikes[sid]['V0'] = V0
-        spikes[sid]['V1'] = V1
-        spikes[sid]['Vpp'] = abs(V1 - V0)
+        spikes['V0'][sid] = V0
+        spikes['V1'][sid] = V1
+        spikes['Vpp'][sid] = abs(V1 - V0)
+        sort.invalidate_paramstats(['t', 'chan', 'dt', 'V0', 'V1', 'Vpp'])
 
         # mark sid as dirty in .wave file
         spw.update_dirtysids([sid])
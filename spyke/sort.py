@@ -14,7 +14,12 @@ import operator
 import random
 import shutil
 import hashlib
+import json
+import mmap
+import tempfile
 import multiprocessing as mp
+from multiprocessing.pool import ThreadPool
+from collections import OrderedDict as odict
 
 from PyQt4 import QtCore, QtGui
 from PyQt4.QtCore import Qt
@@ -22,6 +27,7 @@ from PyQt4.QtGui import QAction, QIcon, QApplication
 
 import numpy as np
 import scipy
+import scipy.sparse
 #from scipy.cluster.hierarchy import fclusterdata
 
 import pylab as pl
@@ -36,6 +42,7 @@ from .core import (WaveForm, Gaussian, MAXLONGLONG, R, toiter, intround, printfl
                    USList, ClusterChange, SpikeSelectionSlider, lrrep2Darrstripis, rollwin2D)
 from .surf import EPOCH
 from .plot import SpikeSortPanel, CLUSTERCOLOURDICT, WHITE
+from .cluster import update_compposs
 from .__version__ import __version__
 
 #MAXCHANTOLERANCE = 100 # um
@@ -49,13 +56,396 @@ VSCROLLBARWIDTH = 14 # hack
 SORTWINDOWHEIGHT = 1035 # TODO: this should be set programmatically
 MINSORTWINDOWWIDTH = 566
 
-MEANWAVEMAXSAMPLES = 2000
+MEANWAVEMAXSAMPLES = None # if set, subsample clusters bigger than this for mean waveforms
+# max num bytes of wavedata rows and data derived from them to work on at a time. Bounds
+# memory use of operations on many spikes, including pages of memmapped wavedata:
+WAVECHUNKMAXNBYTES = 256 * 2**20
+XCACHEMAXNBYTES = 512 * 2**20 # in-memory budget for cached dimension reduction results
+# max num spikes to fit dimension reduction to, the rest are projected through the fit.
+# None fits all spikes:
+COMPFITMAXNSPIKES = 50000
+TSNEMAXNSPIKES = 20000 # max num spikes to fit tSNE to, the rest are interpolated
+TSNEMAXNPCS = 50 # max num PCs to reduce waveforms to before tSNE
+TSNENNEIGHBOURS = 10 # num nearest fit spikes in PC space to interpolate the rest from
+TSNENNMAXNPCS = 8 # max num PCs to search for nearest fit spikes in, kd-trees slow beyond
+# min fraction of fit spikes that must be in the previous tSNE embedding to warm start:
+TSNEWARMMINOVERLAP = 0.5
+ALIGNMAXSHIFT = 2 # max num timepoints to shift spikes by either way when best fit aligning
+ALIGNINTERP = 1 # num steps per timepoint to try when best fit aligning, >1 interpolates
+# split spike reloading reads at ISIs at least this big, in us. Smaller gaps are cheaper to
+# load along with their neighbours than to make another stream call for:
+RELOADMAXISI = 250000
+RELOADMAXGROUPDT = 10000000 # max time span of a single reload read in us, bounds its memory
+RELOADNPROCESSES = None # num processes to reload spikes with, None uses all cores
+XCORRNBINS = 100 # num bins per correlogram
+XCORRCACHESIZE = 20 # num most recently used all-pairs correlogram results to keep
 NPCSPERCHAN = 7
 
 PCALIB = 'mdp'
 ICALIB = 'sklearn'
 
 
+def reloadinitializer(stream, nt):
+    """Save unpickled copy of the Stream to the current process, for reloading spikes"""
+    ps = mp.current_process()
+    ps.stream = stream
+    ps.stream.open() # reopen underlying stream data source after unpickling
+    ps.nt = nt
+
+def callreloadgroup(args):
+    """Reload a group of spikes using the current process' Stream. Return reloaded
+    (data, nts)"""
+    ps = mp.current_process()
+    return reload_group(ps.stream, ps.nt, *args)
+
+def reload_group(stream, nt, t0s, t1s, nchanss, chanss):
+    """Load a temporally ordered group of spikes with a single stream call, and slice
+    out each spike's data. Return (data, nts), where data is (nspikes, maxnchans, nt),
+    and nts is the number of valid timepoints for each spike"""
+    # Find union of chans of spikes in this group, and ask stream for only those
+    # so that no unnecessary resampling on unneeded chans takes place.
+    # Note that this doesn't make a difference when CAR is enabled in the stream,
+    # because the full set of enabled channels have to be maintained in
+    # Stream.__call__ until the very end.
+    # Don't bother cutting out the correct nchans for each spike. At worst,
+    # chan 0 (the "empty" chans array value) will be unnecessarily added to
+    # unionchans, and we'll be retrieving one extra channel when creating tempwave,
+    # which will then later be discarded:
+    unionchans = np.unique(chanss)
+    if 0 not in stream.chans: # if chan 0 is disabled in stream
+        # remove 0 from unionchans, otherwise an error would be raised when
+        # calling stream()
+        unionchans = unionchans[unionchans != 0]
+    # load and resample only what's needed for this group:
+    tempwave = stream(t0s[0], t1s[-1], unionchans)
+    # same time slicing and chan indexing as WaveForm.__getitem__, but for all spikes
+    # at once. unionchans are sorted, so chan indices can be found by searchsorted:
+    lois = tempwave.ts.searchsorted(t0s)
+    hiis = tempwave.ts.searchsorted(t1s)
+    chaniss = unionchans.searchsorted(chanss)
+    nspikes, maxnchans = chanss.shape
+    data = np.zeros((nspikes, maxnchans, nt), dtype=np.int16)
+    nts = hiis - lois
+    for i in range(nspikes):
+        nchans = nchanss[i]
+        data[i, :nchans, :nts[i]] = tempwave.data[chaniss[i, :nchans], lois[i]:hiis[i]]
+    return data, nts
+
+def write_reloaded(wavedata, group, nchanss, data, nts):
+    """Write reloaded data of group of sids to wavedata, leaving the unused chans and
+    timepoints of each row as they were"""
+    maxnchans, nt = data.shape[1:]
+    mask = ((np.arange(maxnchans) < nchanss[:, None])[:, :, None] &
+            (np.arange(nt) < nts[:, None])[:, None, :])
+    if mask.all():
+        wavedata[group] = data
+    else:
+        rows = wavedata[group] # a copy
+        np.copyto(rows, data, where=mask)
+        wavedata[group] = rows
+
+
+def wavefilestat(fname):
+    """Return [size, modification time] of .wave file fname, or None if it doesn't exist"""
+    try:
+        st = os.stat(fname)
+    except (OSError, TypeError): # missing, or fname is None
+        return None
+    return [st.st_size, st.st_mtime]
+
+
+class XCache(object):
+    """LRU cache of dimension reduction results (component matrices), keyed by Xhash.
+    Entries in memory are evicted least recently used first once their total size exceeds
+    maxnbytes. If path is set, flush() also saves entries to .npy files in that directory,
+    with a .json index, from which they can be memmapped in a later session. Each entry
+    keeps its sids, so that it can be invalidated when any of their waveforms change. The
+    index also records which sort the entries belong to, and the size and modification
+    time of the .wave file they were calculated from, so entries of some other sort, or
+    of a .wave file changed since, are never used"""
+    def __init__(self, maxnbytes=XCACHEMAXNBYTES, path=None):
+        self.maxnbytes = maxnbytes
+        self.mem = odict() # Xhash: (X, sids), in order of least to most recently used
+        self.nbytes = 0
+        self.nhits, self.ndiskhits, self.nmisses = 0, 0, 0
+        self.nevicted, self.ninvalidated = 0, 0
+        self.path = None
+        self.index = {} # Xhash: nbytes, of entries saved to path
+        self.sortid, self.wavestat = None, None
+        self.set_path(path)
+
+    def set_path(self, path, sortid=None, wavefname=None):
+        """Bind on-disk cache directory path, and read its index, if any. sortid uniquely
+        identifies the sort, and wavefname is the full path to its .wave file. Entries on
+        disk saved for a different sortid or a different version of the .wave file are
+        deleted"""
+        if path == self.path and sortid == self.sortid:
+            return
+        self.path = path
+        self.index = {}
+        self.sortid, self.wavestat = sortid, wavefilestat(wavefname)
+        if path is None or not os.path.exists(self.indexfname()):
+            return
+        with open(self.indexfname(), 'r') as f:
+            index = json.load(f)
+        self.index = index.get('entries', {})
+        if (index.get('sortid') != sortid or index.get('wavestat') != self.wavestat or
+            'entries' not in index): # saved for another sort or .wave, or by an old version
+            print('Clearing stale dimension reduction results in %r' % path)
+            for key in list(self.index):
+                self.remove(key)
+            self.save_index()
+
+    def update_wavestat(self, wavefname):
+        """Record the current size and modification time of the .wave file, e.g. after
+        saving it, to keep entries on disk valid for it"""
+        self.wavestat = wavefilestat(wavefname)
+        if self.path is not None and os.path.exists(self.indexfname()):
+            self.save_index()
+
+    def indexfname(self):
+        return os.path.join(self.path, 'index.json')
+
+    def fname(self, key, kind):
+        return os.path.join(self.path, '%s_%s.npy' % (key, kind))
+
+    def __contains__(self, key):
+        return key in self.mem or key in self.index
+
+    def __len__(self):
+        return len(set(self.mem) | set(self.index))
+
+    def __getitem__(self, key):
+        """Return X of entry key, from memory or else from disk. Doesn't count towards
+        hit/miss stats"""
+        return self.entry(key)[0]
+
+    def entry(self, key):
+        """Return (X, sids) of entry key, from memory or else from disk"""
+        if key in self.mem:
+            X, sids = self.mem.pop(key)
+            self.mem[key] = X, sids # move to most recently used end
+            return X, sids
+        if key in self.index:
+            X = np.load(self.fname(key, 'X'), mmap_mode='r')
+            sids = np.load(self.fname(key, 'sids'), mmap_mode='r')
+            self.add(key, X, sids)
+            return X, sids
+        raise KeyError(key)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self.remove(key)
+
+    def get(self, key):
+        """Return X of entry key, or None on a miss. Updates hit/miss stats"""
+        inmem = key in self.mem
+        try:
+            X = self[key]
+        except KeyError:
+            self.nmisses += 1
+            return None
+        if inmem:
+            self.nhits += 1
+        else:
+            self.ndiskhits += 1
+        return X
+
+    def add(self, key, X, sids):
+        """Add X calculated from sids as entry key, evict least recently used entries
+        as needed to stay within maxnbytes, but always keep the newest one"""
+        if key in self.mem:
+            self.nbytes -= sum(a.nbytes for a in self.mem.pop(key))
+        self.mem[key] = X, sids
+        self.nbytes += X.nbytes + sids.nbytes
+        while self.nbytes > self.maxnbytes and len(self.mem) > 1:
+            oldkey, oldentry = self.mem.popitem(last=False)
+            self.nbytes -= sum(a.nbytes for a in oldentry)
+            self.nevicted += 1
+
+    def remove(self, key):
+        """Remove entry key from memory and disk"""
+        if key in self.mem:
+            self.nbytes -= sum(a.nbytes for a in self.mem.pop(key))
+        if key in self.index:
+            del self.index[key]
+            for kind in ['X', 'sids']:
+                try: os.remove(self.fname(key, kind))
+                except OSError: pass # already gone, or still memmapped on Windows
+            self.save_index()
+
+    def invalidate(self, sids):
+        """Remove all entries that depend on any of sids, e.g. because their waveforms
+        have changed"""
+        sids = np.asarray(list(sids) if isinstance(sids, set) else sids, dtype=np.int64)
+        if len(sids) == 0:
+            return
+        dirty = np.zeros(sids.max()+1, dtype=bool)
+        dirty[sids] = True
+        for key in list(set(self.mem) | set(self.index)):
+            if key in self.mem:
+                esids = self.mem[key][1]
+            else:
+                try: esids = np.load(self.fname(key, 'sids'), mmap_mode='r')
+                except IOError: esids = sids # missing from disk, remove it from index
+            esids = esids[esids < len(dirty)]
+            if dirty[esids].any():
+                self.remove(key)
+                self.ninvalidated += 1
+
+    def clear(self):
+        """Remove all entries from memory and disk"""
+        for key in list(set(self.mem) | set(self.index)):
+            self.remove(key)
+
+    def flush(self):
+        """Save entries in memory that aren't on disk yet to path"""
+        if self.path is None:
+            return
+        keys = [ key for key in self.mem if key not in self.index ]
+        if len(keys) == 0:
+            return
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        for key in keys:
+            X, sids = self.mem[key]
+            for kind, a in [('X', X), ('sids', sids)]:
+                fname = self.fname(key, kind)
+                with open(fname + '.tmp', 'wb') as f:
+                    np.save(f, a)
+                os.rename(fname + '.tmp', fname) # atomic on POSIX
+            self.index[key] = X.nbytes
+        self.save_index()
+        print('Saved %d dimension reduction results to %r' % (len(keys), self.path))
+
+    def save_index(self):
+        tmpfname = self.indexfname() + '.tmp'
+        with open(tmpfname, 'w') as f:
+            json.dump({'sortid': self.sortid, 'wavestat': self.wavestat,
+                       'entries': self.index}, f)
+        os.rename(tmpfname, self.indexfname())
+
+    def report(self):
+        """Return string summarizing cache contents and hit/miss stats"""
+        nlookups = self.nhits + self.ndiskhits + self.nmisses
+        hitrate = (self.nhits + self.ndiskhits) / nlookups * 100 if nlookups else 0
+        return ('%d entries, %.1f/%.1f MB in memory, %d on disk; %d hits, %d disk hits, '
+                '%d misses (%.0f%% hit rate), %d evicted, %d invalidated'
+                % (len(self), self.nbytes/2**20, self.maxnbytes/2**20, len(self.index),
+                   self.nhits, self.ndiskhits, self.nmisses, hitrate, self.nevicted,
+                   self.ninvalidated))
+
+
+class SpikeTable(object):
+    """Columnar alternative to the spikes struct array, stored as one .npy file per field
+    in a directory, with a .json index of the field dtypes. Fields are loaded lazily, one
+    at a time, the first time they're accessed by name, so scalar fields can be used
+    without reading the wide ones like 'chans' and 'tis'. Fields are loaded into memory,
+    or memmapped if mmap_mode is set. Indexing by anything other than a field name returns
+    a struct array (or record) of those spikes with all fields, just like indexing the
+    spikes array, but as a copy. Fields are modified in place by name throughout, so
+    changed ones are found by their hash when saving, and only those are rewritten"""
+    def __init__(self, path=None, spikes=None, mmap_mode=None):
+        self.path = path
+        self.mmap_mode = mmap_mode
+        self.columns = {} # loaded fields
+        self.hashes = {} # hashes of loaded fields as they are in path
+        if spikes is not None: # convert from struct array
+            self.dtype = spikes.dtype
+            self.nspikes = len(spikes)
+            for name in self.dtype.names:
+                self.columns[name] = spikes[name].copy() # contiguous
+        else:
+            with open(self.indexfname(path), 'r') as f:
+                index = json.load(f)
+            self.nspikes = index['nspikes']
+            self.dtype = np.dtype([ tuple(field[:2]) + tuple(tuple(s) for s in field[2:])
+                                    for field in index['dtype'] ])
+
+    def indexfname(self, path):
+        return os.path.join(path, 'index.json')
+
+    def fname(self, path, name):
+        return os.path.join(path, '%s.npy' % name)
+
+    def __len__(self):
+        return self.nspikes
+
+    def get_shape(self):
+        return (self.nspikes,)
+
+    shape = property(get_shape)
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self.get_field(key)
+        names = self.dtype.names
+        field = self.get_field(names[0])[key]
+        shape = field.shape[:field.ndim-len(self.dtype[names[0]].shape)]
+        out = np.empty(shape, dtype=self.dtype)
+        for name in names:
+            out[name] = self.get_field(name)[key]
+        return out[()] if out.ndim == 0 else out # record for a scalar key
+
+    def __setitem__(self, key, value):
+        if isinstance(key, str):
+            self.get_field(key)[:] = value
+            return
+        for name in self.dtype.names:
+            self.get_field(name)[key] = value[name]
+
+    def get_field(self, name):
+        """Return field name, load it first if necessary"""
+        try:
+            return self.columns[name]
+        except KeyError:
+            pass
+        if name not in self.dtype.names:
+            raise ValueError('no field of name %s' % name)
+        field = np.load(self.fname(self.path, name), mmap_mode=self.mmap_mode)
+        self.columns[name] = field
+        self.hashes[name] = self.hash(field)
+        return field
+
+    def hash(self, field):
+        return hashlib.md5(np.ascontiguousarray(field)).hexdigest()
+
+    def save(self, path):
+        """Save fields to directory path. When saving to the path the fields were loaded
+        from, only write those that have changed. Otherwise, write all of them, copying
+        the ones that were never loaded. Replace any .npy spikes file at path"""
+        samepath = (self.path is not None and
+                    os.path.abspath(path) == os.path.abspath(self.path))
+        if os.path.isfile(path):
+            os.remove(path) # .spike file in single struct array format
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        saved = []
+        for name in self.dtype.names:
+            fname = self.fname(path, name)
+            if name not in self.columns:
+                if not samepath:
+                    shutil.copyfile(self.fname(self.path, name), fname)
+                continue
+            field = self.columns[name]
+            h = self.hash(field)
+            if samepath and self.hashes[name] == h:
+                continue # unchanged
+            with open(fname + '.tmp', 'wb') as f:
+                np.save(f, field)
+            os.rename(fname + '.tmp', fname) # atomic on POSIX
+            self.hashes[name] = h
+            saved.append(name)
+        if not samepath:
+            index = {'nspikes': self.nspikes, 'dtype': self.dtype.descr}
+            with open(self.indexfname(path) + '.tmp', 'w') as f:
+                json.dump(index, f)
+            os.rename(self.indexfname(path) + '.tmp', self.indexfname(path))
+            self.path = path
+        print('Saved spike fields %r to %r' % (saved, path))
+
+
 class Sort(object):
     """A spike sorting session, in which you can detect spikes and sort them into Neurons.
     A .sort file is a single pickled Sort object"""
@@ -195,8 +585,9 @@ class Sort(object):
         # copy it cuz we'll be making changes, this is fast because it's just a shallow copy
         d = self.__dict__.copy()
         # Spikes and wavedata arrays are (potentially) saved separately.
-        # usids and PCs/ICs can be regenerated from the spikes array.
-        for attr in ['spikes', 'wavedata', 'usids', 'X', 'Xhash']:
+        # usids, PCs/ICs and spike param stats can be regenerated from the spikes array.
+        for attr in ['spikes', 'wavedata', 'wavemodified', 'usids', 'X', 'Xhash',
+                     'xcorrs', 'means', 'stds']:
             # keep _stream during normal pickling for multiprocessing, but remove it
             # manually when pickling to .sort
             try: del d[attr]
@@ -209,10 +600,55 @@ class Sort(object):
 
     nspikes = property(get_nspikes)
 
-    def update_usids(self):
-        """Update usids, which is an array of indices of unsorted spikes"""
-        nids = self.spikes['nid']
-        self.usids, = np.where(nids == 0) # 0 means unclustered
+    def get_paramstats(self, dim):
+        """Return mean and std of spike param dim across all spikes, for normalizing it.
+        These are cached until invalidated by self.invalidate_paramstats(), which must be
+        called whenever the spikes array or any of its param values change"""
+        try: self.means
+        except AttributeError: self.means = {}
+        try: self.stds
+        except AttributeError: self.stds = {}
+        if dim not in self.means:
+            data = self.spikes[dim]
+            self.means[dim] = data.mean()
+            self.stds[dim] = data.std()
+        return self.means[dim], self.stds[dim]
+
+    def invalidate_paramstats(self, dims=None):
+        """Forget cached means and stds of spike params in dims, or of all of them, so
+        that they're recalculated from the spikes array the next time they're needed"""
+        if dims is None:
+            self.means, self.stds = {}, {}
+            return
+        for dim in dims:
+            try:
+                del self.means[dim]
+                del self.stds[dim]
+            except (AttributeError, KeyError):
+                pass
+
+    def update_usids(self, sids=None):
+        """Update usids, which is a sorted array of indices of unsorted spikes. If sids is
+        given, only those spikes may have moved into or out of nid 0, and usids are updated
+        incrementally, without scanning all spikes. In that case, return the rows of the
+        old usids that were removed, and the rows of the new usids that were added"""
+        if sids is None:
+            nids = self.spikes['nid']
+            self.usids, = np.where(nids == 0) # 0 means unclustered
+            return
+        usids = self.usids
+        sids = np.unique(sids)
+        unsorted = self.spikes['nid'][sids] == 0
+        rows = usids.searchsorted(sids)
+        wasunsorted = rows < len(usids)
+        wasunsorted[wasunsorted] = usids[rows[wasunsorted]] == sids[wasunsorted]
+        rmrows = rows[wasunsorted & ~unsorted]
+        addsids = sids[unsorted & ~wasunsorted]
+        usids = np.delete(usids, rmrows)
+        addrows = usids.searchsorted(addsids)
+        self.usids = np.insert(usids, addrows, addsids)
+        addrows += np.arange(len(addrows)) # rows in new usids
+        return rmrows, addrows
 
     def get_spikes_sortedby(self, attr='id'):
         """Return array of all spikes, sorted by attribute 'attr'"""
@@ -248,9 +684,8 @@ class Sort(object):
 
     def get_mean_wave(self, sids, nid=None):
         """Return the mean and std waveform of spike waveforms in sids"""
-        spikes = self.spikes
         nsids = len(sids)
-        if nsids > MEANWAVEMAXSAMPLES:
+        if MEANWAVEMAXSAMPLES and nsids > MEANWAVEMAXSAMPLES:
             step = nsids // MEANWAVEMAXSAMPLES + 1 
             s = ("get_mean_wave() sampling every %d spikes instead of all %d"
                  % (step, nsids))
@@ -259,42 +694,173 @@ class Sort(object):
             print(s)
             sids = sids[::step]
             nsids = len(sids) # update
-    
-        chanss = spikes['chans'][sids]
-        nchanss = spikes['nchans'][sids]
-        chanslist = [ chans[:nchans] for chans, nchans in zip(chanss, nchanss) ] # list of arrays
-        chanpopulation = np.concatenate(chanslist)
-        groupchans = np.unique(chanpopulation) # comes out sorted
-    
-        wavedata = self.wavedata[sids]
-        if wavedata.ndim == 2: # should be 3, get only 2 if nsids == 1
-            wavedata.shape = 1, wavedata.shape[0], wavedata.shape[1] # give it a singleton 3rd dim
-        nt = wavedata.shape[-1]
-        maxnchans = len(groupchans)
-        data = np.zeros((maxnchans, nt))
-        # all spikes have same nt, but not necessarily same nchans, keep track of
-        # how many spikes contributed to each of the group's chans
-        nspikes = np.zeros((maxnchans, 1), dtype=int)
-        for chans, wd in zip(chanslist, wavedata):
-            chanis = groupchans.searchsorted(chans) # each spike's chans is a subset of groupchans
-            data[chanis] += wd[:len(chans)] # accumulate
-            nspikes[chanis] += 1 # inc spike count for this spike's chans
-        #t0 = time.time()
-        data /= nspikes # normalize all data points appropriately, this is now the mean
-        var = np.zeros((maxnchans, nt))
-        for chans, wd in zip(chanslist, wavedata):
-            chanis = groupchans.searchsorted(chans) # each spike's chans is a subset of groupchans
-            var[chanis] += (wd[:len(chans)] - data[chanis]) ** 2 # accumulate 2nd moment
-        var /= nspikes # normalize all data points appropriately, this is now the variance
-        std = np.sqrt(var)
-        # keep only those chans that at least 1/2 the spikes contributed to
-        bins = list(groupchans) + [sys.maxint] # concatenate rightmost bin edge
-        hist, bins = np.histogram(chanpopulation, bins=bins)
-        chans = groupchans[hist >= nsids/2]
-        chanis = groupchans.searchsorted(chans)
-        data = data[chanis]
-        std = std[chanis]
-        return WaveForm(data=data, std=std, chans=chans)
+        chans, counts, sums, sumsqs = self.get_wave_sums(sids)
+        return self.sums2wave(chans, counts, sums, sumsqs, nsids)
+
+    def get_wave_sums(self, sids):
+        """Return the chans of all spikes in sids, the number of spikes that include
+        each chan, and the sums and sums of squares of their waveforms on each chan.
+        Sums are exact int64, so they can later be added to and subtracted from without
+        any loss of precision. Spikes are gathered straight from self.wavedata in chunks,
+        so memory use doesn't grow with len(sids)"""
+        spikes = self.spikes
+        sids = np.asarray(sids, dtype=np.int64)
+        nt = self.wavedata.shape[-1]
+        nchanids = 2**8 # chan ids are uint8, sum over all possible ids, then trim
+        counts = np.zeros(nchanids, dtype=np.int64)
+        sums = np.zeros((nchanids, nt), dtype=np.int64)
+        sumsqs = np.zeros((nchanids, nt), dtype=np.int64)
+        ptr = np.zeros(nchanids+1, dtype=np.int64)
+        # 4 int64 indices per spike chan:
+        nbytesperspike = self.wavedata.shape[1] * 4 * 8
+        for chunkis in self.get_wavechunks(sids, nbytesperspike):
+            chunksids = sids[chunkis]
+            chanss = spikes['chans'][chunksids]
+            nchanss = spikes['nchans'][chunksids]
+            # indices into chunksids and into each spike's chans, for all valid chans:
+            sidis, chaniis = np.where(np.arange(chanss.shape[1]) < nchanss[:, None])
+            chans = chanss[sidis, chaniis]
+            # group (sid, chanii) pairs by chan, each chan's group is summed in parallel:
+            chunkcounts = np.bincount(chans, minlength=nchanids)
+            ptr[1:] = chunkcounts.cumsum()
+            groupis = chans.argsort(kind='mergesort')
+            util.wavedata_sums(self.wavedata, chunksids[sidis[groupis]], chaniis[groupis],
+                               ptr, sums, sumsqs)
+            counts += chunkcounts
+            self.release_wavedata(chunksids)
+        chans, = np.where(counts > 0) # comes out sorted
+        return np.uint8(chans), counts[chans], sums[chans], sumsqs[chans]
+
+    def sums2wave(self, chans, counts, sums, sumsqs, nsids):
+        """Return mean and std WaveForm from the output of get_wave_sums(). Keep only
+        those chans that at least 1/2 of the nsids spikes contributed to"""
+        keep = counts >= nsids/2
+        counts = counts[keep][:, None]
+        data = sums[keep] / counts # mean
+        var = sumsqs[keep] / counts - data**2 # population variance, like np.var()
+        std = np.sqrt(var.clip(min=0)) # clip any -ve roundoff error
+        return WaveForm(data=data, std=std, chans=chans[keep])
+
+    def get_match_errors(self, cids, sids):
+        """Return rmserror in AD units between the mean waveforms of neurons cids and
+        the waveforms of spikes sids, as a len(cids) x len(sids) sparse matrix. Only
+        comparable pairs are stored, i.e. where both share each other's maxchan. Pairs
+        are pruned spatially up front, by checking each spike's maxchan against each
+        neuron's chans, and the rest are calculated in parallel, chunk by chunk"""
+        spikes = self.spikes
+        sids = np.asarray(sids, dtype=np.int64)
+        ncids = len(cids)
+        nt = self.wavedata.shape[-1]
+        nchanids = 2**8 # chan ids are uint8, index template data by chan id
+        tdata = np.zeros((ncids, nchanids, nt), dtype=np.float32)
+        tmask = np.zeros((ncids, nchanids), dtype=np.uint8)
+        tchans = np.zeros(ncids, dtype=np.uint8)
+        for k, cid in enumerate(cids):
+            neuron = self.neurons[cid]
+            wave = neuron.get_wave()
+            tdata[k, wave.chans] = wave.data
+            tmask[k, wave.chans] = True
+            tchans[k] = neuron.chan
+        cidis, sidis, errs = [], [], []
+        # candidate mask and up to 5 int64s and a float32 per candidate pair:
+        nbytesperspike = ncids * (1 + 5*8 + 4)
+        for chunkis in self.get_wavechunks(sids, nbytesperspike):
+            chunksids = sids[chunkis]
+            # (chunkii, k) pairs where neuron k has the spike's maxchan, sorted by sid:
+            chunkiis, ks = np.where(tmask[:, spikes['chan'][chunksids]].T)
+            ks = np.ascontiguousarray(ks, dtype=np.int64)
+            chunkerrs = np.empty(len(ks), dtype=np.float32)
+            util.match_errors(self.wavedata, chunksids[chunkiis], ks, spikes['chans'],
+                              spikes['nchans'], tdata, tmask, tchans, chunkerrs)
+            comparable = chunkerrs >= 0
+            cidis.append(ks[comparable])
+            sidis.append(chunkis[chunkiis[comparable]])
+            errs.append(chunkerrs[comparable])
+            self.release_wavedata(chunksids)
+        if len(sids) == 0:
+            cidis, sidis, errs = [np.int64([])], [np.int64([])], [np.float32([])]
+        errs = scipy.sparse.csr_matrix((np.concatenate(errs),
+                                        (np.concatenate(cidis), np.concatenate(sidis))),
+                                       shape=(ncids, len(sids)))
+        return errs
+
+    def get_duplicate_sids(self, nids, minISI):
+        """Find all pairs of consecutive spikes of each of neurons nids that are no more
+        than minISI apart, and for each pair, pick the one to remove as a duplicate. Keep
+        whichever has the most chans in common with its neuron's template. If both have
+        the same number, keep the first one. Return an odict of arrays of sids to remove,
+        one per pair, indexed by nid, for only those nids with any duplicates, in order of
+        nids. All pairs are found in a single pass over the spike trains of all nids, and
+        only the spikes in them are compared to the templates"""
+        spikes = self.spikes
+        rmsidss = odict()
+        if len(nids) == 0:
+            return rmsidss
+        sidss = [ self.neurons[nid].sids for nid in nids ]
+        sids = np.concatenate(sidss).astype(np.int64)
+        gis = np.repeat(np.arange(len(nids)), [ len(nsids) for nsids in sidss ])
+        # index of the first spike of each pair that belongs to a single neuron:
+        pairis, = np.where((np.diff(spikes['t'][sids]) <= minISI) & (gis[1:] == gis[:-1]))
+        if len(pairis) == 0:
+            return rmsidss
+        pairgis = gis[pairis] # sorted, since neurons' sids are concatenated in order
+        dupgis = np.unique(pairgis)
+        tmask = np.zeros((len(nids), 2**8), dtype=bool) # template chans of each neuron
+        for gi in dupgis:
+            tmask[gi, self.neurons[nids[gi]].chans] = True
+        ncommons = []
+        for pairsids in [sids[pairis], sids[pairis+1]]:
+            chanss = spikes['chans'][pairsids]
+            valid = np.arange(chanss.shape[1]) < spikes['nchans'][pairsids][:, None]
+            ncommons.append((tmask[pairgis[:, None], chanss] & valid).sum(axis=1))
+        ncommon0, ncommon1 = ncommons
+        rmsids = np.where(ncommon0 >= ncommon1, sids[pairis+1], sids[pairis])
+        starts = pairgis.searchsorted(dupgis)
+        stops = pairgis.searchsorted(dupgis, side='right')
+        for gi, start, stop in zip(dupgis, starts, stops):
+            rmsidss[nids[gi]] = rmsids[start:stop]
+        return rmsidss
+
+    def get_xcorrs(self, nids, trange, nbins=XCORRNBINS):
+        """Return all auto and cross-correlograms of the spike trains of neurons nids, as
+        an (N, N, nbins) array of counts of spike times of neuron nids[j] relative to those
+        of neuron nids[i], and the nbins+1 bin edges spanning trange, in us. Results are
+        cached, keyed on the spike times of each of nids, which the correlograms depend on
+        entirely, so changes to either their membership or their spike times (e.g. by
+        realignment) are never missed"""
+        trange = np.asarray(trange, dtype=np.int64)
+        h = hashlib.md5()
+        h.update(trange)
+        h.update(str(nbins).encode())
+        for nid in nids:
+            sids = self.neurons[nid].sids
+            h.update(str((nid, len(sids))).encode())
+            h.update(np.ascontiguousarray(self.spikes['t'][sids]))
+        key = h.hexdigest()
+        try:
+            self.xcorrs
+        except AttributeError:
+            self.xcorrs = odict() # key: counts, in order of least to most recently used
+        if key in self.xcorrs:
+            counts = self.xcorrs.pop(key)
+        else:
+            sidss = [ self.neurons[nid].sids for nid in nids ]
+            nspikess = np.array([ len(sids) for sids in sidss ], dtype=np.int64)
+            sids = np.concatenate(sidss)
+            cis = np.repeat(np.arange(len(nids), dtype=np.int64), nspikess)
+            # merge spike trains, stable so each cluster's spikes keep their order:
+            ts = self.spikes['t'][sids]
+            tsortis = ts.argsort(kind='mergesort')
+            ts, cis = ts[tsortis], cis[tsortis]
+            order = tsortis.argsort(kind='mergesort') # merged index of each spike in sids
+            ptr = np.concatenate([[0], nspikess.cumsum()])
+            counts = np.zeros((len(nids), len(nids), nbins), dtype=np.int64)
+            util.xcorrs(ts, cis, order, ptr, trange[0], trange[1], counts)
+            while len(self.xcorrs) >= XCORRCACHESIZE:
+                self.xcorrs.popitem(last=False) # evict least recently used
+        self.xcorrs[key] = counts # most recently used
+        edges = np.linspace(trange[0], trange[1], nbins+1)
+        return counts, edges
 
     def exportptcsfiles(self, basepath, sortpath):
         """Export spike data to binary .ptcs files under basepath, one file per recording"""
@@ -491,23 +1057,25 @@ class Sort(object):
     def exportspikewaves(self, sids, selchans, tis, fname, format):
         """Export spike waveform data of selected sids, selchans and tis to binary
         .spikes.zip file or text .spikes.csv file"""
+        sids = np.asarray(sids)
         nspikes = len(sids)
-        chans, chanslist = self.get_common_chans(sids, selchans)
+        chans = self.get_common_chans(sids, selchans)
         nchans = len(chans)
         ti0, ti1 = tis
         nt = ti1 - ti0
-        # fill in 3D data array:
         dtype = self.wavedata.dtype
-        data = np.zeros((nspikes, nchans, nt), dtype=dtype)
-        for sii, sid in enumerate(sids):
-            spikechans = chanslist[sii]
-            spikechanis = spikechans.searchsorted(chans)
-            data[sii] = self.wavedata[sid][spikechanis, ti0:ti1]
-        if format == 'text': # flatten timepoints of all chans into columns
-            data.shape = nspikes, nchans*nt
         stream = self.stream
         assert stream.kind == 'highpass' # should be the only type ever saved to self
         if format == 'binary':
+            # fill in 3D data array, backed by a temporary file if it's too big for memory.
+            # It's written to the compressed file in chunks:
+            if nspikes * nchans * nt * dtype.itemsize > WAVECHUNKMAXNBYTES:
+                out = np.memmap(tempfile.TemporaryFile(), dtype=dtype, mode='w+',
+                                shape=(nspikes, nchans*nt))
+            else:
+                out = None
+            data = self.get_wavedata_matrix(sids, chans, tis, dtype=dtype, out=out)
+            data = data.reshape(nspikes, nchans, nt)
             nids = self.spikes['nid'][sids]
             spiketimes = self.spikes['t'][sids]
             chanpos = stream.probe.siteloc_arr()
@@ -517,7 +1085,12 @@ class Sort(object):
                                     spiketimes=spiketimes, chans=chans, tis=tis,
                                     chanpos=chanpos, uVperAD=uVperAD)
         elif format == 'text':
-            np.savetxt(fname, data, fmt='%d', delimiter=',') # data should be int
+            # flatten timepoints of all chans into columns, write a chunk at a time:
+            with open(fname, 'w') as f:
+                for chunkis in self.get_wavechunks(sids, nchans*nt*dtype.itemsize,
+                                                   keeporder=True):
+                    data = self.get_wavedata_matrix(sids[chunkis], chans, tis, dtype=dtype)
+                    np.savetxt(f, data, fmt='%d', delimiter=',') # data should be int
         else:
             raise ValueError('unknown format: %r' % format)
         print('Exported %d spikes on chans=%r and tis=%r to %s'
@@ -589,7 +1162,7 @@ class Sort(object):
         ti0, ti1 = tis
         assert ti0 < ti1 <= nt
         nt = ti1 - ti0
-        chans, chanslist = self.get_common_chans(sids, chans)
+        chans = self.get_common_chans(sids, chans)
         nchans = len(chans)
         nspikes = len(sids)
         if nspikes < 2:
@@ -601,37 +1174,51 @@ class Sort(object):
         Xhash = self.get_Xhash(kind, sids, tis, chans, self.npcsperchan, norm)
         self.Xhash = Xhash # save as key to most recent component matrix in self.X
         try: self.X
-        except AttributeError: self.X = {} # init the dimension reduction cache attrib
-        if Xhash in self.X:
+        except AttributeError: self.X = XCache() # init the dimension reduction cache attrib
+        X = self.X.get(Xhash)
+        if X is not None:
             print('Cache hit, using cached %ss from tis=%r, chans=%r of %d spikes' %
                  (kind[:-1], list(tis), list(chans), nspikes))
-            return self.X[Xhash] # no need to recalculate
+            print('Dimension reduction cache: %s' % self.X.report())
+            return X # no need to recalculate
 
         print('Cache miss, (re)calculating %ss' % kind[:-1])
 
         # collect data between tis from chans from all spikes:
         print('Doing %s on tis=%r, chans=%r of %d spikes' %
              (kind, list(tis), list(chans), nspikes))
-        # MDP complains of roundoff errors with float32 for large covariance matrices
-        data = np.zeros((nspikes, nchans, nt), dtype=np.float64)
-        for sii, sid in enumerate(sids):
-            spikechans = chanslist[sii]
-            spikechanis = spikechans.searchsorted(chans)
-            spikedata = self.wavedata[sid][spikechanis, ti0:ti1]
-            if norm:
-                # normalize by Vpp of chan with max Vpp:
-                maxptp = spikedata.ptp(axis=1).max()
-                if maxptp != 0: # prevent div by 0
-                    spikedata = spikedata / maxptp
-            data[sii] = spikedata
-        print('Input shape for %s: %r' % (kind, data.shape))
+        # MDP complains of roundoff errors with float32 for large covariance matrices,
+        # everything else gets by with half the memory:
+        mdpinput = (kind == 'tSNE' or (kind == 'PCA' and PCALIB == 'mdp')
+                    or (kind == 'ICA' and ICALIB == 'mdp'))
+        dtype = np.float64 if mdpinput else np.float32
+        # fit to a stratified subsample of sids, then project all of them through the fit.
+        # tSNE has no way to project new points, the rest are interpolated instead:
+        if kind == 'tSNE':
+            fitsids = self.get_fit_sids(sids, TSNEMAXNSPIKES)
+        else:
+            fitsids = self.get_fit_sids(sids)
+        nfit = len(fitsids)
+        if nfit < nspikes:
+            print('Fitting %s to %d of %d spikes' % (kind, nfit, nspikes))
+        def project(X, transform):
+            """Return X of fitsids if they're all the sids, otherwise project all sids
+            through the transform that was fit to fitsids"""
+            if nfit == nspikes:
+                return X
+            return self.project_components(transform, sids, chans, tis, norm, dtype)
+        # normalize by Vpp of chan with max Vpp, if norm. Timepoints of all chans are
+        # flattened into columns:
+        data = self.get_wavedata_matrix(fitsids, chans, tis, norm=norm, dtype=dtype)
+        print('Input shape for %s: %r' % (kind, (nfit, nchans, nt)))
         t0 = time.time()
-        data.shape = nspikes, nchans*nt # flatten timepoints of all chans into columns
         print('Reshaped input for %s: %r' % (kind, data.shape))
         if kind == 'PCA': # principal components analysis
             if PCALIB == 'mdp':
                 import mdp # delay as late as possible
-                X = mdp.pca(data, output_dim=5, svd=False) # svd=False is default
+                node = mdp.nodes.PCANode(output_dim=5, svd=False) # svd=False is default
+                X = node(data) # do both the fit and the transform, same as mdp.pca()
+                X = project(X, node.execute)
             elif PCALIB == 'sklearn':
                 # sklearn's PCA is about 8x slower than mdp.pca, I think because it
                 # doesn't tap into scipy.linalg.eig compiled code. RandomizedPCA is faster
@@ -639,6 +1226,7 @@ class Sort(object):
                 from sklearn.decomposition import PCA
                 pca = PCA(n_components=5)
                 X = pca.fit_transform(data) # do both the fit and the transform
+                X = project(X, pca.transform)
             else:
                 raise ValueError('invalid PCALIB %r' % PCALIB)
             if X.shape[1] < minncomp:
@@ -650,6 +1238,7 @@ class Sort(object):
             n_jobs = mp.cpu_count()
             spca = SparsePCA(n_components=n_components, alpha=alpha, n_jobs=n_jobs)
             X = spca.fit_transform(data) # do both the fit and the transform
+            X = project(X, spca.transform)
         elif kind == 'mbsPCA': # mini batch sparse principal components analysis
             from sklearn.decomposition import MiniBatchSparsePCA
             n_components = 5
@@ -657,28 +1246,49 @@ class Sort(object):
             n_jobs = mp.cpu_count()
             mbspca = MiniBatchSparsePCA(n_components=n_components, alpha=alpha, n_jobs=n_jobs)
             X = mbspca.fit_transform(data) # do both the fit and the transform
+            X = project(X, mbspca.transform)
         elif kind == 'NMF': # non-negative matrix factorization
             from sklearn.decomposition import NMF
             n_components = 5
             init = None # 'random', 'nndsvd', 'nndsvda', 'nndsvdar', 'custom'
             nmf = NMF(n_components=n_components, init=init)
             X = nmf.fit_transform(data) # do both the fit and the transform
+            X = project(X, nmf.transform)
         elif kind == 'tSNE': # t-distributed stochastic neighbor embedding
-            # limit number of PCs to feed into ICA, keep up to npcsperchan components per
+            # limit number of PCs to feed into tSNE, keep up to npcsperchan components per
             # chan on average:
-            ncomp = min((self.npcsperchan*nchans, data.shape[1]))
+            ncomp = min((self.npcsperchan*nchans, TSNEMAXNPCS, data.shape[1]))
             print('ncomp: %d' % ncomp)
             import mdp # delay as late as possible
-            # do PCA first, to reduce dimensionality and speed up ICA:
-            data = mdp.pca(data, output_dim=ncomp)
+            # do PCA first, to reduce dimensionality and speed up tSNE, and project all
+            # sids onto the PCs of fitsids:
+            pcanode = mdp.nodes.PCANode(output_dim=ncomp)
+            fitpcs = pcanode(data)
+            del data
+            pcs = project(fitpcs, pcanode.execute)
+            isfit = np.in1d(sids, fitsids)
+            # key of the most recent tSNE embedding with the same params but any sids:
+            warmhash = self.get_Xhash(kind, np.empty(0, dtype=np.int64), tis, chans,
+                                      self.npcsperchan, norm)
+            init = self.get_tsne_init(warmhash, sids, pcs, isfit)
             from sklearn.manifold import TSNE
             n_components = 3 # not suited for any more than 3, according to the paper
-            #init =  'random', 'pca'
-            tsne = TSNE(n_components=n_components)
-            X = tsne.fit_transform(data) # do both the fit and the transform
+            # Barnes-Hut approximation is O(N*log(N)) instead of O(N**2):
+            kwargs = dict(n_components=n_components, method='barnes_hut', angle=0.5)
+            if init is not None:
+                kwargs['init'] = init
+            tsne = TSNE(**kwargs)
+            X = np.empty((nspikes, n_components))
+            X[isfit] = tsne.fit_transform(fitpcs) # do both the fit and the transform
+            if nfit < nspikes:
+                # place the rest by interpolating between their nearest fit spikes:
+                nnpcs = slice(0, TSNENNMAXNPCS)
+                X[~isfit] = core.knn_interpolate(fitpcs[:, nnpcs], X[isfit],
+                                                 pcs[~isfit, nnpcs], k=TSNENNEIGHBOURS)
+            self.X.add(warmhash, X, np.asarray(sids)) # to warm start the next tSNE
         elif kind == 'ICA': # independent components analysis
-            # ensure nspikes >= ndims**2 for good ICA convergence
-            maxncomp = intround(np.sqrt(nspikes))
+            # ensure nfit >= ndims**2 for good ICA convergence
+            maxncomp = intround(np.sqrt(nfit))
             if maxncomp < minncomp:
                 raise RuntimeError("can't satisfy minncomp=%d request" % minncomp)
             if data.shape[0] <= data.shape[1]:
@@ -690,13 +1300,15 @@ class Sort(object):
                 import mdp # delay as late as possible
                 # do PCA first, to reduce dimensionality and speed up ICA:
                 print('ncomp: %d' % ncomp)
-                data = mdp.pca(data, output_dim=ncomp)
+                pcanode = mdp.nodes.PCANode(output_dim=ncomp)
+                data = pcanode(data)
                 # nonlinearity g='pow3', ie x**3. tanh seems to separate better,
                 # but is a bit slower. gaus seems to be slower still, and no better
                 # than tanh, but these are just vague impressions.
                 # defaults to whitened=False, ie assumes data isn't whitened
                 node = mdp.nodes.FastICANode(g='pow3')
                 X = node(data)
+                X = project(X, lambda chunk: node.execute(pcanode.execute(chunk)))
                 pm = node.get_projmatrix()
                 X = X[:, np.any(pm, axis=0)] # keep only the non zero columns
             elif ICALIB == 'sklearn':
@@ -716,6 +1328,7 @@ class Sort(object):
                                   max_iter=maxiter, tol=tol, w_init=None,
                                   random_state=None)
                 X = fastica.fit_transform(data) # do both the fit and the transform
+                X = project(X, fastica.transform)
                 #pm = fastica.components_
                 print('fastica niters: %d' % (fastica.n_iter_))
             else:
@@ -761,14 +1374,13 @@ class Sort(object):
         else:
             raise ValueError('unknown kind %r' % kind)
         print('Output shape for %s: %r' % (kind, X.shape))
-        self.X[Xhash] = X # cache for fast future retrieval
+        self.X.add(Xhash, X, np.asarray(sids)) # cache for fast future retrieval
+        print('Dimension reduction cache: %s' % self.X.report())
         print('%s took %.3f sec' % (kind, time.time()-t0))
         unids = list(np.unique(spikes['nid'][sids])) # set of all nids that sids span
-        for nid in unids:
-            # don't update pos of junk cluster, if any, since it might not have any chans
-            # common to all its spikes, and therefore can't have PCA/ICA done on it
-            if nid != 0:
-                self.clusters[nid].update_comppos(X, sids)
+        # don't update pos of junk cluster, if any, since it might not have any chans
+        # common to all its spikes, and therefore can't have PCA/ICA done on it:
+        update_compposs([ self.clusters[nid] for nid in unids if nid != 0 ], X, sids)
         return X
 
     def get_rms_error(self, sids, tis=None, chans=None):
@@ -787,49 +1399,230 @@ class Sort(object):
         ti0, ti1 = tis
         assert ti0 < ti1 <= nt
         nt = ti1 - ti0
-        chans, chanslist = self.get_common_chans(sids, chans)
+        chans = self.get_common_chans(sids, chans)
         nchans = len(chans)
         nspikes = len(sids)
         if nchans == 0:
             raise RuntimeError("Spikes have no common chans for RMS error")
 
-        # collect data between tis from chans from all spikes:
         print('Getting RMS error on tis=%r, chans=%r of %d spikes' %
              (list(tis), list(chans), nspikes))
-        data = np.zeros((nspikes, nchans, nt), dtype=np.float64)
-        for sii, sid in enumerate(sids):
-            spikechans = chanslist[sii]
-            spikechanis = spikechans.searchsorted(chans)
-            data[sii] = self.wavedata[sid][spikechanis, ti0:ti1]
 
         # get cluster mean waveform between tis on chans:
         wave = self.neurons[nid].get_wave()
         chanis = wave.chans.searchsorted(chans)
-        meandata = np.float64(wave.data[chanis, ti0:ti1])
-
-        # calculate RMS error between each spike and the cluster mean waveform:
-        se = (data - meandata) ** 2 # squared error
-        # take mean across timepoints and chans, but not across spikes:
-        mse = se.mean(axis=2).mean(axis=1) # mean squared error
+        meandata = np.float32(wave.data[chanis, ti0:ti1]).ravel()
+
+        sids = np.asarray(sids)
+        mse = np.empty(nspikes) # mean squared error of each spike
+        for chunkis in self.get_wavechunks(sids, nbytesperspike=nchans*nt*4):
+            # collect data between tis from chans from chunk of spikes, flattened chan by
+            # chan:
+            data = self.get_wavedata_matrix(sids[chunkis], chans, tis)
+            # calculate RMS error between each spike and the cluster mean waveform,
+            # in place:
+            data -= meandata
+            data **= 2 # squared error
+            # take mean across timepoints and chans, but not across spikes:
+            mse[chunkis] = data.mean(axis=1, dtype=np.float64)
         return np.sqrt(mse)
 
     def get_common_chans(self, sids, chans=None):
-        """Find channels common to all sids, and optionally to chans as well. Also,
-        return chanslist, ie list of arrays of chans of sids"""
+        """Find channels common to all sids, and optionally to chans as well"""
         spikes = self.spikes
+        nspikes = len(sids)
+        if nspikes == 0:
+            raise ValueError("Can't find common chans of 0 spikes")
         chanss = spikes['chans'][sids]
         nchanss = spikes['nchans'][sids]
-        #t0 = time.time()
-        chanslist = [ cs[:ncs] for cs, ncs in zip(chanss, nchanss) ] # list of arrays
-        #print('Building chanslist took %.3f sec' % (time.time()-t0))
-        commonchans = util.intersect1d_uint8(chanslist) # find intersection
+        # each spike's chans are unique, so a chan is common to all sids iff it shows up
+        # nspikes times in their valid (non-padding) chans:
+        valid = np.arange(chanss.shape[1]) < nchanss[:, None]
+        counts = np.bincount(chanss[valid], minlength=256)
+        commonchans = np.uint8(np.where(counts == nspikes)[0])
         if chans is not None and len(chans) > 0:
             # values in chans but not in commonchans:
             diffchans = np.setdiff1d(chans, commonchans)
             commonchans = np.intersect1d(chans, commonchans) # values in both
             if len(diffchans) > 0:
                 print('WARNING: ignored chans %r not common to all spikes' % list(diffchans))
-        return commonchans, chanslist
+        return commonchans
+
+    def get_wavechunks(self, sids, nbytesperspike=0, nconcurrent=1, keeporder=False):
+        """Split sids into chunks to access wavedata in, such that nconcurrent chunks of
+        wavedata rows plus nbytesperspike of data derived from each row fit in
+        WAVECHUNKMAXNBYTES. Return a list of index arrays into sids. Chunks go in order of
+        sid, i.e. in temporal order, which is also file order for memmapped wavedata,
+        unless keeporder, in which case they're consecutive runs of sids as given.
+        Each row of memmapped wavedata is counted as at least a page, since that's how
+        much accessing it maps into memory"""
+        sids = np.asarray(sids)
+        rownbytes = int(np.prod(self.wavedata.shape[1:])) * self.wavedata.itemsize
+        if isinstance(self.wavedata, np.memmap):
+            rownbytes = max(rownbytes, mmap.PAGESIZE)
+        chunksize = max(WAVECHUNKMAXNBYTES // nconcurrent // (rownbytes + nbytesperspike), 1)
+        if keeporder or (np.diff(sids) >= 0).all():
+            sidis = np.arange(len(sids))
+        else:
+            sidis = sids.argsort(kind='mergesort')
+        return [ sidis[i0:i0+chunksize] for i0 in range(0, len(sids), chunksize) ]
+
+    def release_wavedata(self, sids):
+        """Release the pages of memmapped wavedata spanned by sorted sids, except for rows
+        that have been modified in memory, so that working through all of a big .wave
+        file doesn't keep all of it in memory"""
+        wavedata = self.wavedata
+        if not isinstance(wavedata, np.memmap) or len(sids) == 0:
+            return
+        row0, row1 = sids[0], sids[-1] + 1
+        try:
+            modified = self.wavemodified[row0:row1]
+        except AttributeError:
+            modified = None
+        if wavedata.mode != 'c' or modified is None:
+            core.releasememmaprows(wavedata, row0, row1)
+            return
+        # release each run of unmodified rows:
+        edges = np.diff(np.int8(np.concatenate([[True], modified, [True]])))
+        starts, = np.where(edges == -1)
+        stops, = np.where(edges == 1)
+        for start, stop in zip(starts, stops):
+            core.releasememmaprows(wavedata, row0+start, row0+stop)
+
+    def update_wavemodified(self, sids, modified=True):
+        """Mark rows of copy-on-write memmapped wavedata as (un)modified. Modified rows
+        exist only in memory until they're written back to the .wave file, and must
+        therefore never be released"""
+        if not isinstance(self.wavedata, np.memmap) or self.wavedata.mode != 'c':
+            return
+        try:
+            self.wavemodified
+        except AttributeError:
+            self.wavemodified = np.zeros(len(self.wavedata), dtype=bool)
+        self.wavemodified[sids] = modified
+
+    def save_wavedata(self, f, progress=None):
+        """Save wavedata to open file f in .npy format, a chunk of rows at a time, so that
+        memmapped wavedata doesn't have to be in memory all at once. progress, if given,
+        is called with the number of bytes written after each chunk"""
+        wavedata = self.wavedata
+        header = np.lib.format.header_data_from_array_1_0(wavedata)
+        np.lib.format.write_array_header_1_0(f, header)
+        sids = np.arange(len(wavedata))
+        for chunkis in self.get_wavechunks(sids):
+            i0, i1 = chunkis[0], chunkis[-1] + 1
+            wavedata[i0:i1].tofile(f)
+            self.release_wavedata(sids[i0:i1])
+            if progress:
+                progress(wavedata[i0:i1].nbytes)
+
+    def get_wavedata_matrix(self, sids, chans, tis, norm=False, dtype=np.float32,
+                            out=None):
+        """Gather wavedata of sids on chans between tis into a 2D (nspikes, nchans*nt)
+        matrix, timepoints of all chans flattened into columns. If norm, normalize each
+        spike by the Vpp of its chan with max Vpp. All sids must have all chans. out can
+        be a preallocated matrix, e.g. an np.memmap for out-of-core use, which is filled
+        in chunks of temporally ordered spikes"""
+        spikes = self.spikes
+        sids = np.ascontiguousarray(sids, dtype=np.int64) # copy only if necessary
+        chans = np.ascontiguousarray(chans, dtype=np.uint8)
+        ti0, ti1 = tis
+        nspikes, nchans, nt = len(sids), len(chans), ti1 - ti0
+        if out is None:
+            out = np.empty((nspikes, nchans*nt), dtype=dtype)
+        assert out.shape == (nspikes, nchans*nt)
+        assert out.flags.c_contiguous
+        ordered = (np.diff(sids) >= 0).all()
+        # unordered sids are gathered into a temporary chunk before being scattered to out:
+        nbytesperspike = 0 if ordered else nchans * nt * out.itemsize
+        for chunkis in self.get_wavechunks(sids, nbytesperspike):
+            chunksids = sids[chunkis]
+            if ordered:
+                chunkout = out[chunkis[0]:chunkis[-1]+1]
+            else:
+                chunkout = np.empty((len(chunkis), nchans*nt), dtype=out.dtype)
+            nmissing = util.gather_wavedata(self.wavedata, chunksids, spikes['chans'],
+                                            spikes['nchans'], chans, ti0, ti1, norm,
+                                            chunkout)
+            if nmissing > 0:
+                raise RuntimeError("%d spikes don't have all of chans %r"
+                                   % (nmissing, list(chans)))
+            if not ordered:
+                out[chunkis] = chunkout
+            self.release_wavedata(chunksids)
+        return out
+
+    def get_fit_sids(self, sids, maxnspikes=None):
+        """Return a random subsample of at most about maxnspikes of sids (default
+        COMPFITMAXNSPIKES) to fit dimension reduction to, stratified by nid and maxchan, so
+        that every cluster and chan is represented in proportion to its number of spikes,
+        by at least 1 spike. The subsample is deterministic for a given set of sids, and
+        keeps their order"""
+        if maxnspikes is None:
+            maxnspikes = COMPFITMAXNSPIKES
+        sids = np.asarray(sids)
+        nspikes = len(sids)
+        if maxnspikes is None or nspikes <= maxnspikes:
+            return sids
+        spikes = self.spikes
+        strata = np.int64(spikes['nid'][sids]) * 256 + spikes['chan'][sids]
+        ustrata, stratais, counts = np.unique(strata, return_inverse=True,
+                                              return_counts=True)
+        nsample = np.maximum(np.int64(np.round(counts * (maxnspikes / nspikes))), 1)
+        # randomly rank spikes within each stratum, keep the first nsample in each:
+        rng = np.random.RandomState(0)
+        order = np.lexsort((rng.random_sample(nspikes), stratais))
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        ranks = np.empty(nspikes, dtype=np.int64)
+        ranks[order] = np.arange(nspikes) - starts[stratais[order]]
+        return sids[ranks < nsample[stratais]]
+
+    def get_tsne_init(self, warmhash, sids, pcs, isfit):
+        """Return initial tSNE embedding of sids[isfit] from the cached embedding at
+        warmhash of a previous selection, if enough of them were in it. Otherwise, return
+        None. Fit sids that weren't are placed by interpolating between their nearest
+        neighbours in PC space that were"""
+        try: prevX, prevsids = self.X.entry(warmhash)
+        except KeyError: return None
+        fitsids, fitpcs = np.asarray(sids)[isfit], pcs[isfit]
+        sortis = prevsids.argsort()
+        previs = sortis[prevsids.searchsorted(fitsids, sorter=sortis).clip(max=len(sortis)-1)]
+        found = prevsids[previs] == fitsids
+        if found.mean() < TSNEWARMMINOVERLAP:
+            return None
+        print('Warm starting tSNE from previous embedding of %d of %d spikes'
+              % (found.sum(), len(fitsids)))
+        init = np.empty((len(fitsids), prevX.shape[1]))
+        init[found] = prevX[previs[found]]
+        if not found.all():
+            nnpcs = slice(0, TSNENNMAXNPCS)
+            init[~found] = core.knn_interpolate(fitpcs[found, nnpcs], init[found],
+                                                fitpcs[~found, nnpcs], k=TSNENNEIGHBOURS)
+        return init
+
+    def project_components(self, transform, sids, chans, tis, norm=False,
+                           dtype=np.float32):
+        """Project wavedata of sids on chans between tis through transform, fit elsewhere.
+        Chunks of temporally ordered spikes are gathered and projected in parallel
+        threads, so only about one chunk per thread is ever held in memory"""
+        sids = np.asarray(sids)
+        nspikes = len(sids)
+        nthreads = mp.cpu_count()
+        nbytesperspike = len(chans) * (tis[1] - tis[0]) * np.dtype(dtype).itemsize
+        chunks = self.get_wavechunks(sids, nbytesperspike, nconcurrent=nthreads)
+        def projectchunk(chunkis):
+            data = self.get_wavedata_matrix(sids[chunkis], chans, tis, norm=norm,
+                                            dtype=dtype)
+            return transform(data)
+        t0 = time.time()
+        pool = ThreadPool(min(nthreads, len(chunks)))
+        Xs = pool.map(projectchunk, chunks)
+        pool.close()
+        X = np.empty((nspikes, Xs[0].shape[1]), dtype=Xs[0].dtype)
+        for chunkis, chunkX in zip(chunks, Xs):
+            X[chunkis] = chunkX
+        print('Projecting %d spikes took %.3f sec' % (nspikes, time.time()-t0))
+        return X
 
     def get_Xhash(self, kind, sids, tis, chans, npcsperchan, norm):
         """Return MD5 hex digest of args, for uniquely identifying the matrix resulting
@@ -839,9 +1632,12 @@ class Sort(object):
         h.update(sids)
         h.update(tis)
         h.update(chans)
-        if kind == 'ICA': # consider npcsperchan only if doing ICA
+        if kind in ['ICA', 'tSNE']: # consider npcsperchan only if doing ICA or tSNE
             h.update(str(npcsperchan).encode())
         h.update(str(norm).encode())
+        maxnfit = TSNEMAXNSPIKES if kind == 'tSNE' else COMPFITMAXNSPIKES
+        if maxnfit is not None and len(sids) > maxnfit:
+            h.update(str(maxnfit).encode()) # fit to a subsample
         return h.hexdigest()
 
     def create_neuron(self, id=None, inserti=None):
@@ -872,9 +1668,10 @@ class Sort(object):
         """Shift sid waveforms by nt timepoints: -ve shifts waveforms left, +ve shifts right.
         For speed, pad waveforms with edge values at the appropriate end"""
         spikes = self.spikes
-        wd = self.wavedata
-        for sid in sids: # maybe there's a more efficient way than iterating over sids
-            core.shiftpad(wd[sid], nt) # modifies wd in-place
+        sids = np.ascontiguousarray(sids, dtype=np.int64)
+        shifts = np.tile(np.int64(nt), len(sids))
+        util.shift_wavedata(self.wavedata, sids, shifts, 1) # modifies wavedata in-place
+        self.update_wavemodified(sids)
         # update spike parameters:
         dt = intround(nt * self.tres) # amount of time to shift by, signed, in us
         # so we can later reload the wavedata accurately, shifting the waveform right and
@@ -883,6 +1680,7 @@ class Sort(object):
         spikes['t'][sids] -= dt
         spikes['t0'][sids] -= dt
         spikes['t1'][sids] -= dt
+        self.invalidate_paramstats(['t'])
         # might result in some out of bounds tis because the original peaks
         # have shifted off the ends. Opposite sign wrt timepoints above, referencing within
         # wavedata:
@@ -891,101 +1689,94 @@ class Sort(object):
         # subtracting an int from an unsigned int:
         #spikes['tis'][sid] += nt
         # caller should treat all sids as dirty
-    '''
-    # replaced by util.alignbest_cy():
-    def alignbest(self, sids, tis, chans):
-        """Align all sids between tis on chans by best fit according to mean squared error.
-        chans are assumed to be a subset of channels of sids. Return sids
-        that were actually moved and therefore need to be marked as dirty"""
+    def alignbest(self, sids, tis, chans, maxshift=ALIGNMAXSHIFT, interp=ALIGNINTERP):
+        """Align all sids between tis on chans by best fit to their mean waveform according
+        to sum of squared errors, trying shifts of up to +/- maxshift timepoints in steps
+        of 1/interp timepoints. Shifts of less than a timepoint interpolate linearly. chans
+        are assumed to be a subset of channels of sids. Shift wavedata and update time
+        values of sids in place, the latter rounded to the nearest timepoint. Return sids
+        that were actually moved and therefore need to be marked as dirty, and the shift
+        of each of sids, in timepoints"""
         spikes = self.spikes
+        sids = np.ascontiguousarray(sids, dtype=np.int64)
+        chans = np.ascontiguousarray(chans, dtype=np.uint8)
         nspikes = len(sids)
-        nchans = len(chans)
-        wd = self.wavedata
-        nt = wd.shape[2] # num timepoints in each waveform
         ti0, ti1 = tis
         subnt = ti1 - ti0 # num timepoints to slice from each waveform
-        # TODO: make maxshift a f'n of interpolation factor
-        maxshift = 2 # shift +/- this many timepoints
-        subntdiv2 = subnt // 2
-        #print('subntdiv2 on either side of t=0: %d' % subntdiv2)
-        if subntdiv2 < maxshift:
+        if subnt // 2 < maxshift:
             raise ValueError("Selected waveform duration too short")
-        #maxshiftus = maxshift * self.stream.tres
-        # NOTE: in this case, it may be faster to keep shifts and sti0s and sti1s as lists
-        # of ints instead of np int arrays, maybe because their values are faster to iterate
-        # over or index with in python loops and lists:
-        shifts = range(-maxshift, maxshift+1) # from -maxshift to maxshift, inclusive
-        nshifts = len(shifts)
-        sti0s = [ ti0+shifti for shifti in range(nshifts) ] # shifted ti0 values
-        sti1s = [ ti1+shifti for shifti in range(nshifts) ] # shifted ti1 values
-        sti0ssti1s = zip(sti0s, sti1s)
-        print("Padding waveforms with up to +/- %d points of fake data" % maxshift)
-
-        # not worth subsampling here while calculating meandata, since all this
-        # stuff in this loop is needed in the shift loop below
-        subsd = np.zeros((nspikes, nchans, subnt), dtype=wd.dtype) # subset of spike data
-        spikechanis = np.zeros((nspikes, nchans), dtype=np.int64)
-        t0 = time.time()
-        for sidi, sid in enumerate(sids):
-            spike = spikes[sid]
-            nspikechans = spike['nchans']
-            spikechans = spike['chans'][:nspikechans]
-            spikechanis[sidi] = spikechans.searchsorted(chans)
-            subsd[sidi] = wd[sid, spikechanis[sidi], ti0:ti1]
-        print('Mean prep loop for best shift took %.3f sec' % (time.time()-t0))
+        print("Padding waveforms with up to +/- %d points of edge data" % maxshift)
         t0 = time.time()
-        meandata = subsd.mean(axis=0) # float64
-        print('Mean for best shift took %.3f sec' % (time.time()-t0))
-
-        # choose best shifted waveform for each spike
-        # widesd holds current spike data plus padding on either side
-        # to allow for full width slicing for all time shifts:
-        maxnchans = spikes['nchans'].max() # of all spikes in sort
-        widesd = np.zeros((maxnchans, maxshift+nt+maxshift), dtype=wd.dtype)        
-        shiftedsubsd = subsd.copy() # init
-        tempsubshifts = np.zeros((nshifts, nchans, subnt), dtype=wd.dtype)
-        dirtysids = []
-        t0 = time.time()
-        for sidi, sid in enumerate(sids):
-            # for speed, instead of adding real data, pad start and end with fake values
-            chanis = spikechanis[sidi]
-            sd = wd[sid] # sid's spike data
-            widesd[:, maxshift:-maxshift] = sd # 2D
-            widesd[:, :maxshift] = sd[:, 0, None] # pad start with first point per chan
-            widesd[:, -maxshift:] = sd[:, -1, None] # pad end with last point per chan
-            wideshortsd = widesd[chanis] # sid's padded spike data on chanis, 2D
-
-            # keep this inner loop as fast as possible:
-            for shifti, (sti0, sti1) in enumerate(sti0ssti1s):
-                tempsubshifts[shifti] = wideshortsd[:, sti0:sti1] # len: subnt
-            
-            errors = tempsubshifts - meandata # (nshifts, nchans, subnt) - (nchans, subnt)
-            # get sum squared errors by taking sum across highest two dims - for purpose
-            # of error comparison, don't need to take mean or square root. Also, order
-            # of summation along axes doesn't matter, as long as it's done on the highest two:
-            sserrors = (errors**2).sum(axis=2).sum(axis=1) # nshifts long
-            bestshifti = sserrors.argmin()
-            bestshift = shifts[bestshifti]
-            if bestshift != 0: # no need to update sort.wavedata[sid] if there's no shift
-                # update time values:
-                dt = bestshift * self.tres # time to shift by, signed, in us
-                spikes['t'][sid] += dt # should remain halfway between t0 and t1
-                spikes['t0'][sid] += dt
-                spikes['t1'][sid] += dt
-                # might result in some out of bounds tis because the original peaks
-                # have shifted off the ends. Opposite sign, referencing within wavedata:
-                spikes['tis'][sid] -= bestshift
-                # update sort.wavedata
-                wd[sid] = widesd[:, bestshifti:bestshifti+nt]
-                shiftedsubsd[sidi] = tempsubshifts[bestshifti]
-                dirtysids.append(sid) # mark sid as dirty
-        print('Shifting loop took %.3f sec' % (time.time()-t0))
+        meandata, stdevbefore = self.get_wavedata_meanstd(sids, chans, tis)
+        shifts = np.empty(nspikes, dtype=np.int64) # in 1/interp timepoints
+        sserrors0 = np.empty(nspikes, dtype=np.float64)
+        sserrors = np.empty(nspikes, dtype=np.float64)
+        # find and apply best shifts one chunk of temporally ordered spikes at a time:
+        for chunkis in self.get_wavechunks(sids, nbytesperspike=3*8):
+            chunksids = sids[chunkis]
+            chunkshifts = np.empty(len(chunkis), dtype=np.int64)
+            chunksserrors0 = np.empty(len(chunkis), dtype=np.float64)
+            chunksserrors = np.empty(len(chunkis), dtype=np.float64)
+            util.best_shifts(self.wavedata, chunksids, spikes['chans'], spikes['nchans'],
+                             chans, ti0, ti1, meandata, maxshift, interp,
+                             chunkshifts, chunksserrors0, chunksserrors)
+            shifts[chunkis] = chunkshifts
+            sserrors0[chunkis] = chunksserrors0
+            sserrors[chunkis] = chunksserrors
+            # no need to update wavedata of sids that aren't shifted:
+            moved = chunkshifts != 0
+            # best shifts are offsets to read wavedata at, shifting the waveform the other
+            # way:
+            util.shift_wavedata(self.wavedata, chunksids[moved], -chunkshifts[moved], interp)
+            self.update_wavemodified(chunksids[moved])
+            self.release_wavedata(chunksids)
+        moved = shifts != 0
+        dirtysids, dirtyshifts = sids[moved], shifts[moved]
+        # update time values by whole timepoints, keeping them on the sample grid and in
+        # step with tis. Any sub-timepoint remainder of a shift is only in the wavedata:
+        dtis = np.int64(np.round(dirtyshifts / interp))
+        dts = intround(dtis * self.tres) # signed, in us
+        spikes['t'][dirtysids] += dts
+        spikes['t0'][dirtysids] += dts
+        spikes['t1'][dirtysids] += dts
+        self.invalidate_paramstats(['t'])
+        # might give out of bounds tis because the original peaks have shifted off the
+        # ends. Use opposite sign because we're referencing within wavedata:
+        spikes['tis'][dirtysids] = spikes['tis'][dirtysids] - dtis[:, None, None]
+        print('Best fit alignment took %.3f sec' % (time.time()-t0))
+        # report per-spike shift stats:
+        shifts = shifts / interp # in timepoints
+        ushifts, counts = np.unique(shifts, return_counts=True)
+        print('Shifts (timepoints: nspikes): %s'
+              % ', '.join('%g: %d' % (us, c) for us, c in zip(ushifts, counts)))
+        print('Mean abs shift: %.3f timepoints' % np.abs(shifts).mean())
+        sse0, sse = sserrors0.sum(), sserrors.sum()
+        if sse0 > 0:
+            print('Sum squared error from mean went down by %.1f%%' % ((sse0-sse)/sse0*100))
+        stdevafter = self.get_wavedata_meanstd(sids, chans, tis)[1]
         AD2uV = self.converter.AD2uV
-        stdevbefore = AD2uV(subsd.std(axis=0).mean())
-        stdevafter = AD2uV(shiftedsubsd.std(axis=0).mean())
-        print('stdev went from %.3f to %.3f uV' % (stdevbefore, stdevafter))
-        return dirtysids
-    '''
+        print('stdev went from %.3f to %.3f uV' % (AD2uV(stdevbefore), AD2uV(stdevafter)))
+        return dirtysids, shifts
+
+    def get_wavedata_meanstd(self, sids, chans, tis):
+        """Return mean wavedata of sids on chans between tis, and its stdev across sids,
+        averaged over chans and timepoints. Gather a chunk of spikes at a time"""
+        sids = np.asarray(sids)
+        nspikes = len(sids)
+        ti0, ti1 = tis
+        nchans, nt = len(chans), ti1 - ti0
+        s = np.zeros(nchans*nt)
+        ss = np.zeros(nchans*nt)
+        # float32 data, and its float64 square:
+        for chunkis in self.get_wavechunks(sids, nbytesperspike=nchans*nt*(4+8)):
+            # int16 values are exact in float32, sum them up in float64:
+            data = self.get_wavedata_matrix(sids[chunkis], chans, tis)
+            s += data.sum(axis=0, dtype=np.float64)
+            ss += (np.float64(data)**2).sum(axis=0)
+        mean = s / nspikes
+        std = np.sqrt(np.maximum(ss / nspikes - mean**2, 0)) # clip roundoff error
+        return mean.reshape(nchans, nt), std.mean()
+
     def alignminmax(self, sids, to):
         """Align sids by their min or max. Return those that were actually moved
         and therefore need to be marked as dirty"""
@@ -1037,6 +1828,7 @@ class Sort(object):
         spikes['t'][sids] += dts
         spikes['t0'][sids] += dts
         spikes['t1'][sids] += dts
+        self.invalidate_paramstats(['t'])
         spikes['tis'][sids] = spikes['tis'][sids] + dtis[:, None, None] # update wrt new t0i
         spikes['aligni'][sids[alignis0]] = 1
         spikes['aligni'][sids[alignis1]] = 0
@@ -1045,11 +1837,13 @@ class Sort(object):
         self.reload_spikes(sids)
         return sids # mark all sids as dirty
 
-    def reload_spikes(self, sids, usemeanchans=False):
+    def reload_spikes(self, sids, usemeanchans=False, nprocesses=None):
         """Update wavedata of designated spikes from stream. Optionally fix incorrect
         time values from .sort 0.3 files. Optionally choose new set of channels for all
-        sids based on the chans closest to the mean of the sids. It's the caller's
-        responsibility to mark sids as dirty and trigger resaving of .wave file"""
+        sids based on the chans closest to the mean of the sids. Reloading is spread across
+        nprocesses, and can be cancelled with Ctrl+C. Return the sids that were reloaded.
+        It's the caller's responsibility to mark sids as dirty and trigger resaving of
+        .wave file"""
         nsids = len(sids)
         print('(Re)loading %d spikes' % nsids)
         stream = self.stream
@@ -1060,7 +1854,6 @@ class Sort(object):
         ver_lte_03 = float(self.__version__) <= 0.3
         if ver_lte_03:
             print('Fixing potentially wrong time values during spike reloading')
-            nfixed = 0
         treload = time.time()
         if usemeanchans:
             if ver_lte_03:
@@ -1087,73 +1880,123 @@ class Sort(object):
             assert nmeanchans == det.maxnchansperspike
             assert maxchan in meanchans
 
-        # split up sids into groups efficient for loading from stream:
-        ts = spikes[sids]['t'] # noncontig, not a copy
-        # ensure they're in temporal order:
+            # update spikes array entries of all sids with meanchans, using the max num
+            # chans, so assign the full array:
+            spikes['nchans'][sids] = nmeanchans
+            spikes['chans'][sids] = meanchans
+            self.invalidate_paramstats(['nchans'])
+            # check that each spike's maxchan is in meanchans, and if not, replace
+            # furthestchan with spike's maxchan:
+            outsids = sids[~np.in1d(spikes['chan'][sids], meanchans)]
+            if len(outsids) > 0:
+                print("%d spikes: replacing furthestchan %d with spike's maxchan"
+                      % (len(outsids), furthestchan))
+                chanss = np.tile(meanchans, (len(outsids), 1))
+                chanss[:, furthestchani] = spikes['chan'][outsids]
+                chanss.sort(axis=1) # make sure chans remain sorted
+                spikes['chans'][outsids] = chanss
+
+        # ensure sids are in temporal order:
+        ts = spikes['t'][sids]
         if not (np.diff(ts) >= 0).all():
             print("reload_spikes(): sids aren't in temporal order, might slow things down "
                   "or cause indexing problems, sorting by time...")
-            tsis = ts.argsort()
-            sids = sids[tsis]
+            sids = sids[ts.argsort()]
             print("Done sorting sids by time")
-        MAXISI = 100000 # us (100 ms)
-        MAXGROUPDT = 100000000 # us (100 s)
-        # break up spikes by ISIs >= MAXISI:
-        splitis = np.where(np.diff(ts) >= MAXISI)[0] + 1
-        groups = np.split(sids, splitis)
-        # limit each group of sids to no more than MAXGROUPDT:
-        groupi = 0
-        while groupi < len(groups):
-            group = groups[groupi] # group of sids all with ISIs < MAXISI
-            ## TODO: not a copy: is this the optimal way to get the times in this case?
-            relts = spikes[group]['t'] - spikes[group[0]]['t']
-            splitis = np.where(np.diff(relts // MAXGROUPDT) > 0)[0] + 1
-            nsubgroups = len(splitis) + 1
-            if nsubgroups > 1:
-                # del original group, replace with subgroups
-                del groups[groupi]
-                subgroups = np.split(group, splitis)
-                groups[groupi:groupi] = subgroups
-                groupi += len(subgroups)
-            else:
-                groupi += 1
+        groups = self.get_reload_groups(sids)
         print('ngroups: %d' % len(groups))
+        if ver_lte_03:
+            self.reload_groups_0_3(groups)
+            sids = np.sort(sids)
+        else:
+            sids = self.reload_groups(groups, nprocesses=nprocesses)
+        self.update_wavemodified(sids)
+        print('(Re)loaded %d spikes, took %.3f sec' % (len(sids), time.time()-treload))
+        return sids
 
-        # process each group:
+    def get_reload_groups(self, sids):
+        """Split up temporally ordered sids into groups efficient for loading from stream,
+        one stream call per group. Neighbouring spikes are coalesced into the same group
+        unless separated by an ISI >= RELOADMAXISI, and no group spans more than
+        RELOADMAXGROUPDT"""
+        spikes = self.spikes
+        ts = spikes['t'][sids]
+        # break up spikes by ISIs >= RELOADMAXISI:
+        splitis = np.where(np.diff(ts) >= RELOADMAXISI)[0] + 1
+        groupi0s = np.concatenate([[0], splitis])
+        # limit each group of sids to no more than RELOADMAXGROUPDT, by splitting it
+        # wherever its time relative to its start crosses a multiple of RELOADMAXGROUPDT:
+        relts = ts - np.repeat(ts[groupi0s], np.diff(np.append(groupi0s, len(sids))))
+        splitis = np.union1d(splitis,
+                             np.where(np.diff(relts // RELOADMAXGROUPDT) > 0)[0] + 1)
+        return np.split(sids, splitis)
+
+    def reload_groups(self, groups, nprocesses=None):
+        """Reload wavedata of groups of temporally ordered sids from stream. Groups are
+        distributed across a pool of processes, each with its own reopened copy of the
+        stream. Reloaded data is pickled back from the processes and written to wavedata
+        here, in this process, whether wavedata is in memory or memmapped copy-on-write.
+        Results are the same for any nprocesses. Ctrl+C cancels all groups not yet
+        reloaded. Return sorted sids that were reloaded"""
+        import tqdm
+        spikes, wavedata, stream = self.spikes, self.wavedata, self.stream
+        nt = wavedata.shape[2]
+        if nprocesses is None:
+            nprocesses = RELOADNPROCESSES or mp.cpu_count()
+        nprocesses = min(nprocesses, len(groups))
+        args = ( (spikes['t0'][group], spikes['t1'][group], spikes['nchans'][group],
+                  spikes['chans'][group]) for group in groups )
+        pool = None
+        if nprocesses > 1:
+            # send pickled copy of stream to each process:
+            pool = mp.Pool(nprocesses, reloadinitializer, (stream, nt))
+            # consume results in order as they come in, in chunks big enough to amortize
+            # interprocess overhead of many small groups, but small enough for progress:
+            chunksize = max(1, len(groups) // (nprocesses * 50))
+            results = pool.imap(callreloadgroup, args, chunksize=chunksize)
+        else:
+            results = ( reload_group(stream, nt, *arg) for arg in args )
+        reloadedgroups = []
+        pbar = tqdm.tqdm(total=sum(len(group) for group in groups), unit='spikes')
+        try:
+            for group, (data, nts) in zip(groups, results):
+                write_reloaded(wavedata, group, spikes['nchans'][group], data, nts)
+                reloadedgroups.append(group)
+                pbar.update(len(group))
+        except KeyboardInterrupt:
+            if pool:
+                pool.terminate()
+            print('Reloading cancelled, %d of %d groups reloaded'
+                  % (len(reloadedgroups), len(groups)))
+        else:
+            if pool:
+                pool.close()
+        finally:
+            pbar.close()
+            if pool:
+                pool.join()
+        if len(reloadedgroups) == 0:
+            return np.array([], dtype=np.int32)
+        return np.sort(np.concatenate(reloadedgroups))
+
+    def reload_groups_0_3(self, groups):
+        """Reload wavedata of groups of temporally ordered sids from stream, serially, while
+        fixing incorrect time values from .sort 0.3 files"""
+        spikes = self.spikes
+        stream = self.stream
+        nfixed = 0
         sidi = 0 # init sid index across all groups, used as status counter
         import tqdm
         for group in tqdm.tqdm(groups):
             assert len(group) > 0 # otherwise something went wrong above
-            t0 = spikes[group[0]]['t0']
-            t1 = spikes[group[-1]]['t1']
-            if ver_lte_03:
-                # load a little extra, in case we need to reload misaligned first and/or
-                # last spike in this group
-                t0 -= 5000 # -5 ms
-                t1 += 5000 # +5 ms
-            # Find union of chans of sids in this group, and ask stream for only those
-            # so that no unnecessary resampling on unneeded chans takes place.
-            # Note that this doesn't make a difference when CAR is enabled in the stream,
-            # because the full set of enabled channels have to be maintained in
-            # Stream.__call__ until the very end.
-            # Don't bother cutting out the correct nchans for each sid. At worst,
-            # chan 0 (the "empty" chans array value) will be unnecessarily added to
-            # unionchans, and we'll be retrieving one extra channel when creating tempwave,
-            # which will then later be discarded:
+            # load a little extra, in case we need to reload misaligned first and/or
+            # last spike in this group
+            t0 = spikes[group[0]]['t0'] - 5000 # -5 ms
+            t1 = spikes[group[-1]]['t1'] + 5000 # +5 ms
+            # see reload_group() for why unionchans of this group is loaded:
             unionchans = np.unique(spikes['chans'][group])
-            if usemeanchans:
-                # now that we have the original unionchans of this group,
-                # update this group's spikes array entries with meanchans:
-                spikes['nchans'][group] = nmeanchans
-                # we're using the max num chans, so assign the full array:
-                spikes['chans'][group] = meanchans
-                # now update unionchans as well:
-                unionchans = np.unique(np.hstack((unionchans, meanchans)))
             if 0 not in stream.chans: # if chan 0 is disabled in stream
-                # remove 0 from unionchans, otherwise an error would be raised when
-                # calling stream()
                 unionchans = unionchans[unionchans != 0]
-            # load and resample only what's needed for this group:
             tempwave = stream(t0, t1, unionchans)
             # slice out each spike's reloaded data from tempwave:
             for sid in group:
@@ -1162,84 +2005,63 @@ class Sort(object):
                     printflush(sidi, end='')
                 elif sidi % 1000 == 0:
                     printflush('.', end='')
-                if usemeanchans: # already checked above that ver_lte_03 == False
-                    # this spike's chans have been set to meanchans, now
-                    # check that each spike's maxchan is in meanchans:
-                    chan = spikes[sid]['chan']
-                    if chan not in meanchans:
-                        # replace furthest chan with spike's maxchan:
-                        print("spike %d: replacing furthestchan %d with spike's maxchan %d"
-                              % (sid, furthestchan, chan))
-                        nchans = spikes[sid]['nchans']
-                        chans = spikes[sid]['chans'][:nchans]
-                        # replace furthest chan with max chan, modifies spikes array in-place:
-                        chans[furthestchani] = chan
-                        # make sure chans remain sorted:
-                        chans.sort()
-                        # this isn't necessary, because all the above was in-place:
-                        #spikes['chans'][sid][:nchans] = chans
                 spike = spikes[sid]
                 nchans = spike['nchans']
                 chans = spike['chans'][:nchans]
                 rd = tempwave[spike['t0']:spike['t1']][chans].data # reloaded data
                 nt = rd.shape[1]
-
-                if ver_lte_03:
-                    """In sort.__version__ <= 0.3, t, t0, t1, and tis were not updated
-                    during alignbest() calls. To fix this, load new data with old potentially
-                    incorrect t0 and t1 values, and compare this new data to existing old data
-                    in wavedata array. Find where the non-repeating parts of the old data fits
-                    into the new, and calculate the correction needed to fix the time values.
-                    Finally, reload new data according to these corrected time values."""
-                    #print('reloading sid: %d' % sid)
-                    od = self.wavedata[sid, :nchans] # old data
-                    # indices that strip const values from left and right ends:
-                    lefti, righti = lrrep2Darrstripis(od)
-                    od = od[:, lefti:righti] # stripped old data
-                    # reloaded data rd uses old incorrect t0 and t1, but they should be
-                    # wide enough to encompass the non-repeating parts of the old data
-                    width = od.shape[1] # rolling window width
-                    if not width <= rd.shape[1]:
-                        print('') # newline
-                        print("WARNING: od.shape[1]=%d > rd.shape[1]=%d for sid %d" %
-                              (od.shape[1], rd.shape[1], sid))
-                        #import pdb; pdb.set_trace()
-                        sidi += 1 # inc status counter
-                        continue # rollwin2D won't work, skip to next sid
-                    odinndis = np.where(
-                               (rollwin2D(rd, width) == od).all(axis=1).all(axis=1))[0]
-                    if len(odinndis) == 0: # no hits of old data in new
-                        dnt = 0 # reload data based on current timepoints
-                    elif len(odinndis) == 1: # exactly 1 hit of old data in new
-                        odinndi = odinndis[0] # pull it out
-                        dnt = odinndi - lefti # num timepoints to correct by, signed
-                    else:
-                        raise RuntimeError("multiple hits of old data in new, don't know "
-                                           "how to reload spike %d" % sid)
-                    if dnt != 0:
-                        dt = intround(dnt * self.tres) # time to correct by, signed, in us
-                        spikes['t'][sid] += dt # should remain halfway between t0 and t1
-                        spikes['t0'][sid] += dt
-                        spikes['t1'][sid] += dt
-                        # might result in some out of bounds tis because the original peaks
-                        # have shifted off the ends. Use opposite sign because we're
-                        # referencing within wavedata:
-                        # in versions <= 0.3, 'tis' were named 'phasetis':
-                        spikes['phasetis'][sid] = spikes['phasetis'][sid] - dnt
-                        spike = spikes[sid]
-                        # reslice tempwave again now that t0 and t1 have changed
-                        rd = tempwave[spike['t0']:spike['t1']][chans].data
-                        nfixed += 1
-                        #printflush('F', end='')
-                # else: assume time values for all spikes are accurate
+                # In sort.__version__ <= 0.3, t, t0, t1, and tis were not updated
+                # during alignbest() calls. To fix this, load new data with old potentially
+                # incorrect t0 and t1 values, and compare this new data to existing old data
+                # in wavedata array. Find where the non-repeating parts of the old data fits
+                # into the new, and calculate the correction needed to fix the time values.
+                # Finally, reload new data according to these corrected time values.
+                #print('reloading sid: %d' % sid)
+                od = self.wavedata[sid, :nchans] # old data
+                # indices that strip const values from left and right ends:
+                lefti, righti = lrrep2Darrstripis(od)
+                od = od[:, lefti:righti] # stripped old data
+                # reloaded data rd uses old incorrect t0 and t1, but they should be
+                # wide enough to encompass the non-repeating parts of the old data
+                width = od.shape[1] # rolling window width
+                if not width <= rd.shape[1]:
+                    print('') # newline
+                    print("WARNING: od.shape[1]=%d > rd.shape[1]=%d for sid %d" %
+                          (od.shape[1], rd.shape[1], sid))
+                    #import pdb; pdb.set_trace()
+                    sidi += 1 # inc status counter
+                    continue # rollwin2D won't work, skip to next sid
+                odinndis = np.where(
+                           (rollwin2D(rd, width) == od).all(axis=1).all(axis=1))[0]
+                if len(odinndis) == 0: # no hits of old data in new
+                    dnt = 0 # reload data based on current timepoints
+                elif len(odinndis) == 1: # exactly 1 hit of old data in new
+                    odinndi = odinndis[0] # pull it out
+                    dnt = odinndi - lefti # num timepoints to correct by, signed
+                else:
+                    raise RuntimeError("multiple hits of old data in new, don't know "
+                                       "how to reload spike %d" % sid)
+                if dnt != 0:
+                    dt = intround(dnt * self.tres) # time to correct by, signed, in us
+                    spikes['t'][sid] += dt # should remain halfway between t0 and t1
+                    spikes['t0'][sid] += dt
+                    spikes['t1'][sid] += dt
+                    # might result in some out of bounds tis because the original peaks
+                    # have shifted off the ends. Use opposite sign because we're
+                    # referencing within wavedata:
+                    # in versions <= 0.3, 'tis' were named 'phasetis':
+                    spikes['phasetis'][sid] = spikes['phasetis'][sid] - dnt
+                    spike = spikes[sid]
+                    # reslice tempwave again now that t0 and t1 have changed
+                    rd = tempwave[spike['t0']:spike['t1']][chans].data
+                    nfixed += 1
+                    #printflush('F', end='')
 
                 self.wavedata[sid, :nchans, :nt] = rd # update wavedata
                 sidi += 1 # inc status counter
         print()
-
-        if ver_lte_03:
-            print('Fixed time values of %d spikes' % nfixed)
-        print('(Re)loaded %d spikes, took %.3f sec' % (len(sids), time.time()-treload))
+        print('Fixed time values of %d spikes' % nfixed)
+        self.invalidate_paramstats(['t'])
     '''
     def get_component_matrix(self, dims=None, weighting=None):
         """Convert spike param matrix into pca/ica data for clustering"""
@@ -1489,6 +2311,10 @@ class Neuron(object):
     """A collection of spikes that have been deemed somehow, whether manually
     or automatically, to have come from the same cell. A Neuron's waveform
     is the mean of its member spikes"""
+    # running (chans, counts, sums, sumsqs) of member spike waveforms, see
+    # Sort.get_wave_sums(). Class attrib provides default for old pickled neurons
+    wavesums = None
+
     def __init__(self, sort, id=None):
         self.sort = sort
         self.id = id # neuron id
@@ -1504,14 +2330,14 @@ class Neuron(object):
 
     def get_chans(self):
         if self.wave.data is None:
-            self.update_wave()
+            self.update_wave(rebuild=False)
         return self.wave.chans # self.chans just refers to self.wave.chans
 
     chans = property(get_chans)
 
     def get_chan(self):
         if self.wave.data is None:
-            self.update_wave()
+            self.update_wave(rebuild=False)
         return self.wave.chans[self.wave.data.ptp(axis=1).argmax()] # chan with max Vpp
 
     chan = property(get_chan)
@@ -1529,26 +2355,32 @@ class Neuron(object):
         #d.pop('Xhash', None)
         # don't save plot self is assigned to, since that'll change anyway on unpickle
         d['plt'] = None
+        # wavedata might change before unpickling, rebuild waveform sums when needed:
+        d['wavesums'] = None
         return d
 
     def get_wave(self):
         """Check for valid mean and std waveform before returning it"""
         # many neuron waveforms saved in old .sort files won't have a wave.std field
         try: self.wave.std
-        except AttributeError: return self.update_wave()
+        except AttributeError: return self.update_wave(rebuild=False)
         if self.wave == None or self.wave.data is None or self.wave.std is None:
-            return self.update_wave()
+            return self.update_wave(rebuild=False)
         else:
             return self.wave # return existing waveform
 
-    def update_wave(self):
-        """Update mean and std of self's waveform"""
+    def update_wave(self, rebuild=True):
+        """Update mean and std of self's waveform. Unless rebuild is set, use running
+        waveform sums of member spikes if available. Rebuild is required whenever
+        waveforms of member spikes have changed"""
         sort = self.sort
-        spikes = sort.spikes
         if len(self.sids) == 0: # no member spikes, perhaps I should be deleted?
             raise RuntimeError("neuron %d has no spikes and its waveform can't be updated"
                                % self.id)
-        meanwave = sort.get_mean_wave(self.sids, nid=self.id)
+        if rebuild or self.wavesums is None:
+            self.wavesums = sort.get_wave_sums(self.sids)
+        chans, counts, sums, sumsqs = self.wavesums
+        meanwave = sort.sums2wave(chans, counts, sums, sumsqs, len(self.sids))
 
         # update self's Waveform object
         self.wave.data = meanwave.data
@@ -1557,6 +2389,85 @@ class Neuron(object):
         self.wave.ts = sort.twts
         return self.wave
 
+    def add_sids(self, sids):
+        """Add sids to self's member spikes, keeping them sorted, and update waveform sums
+        to match, in time proportional to the number of new spikes"""
+        sids = np.unique(sids)
+        sidis = self.sids.searchsorted(sids)
+        if len(self.sids) > 0: # skip sids that are already members
+            new = self.sids[sidis.clip(max=len(self.sids)-1)] != sids
+            sids, sidis = sids[new], sidis[new]
+        self.sids = np.insert(self.sids, sidis, sids)
+        self.update_wavesums(sids, add=True)
+        self.wave.data = None # trigger template mean update
+
+    def remove_sids(self, sids):
+        """Remove sids from self's member spikes, and update waveform sums to match,
+        in time proportional to the number of removed spikes"""
+        sids = np.unique(sids)
+        sidis = self.sids.searchsorted(sids)
+        member = sidis < len(self.sids)
+        member[member] = self.sids[sidis[member]] == sids[member]
+        sids, sidis = sids[member], sidis[member]
+        self.sids = np.delete(self.sids, sidis)
+        self.update_wavesums(sids, add=False)
+        self.wave.data = None # trigger template mean update
+
+    def update_wavesums(self, sids, add=True):
+        """Add or subtract waveform sums of sids to or from self's running waveform sums.
+        Should be called right after adding sids to or removing them from self.sids"""
+        if self.wavesums is None or len(sids) == 0:
+            return # nothing to update, will be rebuilt when needed
+        if len(sids) >= len(self.sids):
+            # not worth it, rebuilding from scratch when needed will be faster:
+            self.wavesums = None
+            return
+        chans, counts, sums, sumsqs = self.wavesums
+        dchans, dcounts, dsums, dsumsqs = self.sort.get_wave_sums(sids)
+        allchans = np.union1d(chans, dchans)
+        # always make new arrays, in case old ones are still in use as donors:
+        nchans, nt = len(allchans), sums.shape[1]
+        newcounts = np.zeros(nchans, dtype=np.int64)
+        newsums = np.zeros((nchans, nt), dtype=np.int64)
+        newsumsqs = np.zeros((nchans, nt), dtype=np.int64)
+        chanis = allchans.searchsorted(chans)
+        newcounts[chanis], newsums[chanis], newsumsqs[chanis] = counts, sums, sumsqs
+        dchanis = allchans.searchsorted(dchans)
+        if add:
+            newcounts[dchanis] += dcounts
+            newsums[dchanis] += dsums
+            newsumsqs[dchanis] += dsumsqs
+        else:
+            newcounts[dchanis] -= dcounts
+            newsums[dchanis] -= dsums
+            newsumsqs[dchanis] -= dsumsqs
+        # chans that no member spikes use any more are dropped:
+        keep = newcounts > 0
+        self.wavesums = (allchans[keep], newcounts[keep], newsums[keep], newsumsqs[keep])
+
+    def inherit_wavesums(self, donors, donornids):
+        """Derive self's waveform sums from those of one of donors, a dict of (sids,
+        wavesums) tuples of other (typically just deleted) neurons, indexed by nid.
+        donornids are the nids in donors of self's spikes. The donor with the most spikes
+        in common with self is used, and only spikes that differ between the two are
+        gathered. Makes splitting a few spikes off a big cluster, or merging a small one
+        into it, or undoing either, cheap"""
+        unids, counts = np.unique(donornids, return_counts=True)
+        for nid in unids[counts.argsort()[::-1]]: # most common nid first
+            sids, wavesums = donors.get(nid, (None, None))
+            if wavesums is not None:
+                break # found the best donor
+        else:
+            return # no donor with sums, rebuild from scratch when needed
+        rmsids = np.setdiff1d(sids, self.sids, assume_unique=True)
+        addsids = np.setdiff1d(self.sids, sids, assume_unique=True)
+        if len(rmsids) + len(addsids) >= len(self.sids):
+            return # not worth it, rebuild from scratch when needed
+        self.wavesums = wavesums
+        self.update_wavesums(rmsids, add=False)
+        self.update_wavesums(addsids, add=True)
+        self.wave.data = None # trigger template mean update
+
     def __sub__(self, other):
         """Return difference array between self and other neurons' waveforms
         on common channels"""
@@ -1749,7 +2660,7 @@ class PTCSNeuronRecord(object):
         self.spikets = spikets # constrained to stream range, may be < neuron.sids
         self.wavedtype = {2: np.float16, 4: np.float32, 8: np.float64}[nsamplebytes]
         if n.wave.data is None or n.wave.std is None: # some may have never been displayed
-            n.update_wave()
+            n.update_wave(rebuild=False)
         # wavedata and wavestd are nchans * nt * nsamplebytes long:
         self.wavedata = pad(self.wavedtype(AD2uV(n.wave.data)), align=8)
         self.wavestd = pad(self.wavedtype(AD2uV(n.wave.std)), align=8)
@@ -2308,7 +3219,7 @@ class SortWindow(SpykeToolWindow):
         spw.AddClusterChangeToStack(cc)
 
         # now do some final updates
-        spw.UpdateClustersGUI()
+        spw.UpdateClustersGUI(sids)
         spw.ColourPoints(newcluster)
         #print('applying clusters to plot took %.3f sec' % (time.time()-t0))
         # select newly created cluster
@@ -2733,7 +3644,7 @@ class SortWindow(SpykeToolWindow):
         # try and compare source neuron waveform to all destination neuron waveforms
         for dest in destinations:
             if dest.neuron.wave.data is None: # hasn't been calculated yet
-                dest.neuron.update_wave()
+                dest.neuron.update_wave(rebuild=False)
             dstchans = dest.neuron.wave.chans
             if len(selchans) > 0:
                 if not set(selchans).issubset(dstchans):
@@ -2817,7 +3728,7 @@ class SortWindow(SpykeToolWindow):
         if to == 'best':
             tis = self.tis
             # find which chans are common to all sids:
-            commonchans = s.get_common_chans(sids)[0]
+            commonchans = s.get_common_chans(sids)
             # check selected chans
             selchans = spw.get_selchans(sids)
             for selchan in selchans:
@@ -2827,10 +3738,7 @@ class SortWindow(SpykeToolWindow):
                     return
             print('Best fit aligning %d spikes between tis=%r on chans=%r' %
                   (len(sids), list(tis), selchans))
-            # numpy implementation:
-            #dirtysids = s.alignbest(sids, tis, selchans)
-            # cython implementation:
-            dirtysids = util.alignbest_cy(s, sids, tis, np.int64(selchans))
+            dirtysids, shifts = s.alignbest(sids, tis, selchans)
         else: # to in ['min', 'max']
             print('Aligning %d spikes to %s' % (len(sids), to))
             dirtysids = s.alignminmax(sids, to)
@@ -2852,6 +3760,16 @@ class SortWindow(SpykeToolWindow):
         if update:
             self.nlist.updateAll()
 
+    def update_usids(self, sids=None):
+        """Update sort.usids and uslist. If sids is given, only those spikes may have moved
+        into or out of nid 0, and only their rows in uslist are updated"""
+        if sids is None:
+            self.sort.update_usids()
+            self.uslist.updateAll()
+            return
+        rmrows, addrows = self.sort.update_usids(sids)
+        self.uslist.model().updateRows(rmrows, addrows)
+
     def MoveSpikes2Neuron(self, sids, neuron=None, update=True):
         """Assign spikes from sort.spikes to a neuron, and trigger eventual update of
         mean wave. If neuron is None, create a new one"""
@@ -2859,16 +3777,14 @@ class SortWindow(SpykeToolWindow):
         spikes = self.sort.spikes
         if neuron == None:
             neuron = self.sort.create_neuron()
-        neuron.sids = np.union1d(neuron.sids, sids) # update
+        neuron.add_sids(sids) # also triggers template mean update
         spikes['nid'][sids] = neuron.id
         if update:
-            self.sort.update_usids()
-            self.uslist.updateAll()
+            self.update_usids(sids)
         if neuron in self.nslist.neurons:
             self.nslist.neurons = self.nslist.neurons # trigger nslist refresh
         # TODO: selection doesn't seem to be working, always jumps to top of list
         #self.uslist.Select(row) # automatically select the new item at that position
-        neuron.wave.data = None # trigger template mean update
         return neuron
 
     def MoveSpikes2List(self, neuron, sids, update=True):
@@ -2877,15 +3793,13 @@ class SortWindow(SpykeToolWindow):
         if len(sids) == 0:
             return # nothing to do
         spikes = self.sort.spikes
-        neuron.sids = np.setdiff1d(neuron.sids, sids) # return what's in 1st arr and not in 2nd
+        neuron.remove_sids(sids) # also triggers template mean update
         spikes['nid'][sids] = 0 # unbind neuron id of sids in spikes struct array
         if update:
-            self.sort.update_usids()
-            self.uslist.updateAll()
+            self.update_usids(sids)
         # this only makes sense if the neuron is currently selected in the nlist:
         if neuron in self.nslist.neurons:
             self.nslist.neurons = self.nslist.neurons # this triggers a refresh
-        neuron.wave.data = None # triggers an update when it's actually needed
 
     def PlotClusterHistogram(self, X, nids):
         """Plot histogram of given clusters along a single dimension. If two clusters are
@@ -360,6 +360,15 @@ class DATStream(Stream):
         self.t0, self.t1 = f.t0, f.t1
         self.tranges = np.asarray([[self.t0, self.t1]])
 
+    def refresh(self):
+        """Update to include any data appended to the underlying file since it was last
+        loaded, as when it's still being written to. Return number of new timepoints"""
+        nnew = self.f.refresh()
+        # file might have been refreshed via some other stream, so always update:
+        self.t0, self.t1 = self.f.t0, self.f.t1
+        self.tranges = np.asarray([[self.t0, self.t1]])
+        return nnew
+
     def get_filtering(self):
         """Get filtering settings in an odict, based on self.kind and self.filtmeth"""
         if not self.filtmeth:
@@ -0,0 +1,84 @@
+"""Validate fit-on-subsample dimension reduction against fitting all spikes. Generates
+synthetic clusters of multichannel spike waveforms, does PCA/ICA on them with and without
+subsampling, and reports the agreement of the resulting component subspaces"""
+
+from __future__ import division
+from __future__ import print_function
+
+import time
+
+import numpy as np
+from scipy.linalg import subspace_angles
+
+from spyke import sort as spykesort
+from spyke.sort import Sort
+
+
+class DummyNeuron(object):
+    def __init__(self, sort):
+        self.sort = sort
+
+
+class DummyCluster(object):
+    def __init__(self, sort, id):
+        self.neuron = DummyNeuron(sort)
+        self.id = id
+        self.pos, self.normpos = {}, {}
+
+
+def make_sort(nclusters=10, nspikesperclust=20000, nchans=8, nt=50, noise=30, seed=0):
+    """Return a bare Sort with synthetic clusters, each with its own random template,
+    maxchan and size, plus Gaussian noise"""
+    rng = np.random.RandomState(seed)
+    maxnchans = nchans + 4
+    spikes = np.zeros(nclusters*nspikesperclust, dtype=[('id', np.int32), ('nid', np.int32),
+                                                        ('chan', np.uint8),
+                                                        ('nchans', np.uint8),
+                                                        ('chans', np.uint8, maxnchans)])
+    wavedata = np.zeros((len(spikes), maxnchans, nt), dtype=np.int16)
+    tis = np.arange(nt)
+    si = 0
+    for nid in range(1, nclusters+1):
+        n = rng.randint(nspikesperclust // 10, nspikesperclust) # uneven cluster sizes
+        chan0 = rng.randint(0, 4)
+        amps = rng.uniform(50, 500, nchans)
+        template = -amps[:, None] * np.exp(-(tis - rng.uniform(15, 25))**2 / 20)
+        template += amps[:, None] / 3 * np.exp(-(tis - rng.uniform(25, 40))**2 / 50)
+        sl = slice(si, si+n)
+        spikes['nid'][sl] = nid
+        spikes['chan'][sl] = chan0 + nchans // 2
+        spikes['nchans'][sl] = nchans
+        spikes['chans'][sl, :nchans] = np.arange(chan0, chan0+nchans)
+        wavedata[sl, :nchans] = template + rng.normal(scale=noise, size=(n, nchans, nt))
+        si += n
+    spikes, wavedata = spikes[:si], wavedata[:si]
+    spikes['id'] = np.arange(si)
+    s = Sort.__new__(Sort) # skip stream binding
+    s.spikes, s.wavedata = spikes, wavedata
+    s.npcsperchan = spykesort.NPCSPERCHAN
+    s.clusters = dict((nid, DummyCluster(s, nid)) for nid in range(1, nclusters+1))
+    return s
+
+
+def agreement(X0, X1):
+    """Cosine of largest principal angle between column spaces of X0 and X1: 1 means the
+    two span the same subspace, regardless of the order, sign and scale of components"""
+    return np.cos(subspace_angles(X0, X1).max())
+
+
+s = make_sort()
+sids = s.spikes['id']
+# common chans of all clusters:
+chans = np.arange(s.spikes['chans'][:, 0].max(), s.spikes['chans'][:, 7].min()+1)
+print('%d spikes, %d clusters, chans %r' % (len(sids), len(s.clusters), list(chans)))
+for kind in ['PCA', 'ICA']:
+    for maxnspikes in [None, 50000, 20000, 5000]:
+        spykesort.COMPFITMAXNSPIKES = maxnspikes
+        t0 = time.time()
+        X = s.get_component_matrix(kind, sids, chans=chans, minncomp=3)
+        dt = time.time() - t0
+        if maxnspikes is None:
+            Xfull, dtfull = X, dt
+            continue
+        print('%s fit to %d spikes: subspace agreement with full fit: %.6f, '
+              '%.3f vs %.3f sec' % (kind, maxnspikes, agreement(Xfull, X), dt, dtfull))
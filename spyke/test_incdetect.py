@@ -0,0 +1,106 @@
+"""Check incremental detection against a single detection run. Generates a synthetic .dat
+file of noise and spikes in a temporary folder, and appends it a chunk at a time, as an
+acquisition system would, calling Detector.detect_incremental() after each chunk. All
+but the first and last chunks leave a partially written timepoint at the end of the file.
+The result is then compared to a single Detector.detect() over the same time range"""
+
+from __future__ import division
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+import json
+
+import numpy as np
+
+from spyke import dat, probes
+from spyke.sort import Sort
+from spyke.detect import Detector
+
+PROBENAME = 'A1x32'
+SAMPFREQ = 25000 # Hz
+UVPERAD = 0.195
+NCHUNKS = 6
+CHUNKDURATION = 2 # sec
+NSPIKESPERSEC = 50
+NOISE = 20 # AD units
+SPIKETW = -500, 1000 # us
+
+
+def make_data(rng, nchans):
+    """Return (nt, nchans) int16 noise with biphasic spikes added at random times, each
+    spanning a few neighbouring chans"""
+    nt = NCHUNKS * CHUNKDURATION * SAMPFREQ
+    data = rng.normal(scale=NOISE, size=(nt, nchans))
+    tis = np.arange(-25, 25)
+    template = -400 * np.exp(-tis**2 / 8) + 150 * np.exp(-(tis-10)**2 / 30)
+    nspikes = NSPIKESPERSEC * NCHUNKS * CHUNKDURATION
+    for ti, chani in zip(rng.randint(50, nt-50, nspikes), rng.randint(0, nchans, nspikes)):
+        for dchani, scale in [(-1, 0.5), (0, 1), (1, 0.5)]:
+            if 0 <= chani+dchani < nchans:
+                data[ti+tis, chani+dchani] += scale * template
+    return np.int16(np.round(data))
+
+def make_detector(stream, trange, logpath):
+    sort = Sort(detector=None, stream=stream, tw=SPIKETW)
+    det = Detector(sort=sort)
+    sort.detector = det
+    det.extractparamsondetect = False
+    det.chans = stream.chans
+    det.threshmethod = 'GlobalFixed'
+    det.fixedthreshuV = 50
+    det.noisemult = 4.5
+    det.noisemethod = 'median'
+    det.ppthreshmult = 1.5
+    det.dt = 350 # us
+    det.trange = trange
+    det.blocksize = 1000000 # us
+    det.lockrx = 2
+    det.inclr = 100 # um
+    return det
+
+
+path = tempfile.mkdtemp()
+try:
+    rng = np.random.RandomState(0)
+    chans = np.sort(list(probes.getprobe(PROBENAME).SiteLoc))
+    data = make_data(rng, len(chans))
+    fname = os.path.join(path, 'test.dat')
+    with open(fname + '.json', 'w') as f:
+        json.dump({'nchans': len(chans), 'sample_rate': SAMPFREQ, 'dtype': 'int16',
+                   'uV_per_AD': UVPERAD, 'probe_name': PROBENAME,
+                   'chans': list(map(int, chans))}, f)
+    raw = data.tobytes()
+    chunknbytes = len(raw) // NCHUNKS
+    f = open(fname, 'wb')
+    spikes = wavedata = det = None
+    for chunki in range(NCHUNKS):
+        stop = (chunki+1) * chunknbytes
+        if 0 < chunki < NCHUNKS-1:
+            stop += 2 # leave a partially written timepoint, with just one sample
+        f.write(raw[f.tell():stop])
+        f.flush()
+        if det is None:
+            datfile = dat.File(fname)
+            stream = datfile.hpstream
+            det = make_detector(stream, (stream.t0, stream.t1), path)
+        spikes, wavedata = det.detect_incremental(spikes, wavedata, logpath=path)
+        print('chunk %d: %d spikes so far, up to t=%d us'
+              % (chunki, len(spikes), det.trange[1]))
+    f.close()
+
+    # single detection run over the same time range, with the whole file already written:
+    stream = dat.File(fname).hpstream
+    det1 = make_detector(stream, det.trange, path)
+    spikes1, wavedata1 = det1.detect(logpath=path)
+    print('incremental: %d spikes, single run: %d spikes' % (len(spikes), len(spikes1)))
+    assert len(spikes) == len(spikes1)
+    for name in spikes.dtype.names:
+        assert (spikes[name] == spikes1[name]).all(), name
+    # chans of each row beyond its nchans are left uninitialized by check_wave():
+    for sid, nchans in enumerate(spikes['nchans']):
+        assert (wavedata[sid, :nchans] == wavedata1[sid, :nchans]).all(), sid
+    print('Incremental detection matches single detection run')
+finally:
+    shutil.rmtree(path)
@@ -0,0 +1,109 @@
+"""Benchmark updating dirty rows of a .npy file in place against rewriting the whole file,
+across a range of dirty fractions. Dirty rows are either scattered uniformly at random,
+or clustered into short runs, as when realigning or reclustering a subset of spikes.
+Reports the time taken by the old one seek and write per row, by the current span
+coalescing updatenpyfilerows(), and by a full atomic rewrite, along with the choice
+made by the partialnpyupdate() cost model. Dirty rows are changed again before each
+method, and the file is checked after each. Finally, an update is interrupted part way
+through, and then finished from its journal by recovernpyfilerows()"""
+
+from __future__ import division
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from spyke import core
+
+NROWS = 200000
+ROWSHAPE = 12, 50 # nchans, nt of a typical .wave file row
+FRACTIONS = [0.0001, 0.001, 0.01, 0.05, 0.1, 0.2, 0.5]
+RUNLEN = 50 # num consecutive rows per run, for clustered dirty rows
+
+
+def perrow(fname, rows, arr):
+    """Old way of updating rows: one seek and write per row"""
+    f = open(fname, 'r+b')
+    core.readnpyheader(f)
+    arroffset = f.tell()
+    rowsize = arr[0].nbytes
+    for row in sorted(rows):
+        f.seek(arroffset + row*rowsize)
+        f.write(arr[row])
+    f.flush()
+    os.fsync(f.fileno())
+    f.close()
+
+def fullrewrite(fname, rows, arr):
+    """Rewrite the whole file, regardless of rows"""
+    core.writeatomic(fname, lambda f: np.save(f, arr))
+
+def get_rows(rng, fraction, clustered):
+    ndirty = max(int(round(NROWS * fraction)), 1)
+    if not clustered:
+        return np.sort(rng.choice(NROWS, ndirty, replace=False))
+    nruns = max(ndirty // RUNLEN, 1)
+    starts = rng.choice(NROWS - RUNLEN, nruns, replace=False)
+    return np.unique((starts[:, None] + np.arange(RUNLEN)).ravel())
+
+def timeit(func, fname, rows, arr):
+    """Change rows in arr, time how long func takes to update them in fname, and check
+    that fname then matches arr"""
+    arr[rows] += 1
+    t0 = time.time()
+    func(fname, rows, arr)
+    dt = time.time() - t0
+    assert (np.load(fname, mmap_mode='r') == arr).all(), func.__name__
+    return dt
+
+def interruptedwritenpyrows(f, arroffset, rowsize, rows, j, progress):
+    """Write only the first half of rows from the journal, then fail"""
+    writenpyrows(f, arroffset, rowsize, rows[:len(rows)//2], j, progress)
+    f.flush()
+    raise IOError('simulated crash')
+
+
+rng = np.random.RandomState(0)
+arr = rng.randint(-1000, 1000, (NROWS,) + ROWSHAPE).astype(np.int16)
+rowsize = arr[0].nbytes
+path = tempfile.mkdtemp()
+fname = os.path.join(path, 'test.wave')
+fullrewrite(fname, None, arr)
+print('%d rows of %d bytes, %.1f MB file' % (NROWS, rowsize, arr.nbytes / 2**20))
+try:
+    for clustered in [False, True]:
+        print('%s dirty rows:' % ('Clustered' if clustered else 'Scattered'))
+        print('  dirty %    nrows  nspans   per row   spans     full   cost model')
+        for fraction in FRACTIONS:
+            rows = get_rows(rng, fraction, clustered)
+            nspans = len(core.npyrowspans(rows, rowsize)[0])
+            dts = [ timeit(func, fname, rows, arr)
+                    for func in [perrow, core.updatenpyfilerows, fullrewrite] ]
+            partial = core.partialnpyupdate(NROWS, rowsize, rows)
+            print('  %7.2f %7d %7d %8.3fs %6.3fs %7.3fs   %s'
+                  % ((fraction*100, len(rows), nspans) + tuple(dts) +
+                     ('partial' if partial else 'full',)))
+
+    # interrupt an update after half its rows are written, then recover from the journal:
+    rows = get_rows(rng, 0.01, clustered=True)
+    arr[rows] += 1
+    writenpyrows = core.writenpyrows
+    core.writenpyrows = interruptedwritenpyrows
+    try:
+        core.updatenpyfilerows(fname, rows, arr)
+    except IOError:
+        pass
+    finally:
+        core.writenpyrows = writenpyrows
+    assert os.path.exists(fname + '.journal')
+    assert not (np.load(fname) == arr).all() # only partly updated
+    core.recovernpyfilerows(fname)
+    assert not os.path.exists(fname + '.journal')
+    assert (np.load(fname) == arr).all()
+    print('Recovered interrupted update of %d rows from journal' % len(rows))
+finally:
+    shutil.rmtree(path)
@@ -97,3 +97,27 @@ i = np.row_stack(np.float32(np.random.normal(loc=0, scale=1, size=5000))) # 2D
 j = np.row_stack(np.float32(np.random.normal(loc=2, scale=1, size=1000))) # 2D
 util.NDsepmetric(i, j, Nmax=20000)
 '''
+
+'''
+# benchmark histogram-based median_abs_2Dshort and stdev_2Dshort against
+# median_inplace_2Dshort and np.std, across channel counts and block sizes:
+for nchans in [16, 32, 64, 128]:
+    for nt in [100000, 500000, 1000000, 5000000]:
+        data = np.int16(np.random.normal(loc=0, scale=300, size=(nchans, nt)))
+        t0 = time.time()
+        oldmed = util.median_inplace_2Dshort(np.abs(data)) # includes copy
+        toldmed = time.time() - t0
+        t0 = time.time()
+        newmed = util.median_abs_2Dshort(data)
+        tnewmed = time.time() - t0
+        t0 = time.time()
+        oldstd = np.std(data, axis=-1)
+        toldstd = time.time() - t0
+        t0 = time.time()
+        newstd = util.stdev_2Dshort(data)
+        tnewstd = time.time() - t0
+        assert (oldmed == newmed).all()
+        assert np.allclose(oldstd, newstd)
+        print('nchans=%d, nt=%d: median %.3f -> %.3f sec, stdev %.3f -> %.3f sec'
+              % (nchans, nt, toldmed, tnewmed, toldstd, tnewstd))
+'''
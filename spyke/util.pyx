@@ -6,7 +6,7 @@
 """Some functions written in Cython for max performance"""
 
 cimport cython
-from cython.parallel import prange#, parallel
+from cython.parallel import prange, parallel
 import numpy as np
 cimport numpy as np
 from numpy cimport uint8_t, int8_t, int16_t, int32_t, int64_t, float32_t, float64_t
@@ -27,8 +27,18 @@ cdef extern from "float.h":
 cdef extern from "stdio.h":
     int printf(char *, ...)
 
+cdef extern from "math.h":
+    double sqrt(double x) nogil
+    double exp(double x) nogil
+
+cdef extern from "stdlib.h":
+    void *malloc(size_t) nogil
+    void free(void *) nogil
+
 cdef extern from "string.h":
     cdef void *memset(void *, int, size_t) nogil # sets n bytes in memory to constant
+    cdef void *memcpy(void *, const void *, size_t) nogil
+    cdef void *memmove(void *, const void *, size_t) nogil
 
 
 cdef short select_short(short *a, int l, int r, int k):
@@ -79,6 +89,175 @@ def median_inplace_2Dshort(np.ndarray[int16_t, ndim=2, mode='c'] arr):
     return result
 
 
+cdef double select_double(double *a, Py_ssize_t n, Py_ssize_t k) nogil:
+    """Return the k'th (0-based) ranked entry of double array a of length n, by Hoare
+    partitioning based selection. Modifies a in-place, leaving all entries before k <= the
+    returned one. Pivots on the middle entry, so presorted a doesn't take quadratic time"""
+    cdef Py_ssize_t l = 0, r = n - 1, i, j
+    cdef double v, temp
+    while l < r:
+        v = a[(l + r) // 2]
+        i = l
+        j = r
+        while i <= j:
+            while a[i] < v:
+                i = i + 1
+            while a[j] > v:
+                j = j - 1
+            if i <= j:
+                temp = a[i] # swap a[i] and a[j]
+                a[i] = a[j]
+                a[j] = temp
+                i = i + 1
+                j = j - 1
+        if k <= j:
+            r = j
+        elif k >= i:
+            l = i
+        else: # k is in the middle partition, all of whose entries == v
+            break
+    return a[k]
+
+
+def segmedians(const float64_t[::1] a, const int64_t[::1] counts, float64_t[::1] out):
+    """Write the median of each consecutive segment of counts values in a to out, same as
+    np.median of each segment. All counts must be > 0. Segments are handled in parallel,
+    each by selection in its own per-thread copy, in linear time on average"""
+    cdef Py_ssize_t nsegs, i, j, n, k, maxn
+    cdef int64_t[::1] starts
+    cdef double *buf
+    cdef double m, lo
+    nsegs = counts.shape[0]
+    assert out.shape[0] == nsegs
+    if nsegs == 0:
+        return
+    countsarr = np.asarray(counts)
+    assert countsarr.min() > 0 and countsarr.sum() == a.shape[0]
+    starts = np.concatenate([[0], countsarr.cumsum()[:-1]])
+    maxn = countsarr.max()
+    with nogil, parallel():
+        buf = <double *>malloc(maxn * sizeof(double))
+        for i in prange(nsegs, schedule='dynamic'):
+            n = counts[i]
+            memcpy(buf, &a[starts[i]], n * sizeof(double))
+            k = n // 2
+            m = select_double(buf, n, k)
+            if n % 2 == 0: # average with the next lower entry, the max of those before k
+                lo = buf[0]
+                for j in range(1, k):
+                    if buf[j] > lo:
+                        lo = buf[j]
+                m = (lo + m) / 2
+            out[i] = m
+        free(buf)
+
+
+DEF NABSBINS = 32769 # num possible abs values of int16 data, 0 to 2**15 inclusive
+
+
+def abshist_2Dshort(int16_t[:, :] data, int64_t[:, ::1] hist):
+    """Accumulate, in-place, a histogram of the absolute values of each row (chan) of int16
+    data into the corresponding row of hist, which must be of shape (nchans, 2**15+1).
+    data may be strided, and isn't modified. Chans are split across threads. Histograms of
+    separate blocks of data can simply be summed"""
+    cdef Py_ssize_t nchans, nt, ci, ti
+    cdef int v
+    nchans = data.shape[0]
+    nt = data.shape[1]
+    assert hist.shape[0] == nchans
+    assert hist.shape[1] == NABSBINS
+    for ci in prange(nchans, nogil=True, schedule='dynamic'):
+        for ti in range(nt):
+            v = data[ci, ti]
+            if v < 0:
+                v = -v
+            hist[ci, v] += 1
+
+
+def median_abshist(int64_t[:, ::1] hist):
+    """Return the per-chan median from abs value histograms as accumulated by
+    abshist_2Dshort. For an even number of points, the lower of the two middle values is
+    returned, same as median_inplace_2Dshort"""
+    cdef Py_ssize_t nchans, ci, v
+    cdef int64_t n, k, cumsum
+    nchans = hist.shape[0]
+    cdef np.ndarray[int32_t, ndim=1] result = np.zeros(nchans, dtype=np.int32)
+    for ci in range(nchans):
+        n = 0
+        for v in range(NABSBINS):
+            n += hist[ci, v]
+        if n == 0:
+            continue # leave median as 0
+        k = (n-1) // 2 # 0-based rank of median
+        cumsum = 0
+        for v in range(NABSBINS):
+            cumsum += hist[ci, v]
+            if cumsum > k:
+                result[ci] = v
+                break # out of v loop
+    return result
+
+
+def median_abs_2Dshort(int16_t[:, :] data):
+    """Return the per-chan median of the absolute values of 2D int16 data, without copying,
+    modifying or sorting data. Each thread builds a count histogram of abs values of one
+    chan at a time, and reads off the median from its cumulative sum. For an even number
+    of points, the lower of the two middle values is returned, same as
+    median_inplace_2Dshort"""
+    cdef Py_ssize_t nchans, nt, ci, ti, v
+    cdef int absv
+    cdef int64_t k, cumsum
+    cdef int32_t *hist
+    cdef size_t nbyteshist = NABSBINS * sizeof(int32_t)
+    nchans = data.shape[0]
+    nt = data.shape[1]
+    assert nt < 2**31 # make sure int32 counts don't overflow
+    cdef np.ndarray[int32_t, ndim=1] resultarr = np.zeros(nchans, dtype=np.int32)
+    cdef int32_t[::1] result = resultarr
+    k = (nt-1) // 2 # 0-based rank of median
+    with nogil, parallel():
+        hist = <int32_t *>malloc(nbyteshist) # one per thread
+        for ci in prange(nchans, schedule='dynamic'):
+            memset(hist, 0, nbyteshist)
+            for ti in range(nt):
+                absv = data[ci, ti]
+                if absv < 0:
+                    absv = -absv
+                hist[absv] += 1
+            cumsum = 0
+            for v in range(NABSBINS):
+                cumsum = cumsum + hist[v]
+                if cumsum > k:
+                    result[ci] = v
+                    break # out of v loop
+        free(hist)
+    return resultarr
+
+
+def stdev_2Dshort(int16_t[:, :] data):
+    """Return the per-chan (population) standard deviation of 2D int16 data, without
+    copying data. Sums are exact int64, one chan per thread at a time"""
+    cdef Py_ssize_t nchans, nt, ci, ti
+    cdef int64_t x, s, ss
+    cdef double mean
+    nchans = data.shape[0]
+    nt = data.shape[1]
+    cdef np.ndarray[float64_t, ndim=1] resultarr = np.zeros(nchans, dtype=np.float64)
+    cdef float64_t[::1] result = resultarr
+    if nt == 0:
+        return resultarr
+    for ci in prange(nchans, nogil=True, schedule='dynamic'):
+        s = 0
+        ss = 0
+        for ti in range(nt):
+            x = data[ci, ti]
+            s = s + x
+            ss = ss + x*x
+        mean = <double>s / nt
+        result[ci] = sqrt(<double>ss / nt - mean*mean)
+    return resultarr
+
+
 cdef double mean_short(short *a, int N):
     cdef Py_ssize_t i # recommended type for looping
     cdef double s=0.0
@@ -342,6 +521,48 @@ def xcorr(int64_t[::1] x,
     return np.asarray(dts[:dtsi]) # trim it down, convert memory view slice to array
 
 
+def xcorrs(const int64_t[::1] ts, const int64_t[::1] cis, const int64_t[::1] order,
+           const int64_t[::1] ptr, int64_t low, int64_t high, int64_t[:, :, ::1] counts):
+    """Histogram all auto and cross-correlograms of the spike trains of N clusters into
+    counts (N, N, nbins), with equal width bins spanning low <= dt < high. ts are the
+    spike times of all clusters merged and sorted, and cis their cluster indices. order
+    and ptr group the indices into ts by cluster, like a CSR sparse matrix, i.e. cluster
+    ci's spikes are ts[order[ptr[ci]:ptr[ci+1]]]. For each spike of cluster ci, the merged
+    train is swept outwards in both directions until it falls out of range, and each
+    neighbour's time relative to it is binned into counts[ci, its cluster]. Each thread
+    handles its own clusters and fills only their rows of counts, so no locking or
+    per-thread copies are needed. dts are never stored. A spike isn't correlated with
+    itself"""
+    cdef Py_ssize_t nclusters, nbins, nspikes, ci, ii, i, j
+    cdef int64_t t, dt, width
+    nclusters = counts.shape[0]
+    nbins = counts.shape[2]
+    nspikes = ts.shape[0]
+    width = high - low
+    assert counts.shape[1] == nclusters and ptr.shape[0] == nclusters + 1
+    assert cis.shape[0] == nspikes and order.shape[0] == nspikes and width > 0
+    for ci in prange(nclusters, nogil=True, schedule='dynamic'):
+        for ii in range(ptr[ci], ptr[ci+1]):
+            i = order[ii]
+            t = ts[i]
+            j = i - 1
+            while j >= 0:
+                dt = ts[j] - t
+                if dt < low:
+                    break
+                if dt < high:
+                    counts[ci, cis[j], (dt - low) * nbins // width] += 1
+                j = j - 1
+            j = i + 1
+            while j < nspikes:
+                dt = ts[j] - t
+                if dt >= high:
+                    break
+                if dt >= low:
+                    counts[ci, cis[j], (dt - low) * nbins // width] += 1
+                j = j + 1
+
+
 ## TODO: it may be that np.ndarray[float32_t, ndim=2, mode='c'] definitions run faster
 ## than float32_t[:, :] definitions. Or at least they seem to in 1D in alignbest_cy.
 def NDsepmetric(float32_t[:, :] C0,
@@ -446,140 +667,496 @@ cdef int NNmembership(int i, int ndim, int N0, int N1,
     return 1
 
 
-#def alignbest_cy(sort, int64_t[:] sids, int64_t[:] tis, int64_t[:] chans):
-def alignbest_cy(sort,
-                 np.ndarray[int64_t, ndim=1, mode='c'] sids,
-                 np.ndarray[int64_t, ndim=1, mode='c'] tis,
-                 np.ndarray[int64_t, ndim=1, mode='c'] chans):
-    """Align all sids between tis on chans by best fit according to mean squared error.
-    chans are assumed to be a subset of channels of sids. Return sids
-    that were actually moved and therefore need to be marked as dirty"""
-    # TODO: make maxshift a f'n of interpolation factor
-    DEF MAXSHIFT = 2 # constant, shift +/- this many timepoints, keep within int8 bounds
-    spikes = sort.spikes
-    # copy needed fields from spikes rect array as simple arrays, should come out as contig:
-    cdef np.ndarray[uint8_t, ndim=1, mode='c'] spikes_nchans = spikes['nchans'][sids]
-    cdef np.ndarray[uint8_t, ndim=2, mode='c'] spikes_chans = spikes['chans'][sids]
-    cdef int nspikes = sids.shape[0]
-    cdef int nchans = chans.shape[0]
-    cdef np.ndarray[int16_t, ndim=3, mode='c'] wd = sort.wavedata
-    cdef int nt = wd.shape[2] # num timepoints in each waveform
-    cdef int ti0 = tis[0]
-    cdef int ti1 = tis[1]
-    cdef int subnt = ti1 - ti0 # num timepoints to slice from each waveform
-    cdef int subntdiv2 = subnt // 2
-    #print('subntdiv2 on either side of t=0: %d' % subntdiv2)
-    if subntdiv2 < MAXSHIFT:
-        raise ValueError("Selected waveform duration too short")
-    #maxshiftus = MAXSHIFT * self.stream.tres
-    # from -MAXSHIFT to MAXSHIFT, inclusive, use int8 because spikes['tis'] is int8:
-    cdef np.ndarray[int8_t, ndim=1, mode='c'] shifts = \
-        np.arange(-MAXSHIFT, MAXSHIFT+1, dtype=np.int8)
-    cdef int nshifts = shifts.shape[0]
-    print("Padding waveforms with up to +/- %d points of edge data" % MAXSHIFT)
-
-    # not worth subsampling here while calculating meandata, since all this
-    # stuff in this loop is needed in the shift loop below
-    cdef np.ndarray[int16_t, ndim=3, mode='c'] subsd
-    subsd = np.zeros((nspikes, nchans, subnt), dtype=wd.dtype) # subset of spike data
-    cdef np.ndarray[int64_t, ndim=2, mode='c'] spikechanis
-    spikechanis = np.zeros((nspikes, nchans), dtype=np.int64)
-    #t0 = time.time()
-    cdef int sidi, sid
-    cdef int shifti, chani, ti, spikechani=0
-    cdef long long chansubsd
-    for sidi in range(nspikes):
-        sid = sids[sidi]
-        for chani in range(nchans):
-            chan = chans[chani]
-            for spikechani in range(spikes_nchans[sidi]):
-                if spikes_chans[sidi, spikechani] == chan:
-                    spikechanis[sidi, chani] = spikechani
-                    break # out of spikechani loop
-            for ti in range(subnt):
-                subsd[sidi, chani, ti] = wd[sid, spikechani, ti0+ti]
-    #print('mean prep loop for best shift took %.3f sec' % (time.time()-t0))
-    #t0 = time.time()
-    cdef np.ndarray[float64_t, ndim=2, mode='c'] meandata = subsd.mean(axis=0) # float64
-    #print('mean for best shift took %.3f sec' % (time.time()-t0))
-
-    # choose best shifted waveform for each spike
-    # widesd holds current spike data plus padding on either side
-    # to allow for full width slicing for all time shifts:
-    cdef int maxnchans = spikes_nchans.max() # of all sids
-    cdef int wident = MAXSHIFT+nt+MAXSHIFT
-    cdef int maxwidesdi = wident - 1
-    cdef np.ndarray[int16_t, ndim=2, mode='c'] sd
-    sd = np.zeros((maxnchans, nt), dtype=wd.dtype)
-    cdef np.ndarray[int16_t, ndim=2, mode='c'] widesd
-    widesd = np.zeros((maxnchans, wident), dtype=wd.dtype)
-    cdef np.ndarray[int16_t, ndim=3, mode='c'] shiftedsubsd = subsd.copy() # init
-    cdef np.ndarray[int16_t, ndim=3, mode='c'] tempsubshifts
-    tempsubshifts = np.zeros((nshifts, nchans, subnt), dtype=wd.dtype)
-    cdef int bestshift, bestshifti=0, dt, ndirty=0
-    cdef double error
-    cdef np.ndarray[float64_t, ndim=1, mode='c'] sserrors
-    sserrors = np.zeros(nshifts, dtype=np.float64) # sum of squared errors
-    cdef int nbytessserrors = nshifts*sizeof(float64_t)
-    cdef double tres = sort.tres
-    cdef np.ndarray[int64_t, ndim=1, mode='c'] dirtysids = np.empty(nspikes, dtype=np.int64)
-    #t0 = time.time()
-    for sidi in range(nspikes):
-        # pad start and end with first and last points per chan:
-        sid = sids[sidi]
-        for chani in range(maxnchans):
+cdef inline double shifted_point(const int16_t *row, int nt, int64_t pos,
+                                 int interp) nogil:
+    """Return value of row at pos/interp timepoints, linearly interpolated between
+    neighbouring points, and clamped to the first and last points beyond either end"""
+    cdef int64_t q
+    cdef double f
+    if pos <= 0:
+        return row[0]
+    if pos >= (nt-1)*interp:
+        return row[nt-1]
+    q = pos // interp
+    f = <double>(pos - q*interp) / interp
+    return row[q] + f * (row[q+1] - row[q])
+
+
+def best_shifts(const int16_t[:, :, ::1] wavedata, const int64_t[::1] sids,
+                const uint8_t[:, :] chanss, const uint8_t[:] nchanss,
+                const uint8_t[::1] chans, int ti0, int ti1,
+                const float64_t[:, ::1] meandata, int maxshift, int interp,
+                int64_t[::1] shifts, float64_t[::1] sserrors0, float64_t[::1] sserrors):
+    """For each of sids, find the shift of its wavedata between ti0 and ti1 on chans that
+    best fits meandata (nchans, ti1-ti0) according to sum of squared errors. Shifts range
+    over +/- maxshift timepoints in steps of 1/interp timepoints, interpolating linearly
+    between timepoints and padding with edge values. A shift s means reading wavedata at
+    ti+s/interp, i.e. shifting the waveform left by s/interp. Save best shift (in 1/interp
+    timepoint units), sum of squared errors without any shift, and with the best shift to
+    shifts, sserrors0 and sserrors respectively. chanss and nchanss are the full
+    spikes['chans'] and spikes['nchans'] fields. All sids must have all chans. Spikes are
+    split across threads"""
+    cdef Py_ssize_t nspikes, nchans, subnt, nt, i, ci, cj, ti
+    cdef int64_t sid, s, bestshift
+    cdef double err, sse, bestsse
+    cdef int *chanis
+    cdef const int16_t *row
+    nspikes = sids.shape[0]
+    nchans = chans.shape[0]
+    subnt = ti1 - ti0
+    nt = wavedata.shape[2]
+    assert 0 <= ti0 < ti1 <= nt and maxshift >= 0 and interp >= 1
+    assert meandata.shape[0] == nchans and meandata.shape[1] == subnt
+    assert shifts.shape[0] == nspikes and sserrors0.shape[0] == nspikes
+    assert sserrors.shape[0] == nspikes
+    with nogil, parallel():
+        chanis = <int *>malloc(nchans * sizeof(int)) # one per thread
+        for i in prange(nspikes, schedule='static'):
+            sid = sids[i]
+            for ci in range(nchans):
+                chanis[ci] = 0
+                for cj in range(nchanss[sid]):
+                    if chanss[sid, cj] == chans[ci]:
+                        chanis[ci] = cj
+                        break
+            bestsse = DBL_MAX
+            bestshift = 0
+            # same order as the original numpy version, so ties go to the most -ve shift:
+            for s in range(-maxshift*interp, maxshift*interp+1):
+                sse = 0.0
+                for ci in range(nchans):
+                    row = &wavedata[sid, chanis[ci], 0]
+                    if interp == 1 and ti0+s >= 0 and ti1+s <= nt: # no edges, fast path
+                        for ti in range(subnt):
+                            err = row[ti0+s+ti] - meandata[ci, ti]
+                            sse = sse + err*err
+                    else:
+                        for ti in range(subnt):
+                            err = (shifted_point(row, nt, (ti0+ti)*interp + s, interp)
+                                   - meandata[ci, ti])
+                            sse = sse + err*err
+                if s == 0:
+                    sserrors0[i] = sse
+                if sse < bestsse:
+                    bestsse = sse
+                    bestshift = s
+            shifts[i] = bestshift
+            sserrors[i] = bestsse
+        free(chanis)
+
+
+def shift_wavedata(int16_t[:, :, ::1] wavedata, const int64_t[::1] sids,
+                   const int64_t[::1] shifts, int interp):
+    """Shift all chans of wavedata of sids in-place by shifts, in units of 1/interp
+    timepoints: -ve shifts left, +ve shifts right. Pad with edge values at the
+    appropriate end. Sub-timepoint shifts interpolate linearly, and round to the nearest
+    integer. Spikes are split across threads"""
+    cdef Py_ssize_t nspikes, nchans, nt, i, ci, ti
+    cdef int64_t sid, s
+    cdef double v
+    cdef int16_t edge
+    cdef int16_t *row
+    cdef int16_t *buf
+    nspikes = sids.shape[0]
+    nchans = wavedata.shape[1]
+    nt = wavedata.shape[2]
+    assert shifts.shape[0] == nspikes and interp >= 1
+    if nt == 0:
+        return
+    with nogil, parallel():
+        buf = <int16_t *>malloc(nt * sizeof(int16_t)) # one per thread
+        for i in prange(nspikes, schedule='static'):
+            sid = sids[i]
+            s = shifts[i]
+            if s == 0:
+                continue
+            for ci in range(nchans):
+                row = &wavedata[sid, ci, 0]
+                if interp == 1 and s > 0 and s < nt: # shift right, pad with left edge
+                    edge = row[0]
+                    memmove(row+s, row, (nt-s) * sizeof(int16_t))
+                    for ti in range(s):
+                        row[ti] = edge
+                elif interp == 1 and s < 0 and -s < nt: # shift left, pad with right edge
+                    edge = row[nt-1]
+                    memmove(row, row-s, (nt+s) * sizeof(int16_t))
+                    for ti in range(nt+s, nt):
+                        row[ti] = edge
+                else:
+                    for ti in range(nt):
+                        v = shifted_point(row, nt, ti*interp - s, interp)
+                        if v >= 0:
+                            buf[ti] = <int16_t>(v + 0.5)
+                        else:
+                            buf[ti] = <int16_t>(v - 0.5)
+                    memcpy(row, buf, nt * sizeof(int16_t))
+        free(buf)
+
+
+def wavedata_sums(const int16_t[:, :, ::1] wavedata, const int64_t[::1] sids,
+                  const int64_t[::1] chaniis, const int64_t[::1] ptr,
+                  int64_t[:, ::1] sums, int64_t[:, ::1] sumsqs):
+    """Add wavedata[sids[i], chaniis[i]] and its square to row ci of sums and sumsqs, for
+    all i in ptr[ci]:ptr[ci+1], i.e. sids and chaniis are grouped by row ci of the output,
+    like a CSR sparse matrix. Each thread handles its own output rows, so no locking or
+    per-thread copies are needed. Sums of int16 data in int64 are exact, so they can be
+    updated incrementally without accumulating any roundoff error"""
+    cdef Py_ssize_t nrows, nt, ci, i, ti
+    cdef int64_t v
+    cdef const int16_t *row
+    cdef int64_t *sumrow
+    cdef int64_t *sumsqrow
+    nrows = sums.shape[0]
+    nt = sums.shape[1]
+    assert ptr.shape[0] == nrows + 1
+    assert sumsqs.shape[0] == nrows and sumsqs.shape[1] == nt and wavedata.shape[2] == nt
+    if nt == 0:
+        return
+    for ci in prange(nrows, nogil=True, schedule='dynamic'):
+        sumrow = &sums[ci, 0]
+        sumsqrow = &sumsqs[ci, 0]
+        for i in range(ptr[ci], ptr[ci+1]):
+            row = &wavedata[sids[i], chaniis[i], 0]
             for ti in range(nt):
-                sd[chani, ti] = wd[sid, chani, ti] # sid's spike data
-                widesd[chani, ti+MAXSHIFT] = sd[chani, ti] # 2D
-            for ti in range(MAXSHIFT):
-                widesd[chani, ti] = sd[chani, 0] # pad start with first point per chan
-                widesd[chani, maxwidesdi-ti] = sd[chani, -1] # pad end with last point per chan
-
-        # calculate sum of squared errors for all possible shifts of each spike:
-        memset(&sserrors[0], 0, nbytessserrors) # clear sserrors
-        for shifti in range(nshifts):
-            for chani in range(nchans):
-                spikechani = spikechanis[sidi, chani]
-                for ti in range(subnt):
-                    tempsubshifts[shifti, chani, ti] = widesd[spikechani, ti+ti0+shifti]
-                    error = <double>tempsubshifts[shifti, chani, ti] - meandata[chani, ti]
-                    sserrors[shifti] += error*error
-
-        # find shift with smallest error:
-        error = DBL_MAX
-        for shifti in range(nshifts):
-            if sserrors[shifti] < error:
-                error = sserrors[shifti]
-                bestshifti = shifti
-        bestshift = shifts[bestshifti]
-        if bestshift != 0: # no need to update sort.wavedata[sid] if there's no shift
-            # update time values:
-            dt = <int>round(bestshift * tres) # time to shift by, signed, in us
-            ## TODO: update spikes array in pure C:
-            spikes['t'][sid] += dt # should remain as ints between t0 and t1
-            spikes['t0'][sid] += dt
-            spikes['t1'][sid] += dt
-            # might give out of bounds tis because the original peaks have shifted off the
-            # ends. Use opposite sign because we're referencing within wavedata:
-            spikes['tis'][sid] = spikes['tis'][sid] - bestshift
-            # this in-place operation raises a TypeError in numpy 1.11.2, something related to
-            # subtracting an int from an unsigned int:
-            #spikes['tis'][sid] -= bestshift
-            # update sort.wavedata
-            for chani in range(maxnchans):
-                for ti in range(nt):
-                    wd[sid, chani, ti] = widesd[chani, ti+bestshifti]
-            for chani in range(nchans):
-                for ti in range(subnt):
-                    shiftedsubsd[sidi, chani, ti] = tempsubshifts[bestshifti, chani, ti]
-            dirtysids[ndirty] = sid # mark sid as dirty
-            ndirty += 1
-    #print('shifting loop took %.3f sec' % (time.time()-t0))
-    AD2uV = sort.converter.AD2uV
-    stdevbefore = AD2uV(subsd.std(axis=0).mean())
-    stdevafter = AD2uV(shiftedsubsd.std(axis=0).mean())
-    print('stdev went from %.3f to %.3f uV' % (stdevbefore, stdevafter))
-    return dirtysids[:ndirty]
+                v = row[ti]
+                sumrow[ti] += v
+                sumsqrow[ti] += v * v
+
+
+ctypedef fused gather_t:
+    int16_t
+    float32_t
+    float64_t
+
+def gather_wavedata(const int16_t[:, :, ::1] wavedata, const int64_t[::1] sids,
+                    const uint8_t[:, :] chanss, const uint8_t[:] nchanss,
+                    const uint8_t[::1] chans, int ti0, int ti1, bint norm,
+                    gather_t[:, ::1] out):
+    """Copy wavedata[sids[i]] on chans between ti0 and ti1 into row i of out, flattened
+    chan by chan. chanss and nchanss are the full spikes['chans'] and spikes['nchans']
+    fields, indexed by sid, so they needn't be copied. If norm, divide each row by the max
+    Vpp across chans. Each thread fills its own rows of out. Return number of sids missing
+    any of chans, whose rows are left 0"""
+    cdef Py_ssize_t nspikes, nchans, nt, maxnchans, i, ci, cj, ti
+    cdef int64_t sid
+    cdef int nspikechans, v, vmin, vmax, maxptp, nmissing=0
+    cdef const int16_t *row
+    cdef gather_t *outrow
+    nspikes = sids.shape[0]
+    nchans = chans.shape[0]
+    nt = ti1 - ti0
+    maxnchans = chanss.shape[1]
+    assert 0 <= ti0 < ti1 <= wavedata.shape[2]
+    assert out.shape[0] == nspikes and out.shape[1] == nchans*nt
+    assert maxnchans <= wavedata.shape[1]
+    if gather_t is int16_t:
+        assert not norm # can't normalize into integers
+    for i in prange(nspikes, nogil=True, schedule='static'):
+        sid = sids[i]
+        nspikechans = nchanss[sid]
+        outrow = &out[i, 0]
+        maxptp = 0
+        for ci in range(nchans):
+            for cj in range(nspikechans): # spike's chans are few, linear search is fastest
+                if chanss[sid, cj] == chans[ci]:
+                    break
+            else: # chans[ci] not found
+                nmissing += 1
+                for ti in range(nchans*nt):
+                    outrow[ti] = 0
+                break # out of ci loop
+            row = &wavedata[sid, cj, ti0]
+            vmin = row[0]
+            vmax = row[0]
+            for ti in range(nt):
+                v = row[ti]
+                outrow[ci*nt + ti] = v
+                if v < vmin:
+                    vmin = v
+                elif v > vmax:
+                    vmax = v
+            if vmax - vmin > maxptp:
+                maxptp = vmax - vmin
+        else: # all chans found
+            if gather_t is not int16_t:
+                if norm and maxptp != 0: # prevent div by 0
+                    for ti in range(nchans*nt):
+                        outrow[ti] = outrow[ti] / <double>maxptp
+    return nmissing
+
+
+def match_errors(const int16_t[:, :, ::1] wavedata, const int64_t[::1] sids,
+                 const int64_t[::1] tis, const uint8_t[:, :] chanss,
+                 const uint8_t[:] nchanss, const float32_t[:, :, ::1] tdata,
+                 const uint8_t[:, ::1] tmask, const uint8_t[::1] tchans,
+                 float32_t[::1] errs):
+    """For each pair i, save to errs[i] the RMS error between wavedata[sids[i]] and
+    template tis[i], over all timepoints of their common chans. tdata and tmask are
+    indexed by chan id along their 2nd dim, and hold each template's mean waveform and
+    which chans it has. tchans holds each template's maxchan. Pairs aren't comparable if
+    the spike lacks the template's maxchan, and get an error of -1. Checking that the
+    template has the spike's maxchan is left to the caller, which can use it to prune
+    pairs in advance. chanss and nchanss are the full spikes['chans'] and
+    spikes['nchans'] fields, indexed by sid. Pairs are split across threads"""
+    cdef Py_ssize_t npairs, nt, i, cj, ti
+    cdef int64_t sid, k
+    cdef int chan, ncommon
+    cdef bint found
+    cdef double err, sse
+    cdef const int16_t *row
+    cdef const float32_t *trow
+    npairs = sids.shape[0]
+    nt = wavedata.shape[2]
+    assert tis.shape[0] == npairs and errs.shape[0] == npairs
+    assert tdata.shape[0] == tmask.shape[0] == tchans.shape[0]
+    assert tdata.shape[1] == tmask.shape[1] == 2**8 and tdata.shape[2] == nt
+    for i in prange(npairs, nogil=True, schedule='static'):
+        sid = sids[i]
+        k = tis[i]
+        found = False
+        ncommon = 0
+        sse = 0.0
+        for cj in range(nchanss[sid]):
+            chan = chanss[sid, cj]
+            if chan == tchans[k]:
+                found = True
+            if not tmask[k, chan]:
+                continue
+            ncommon = ncommon + 1
+            row = &wavedata[sid, cj, 0]
+            trow = &tdata[k, chan, 0]
+            for ti in range(nt):
+                err = row[ti] - trow[ti]
+                sse = sse + err*err
+        if found and ncommon > 0:
+            errs[i] = sqrt(sse / (ncommon*nt))
+        else:
+            errs[i] = -1
+
+
+DEF LMMAXITER = 200 # max num Levenberg-Marquardt iterations per spatial fit
+DEF LMFTOL = 1.49012e-08 # same default tolerances as scipy.optimize.leastsq
+DEF LMXTOL = 1.49012e-08
+
+# flags returned per spike by weights2gauss_cy:
+DEF GAUSSREJECT = 1 # spatial sigma exceeded maxsigma
+DEF GAUSSFALLBACK = 2 # fit position was too far from spatial mean, fell back to mean
+DEF GAUSSZEROW = 4 # weights were all 0, used straight spatial mean as initial position
+
+
+cdef double gauss_sse(double *w, double *x, double *y, int n, double A,
+                      double x0, double y0, double s, int mode, int ndim,
+                      double *JTJ, double *g) nogil:
+    """Return sum of squared errors between weights w and a spatial Gaussian of amplitude A
+    centered on x0, y0 with spread s, at chan coords x and y. For ndim=1, only y is used.
+    Also fill JTJ (2x2, row-major) and g (2) with J.T*J and J.T*residuals of the free
+    params: s for mode 0, x0 and y0 (just y0 for ndim=1) for mode 1"""
+    cdef int i
+    cdef double dx, dy, d2, s2, G, r, j0, j1, sse=0.0
+    s2 = s*s
+    JTJ[0] = 0.0; JTJ[1] = 0.0; JTJ[2] = 0.0; JTJ[3] = 0.0
+    g[0] = 0.0; g[1] = 0.0
+    for i in range(n):
+        dx = x[i] - x0
+        dy = y[i] - y0
+        d2 = dy*dy
+        if ndim == 2:
+            d2 = d2 + dx*dx
+        G = A * exp(-d2 / (2*s2))
+        r = G - w[i]
+        sse += r*r
+        if mode == 0: # s free
+            j0 = G * d2 / (s2*s)
+            j1 = 0.0
+        elif ndim == 2: # x0 and y0 free
+            j0 = G * dx / s2
+            j1 = G * dy / s2
+        else: # y0 free
+            j0 = G * dy / s2
+            j1 = 0.0
+        JTJ[0] += j0*j0
+        JTJ[1] += j0*j1
+        JTJ[3] += j1*j1
+        g[0] += j0*r
+        g[1] += j1*r
+    JTJ[2] = JTJ[1]
+    return sse
+
+
+cdef double gauss_sse_p(double *w, double *x, double *y, int n, double A,
+                        double x0, double y0, double s, int mode, int ndim, double *p,
+                        double *JTJ, double *g) nogil:
+    """Call gauss_sse with free params taken from p"""
+    if mode == 0:
+        s = p[0]
+    elif ndim == 2:
+        x0 = p[0]
+        y0 = p[1]
+    else:
+        y0 = p[0]
+    return gauss_sse(w, x, y, n, A, x0, y0, s, mode, ndim, JTJ, g)
+
+
+cdef int gauss_lm(double *w, double *x, double *y, int n, double A,
+                  double x0, double y0, double s, int mode, int ndim, double *p) nogil:
+    """Levenberg-Marquardt least squares fit of the free params of a spatial Gaussian
+    (see gauss_sse) to weights w, starting from and updating p in-place. As in MINPACK
+    (used by scipy.optimize.leastsq), damping is scaled by the running max of the Jacobian
+    column norms. The damping factor is updated according to Nielsen, 1999. Return the
+    number of iterations"""
+    cdef int i, it, k
+    cdef double sse, ssenew, lam=1e-3, nu=2.0, det, actred, predred, rho, dpnorm, pnorm
+    cdef double JTJ[4]
+    cdef double g[2]
+    cdef double JTJnew[4]
+    cdef double gnew[2]
+    cdef double D[2]
+    cdef double Da[2]
+    cdef double M[4]
+    cdef double dp[2]
+    cdef double pnew[2]
+    k = 2 if (mode == 1 and ndim == 2) else 1 # num free params
+    D[0] = 0.0; D[1] = 0.0
+    dp[1] = 0.0; pnew[1] = p[1] if k == 2 else 0.0
+    sse = gauss_sse_p(w, x, y, n, A, x0, y0, s, mode, ndim, p, JTJ, g)
+    for it in range(LMMAXITER):
+        for i in range(k):
+            if JTJ[i*3] > D[i]: # diagonal entries of JTJ are at 0 and 3
+                D[i] = JTJ[i*3]
+            Da[i] = D[i] if D[i] > 0.0 else 1.0 # prevent singular M for zero gradients
+        M[0] = JTJ[0] + lam*Da[0]
+        if k == 1:
+            dp[0] = -g[0] / M[0]
+        else:
+            M[1] = JTJ[1]
+            M[2] = JTJ[2]
+            M[3] = JTJ[3] + lam*Da[1]
+            det = M[0]*M[3] - M[1]*M[2]
+            dp[0] = -(M[3]*g[0] - M[1]*g[1]) / det
+            dp[1] = -(M[0]*g[1] - M[2]*g[0]) / det
+        for i in range(k):
+            pnew[i] = p[i] + dp[i]
+        ssenew = gauss_sse_p(w, x, y, n, A, x0, y0, s, mode, ndim, pnew, JTJnew, gnew)
+        actred = sse - ssenew
+        predred = 0.0
+        dpnorm = 0.0
+        pnorm = 0.0
+        for i in range(k):
+            predred += lam*Da[i]*dp[i]*dp[i] - g[i]*dp[i]
+            dpnorm += Da[i]*dp[i]*dp[i]
+            pnorm += Da[i]*p[i]*p[i]
+        # convergence tests, same as MINPACK, done with respect to the old params:
+        if (((actred <= LMFTOL*sse and -actred <= LMFTOL*sse) and predred <= LMFTOL*sse)
+            or sqrt(dpnorm) <= LMXTOL*sqrt(pnorm) or sse == 0.0):
+            if actred > 0.0 and predred > 0.0: # take the final step
+                for i in range(k):
+                    p[i] = pnew[i]
+            break
+        if actred > 0.0 and predred > 0.0: # step improved the fit, accept it
+            rho = actred / predred
+            for i in range(k):
+                p[i] = pnew[i]
+            for i in range(4):
+                JTJ[i] = JTJnew[i]
+            g[0] = gnew[0]; g[1] = gnew[1]
+            sse = ssenew
+            rho = 1 - (2*rho - 1)**3
+            lam *= rho if rho > 1/3. else 1/3.
+            nu = 2.0
+        else: # step made things worse (or produced nans), increase damping
+            lam *= nu
+            nu *= 2
+            if not lam <= 1e16: # no further progress possible
+                break
+    return it + 1
+
+
+cdef int weights2gauss(double *w, double *x, double *y, int n, int maxchani, int ndim,
+                       double maxsigma, double defsx, double defsy, double sigma2maxd,
+                       double *params) nogil:
+    """Fit spatial location and spread of a 1D or 2D Gaussian to the weights w of one spike
+    at chan coords x and y, and save x0, y0, sx, sy to params. Same sequential scheme as
+    extract.Extractor.weights2f_1D and weights2f_2D: location is initialized to the spatial
+    mean and spread to defsx, then spread s (sx == sy) is fit with location fixed, then
+    location is fit with s fixed. Return GAUSS* flags"""
+    cdef int i, flags=0
+    cdef double absw, wsum=0.0, mx0=0.0, my0=0.0, A, s, x0, y0, d2, maxd
+    cdef double p[2]
+    if n == 1: # only one chan, return its coords and the default sigmas
+        params[0] = <long>x[0]
+        params[1] = <long>y[0]
+        params[2] = defsx
+        params[3] = defsy
+        return flags
+    # abs(w) weighted spatial mean:
+    for i in range(n):
+        absw = w[i] if w[i] >= 0.0 else -w[i]
+        wsum += absw
+        mx0 += absw * x[i]
+        my0 += absw * y[i]
+    if wsum == 0.0: # weights are all 0, maybe due to zero'd data gaps between recordings
+        flags |= GAUSSZEROW
+        for i in range(n):
+            mx0 += x[i]
+            my0 += y[i]
+        wsum = n
+    mx0 /= wsum
+    my0 /= wsum
+    A = w[maxchani]
+    # fit s first, since defsx is not a spike-specific estimate:
+    p[0] = defsx
+    p[1] = 0.0
+    gauss_lm(w, x, y, n, A, mx0, my0, defsx, 0, ndim, p)
+    s = p[0] if p[0] >= 0.0 else -p[0] # keep sigma +ve
+    if not s <= maxsigma:
+        return flags | GAUSSREJECT
+    # now that we have a viable estimate for s, fix it and fit x0 and y0:
+    x0, y0 = mx0, my0
+    if ndim == 2:
+        p[0] = mx0
+        p[1] = my0
+        gauss_lm(w, x, y, n, A, mx0, my0, s, 1, ndim, p)
+        x0, y0 = p[0], p[1]
+    else:
+        p[0] = my0
+        gauss_lm(w, x, y, n, A, mx0, my0, s, 1, ndim, p)
+        y0 = p[0]
+    # squared distance between initial and final position estimates:
+    d2 = (x0 - mx0)**2 + (y0 - my0)**2
+    maxd = sigma2maxd * s
+    if d2 > maxd*maxd:
+        flags |= GAUSSFALLBACK
+        x0, y0 = mx0, my0
+    params[0] = x0
+    params[1] = y0
+    params[2] = s
+    params[3] = s
+    return flags
+
+
+def weights2gauss_cy(float64_t[:, ::1] w, float64_t[:, ::1] x, float64_t[:, ::1] y,
+                     int64_t[::1] nchans, int64_t[::1] maxchanis, int ndim,
+                     double maxsigma, double defsx, double defsy, double sigma2maxd):
+    """Fit a 1D or 2D spatial Gaussian to the weights of each of many spikes at once, one
+    spike per row of w, x and y, each with nchans valid entries. Spikes are split across
+    threads. Return an (nspikes, 4) array of x0, y0, sx, sy, and an array of flags: 1 if
+    rejected due to sigma exceeding maxsigma, 2 if the position fell back to the spatial
+    mean, 4 if the weights were all 0"""
+    cdef Py_ssize_t nspikes, i
+    nspikes = w.shape[0]
+    assert x.shape[0] == nspikes and y.shape[0] == nspikes
+    assert nchans.shape[0] == nspikes and maxchanis.shape[0] == nspikes
+    assert ndim in [1, 2]
+    cdef np.ndarray[float64_t, ndim=2, mode='c'] paramsarr = np.zeros((nspikes, 4))
+    cdef np.ndarray[int32_t, ndim=1, mode='c'] flagsarr = np.zeros(nspikes, dtype=np.int32)
+    cdef float64_t[:, ::1] params = paramsarr
+    cdef int32_t[::1] flags = flagsarr
+    if nspikes == 0:
+        return paramsarr, flagsarr
+    for i in prange(nspikes, nogil=True, schedule='guided'):
+        flags[i] = weights2gauss(&w[i, 0], &x[i, 0], &y[i, 0], nchans[i], maxchanis[i],
+                                 ndim, maxsigma, defsx, defsy, sigma2maxd, &params[i, 0])
+    return paramsarr, flagsarr
 
 
 def intersect1d_uint8(arrs):